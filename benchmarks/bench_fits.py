@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+"""
+Benchmarks of the FITS header helpers of pypher
+"""
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+import collections
+
+import numpy as np
+import astropy.io.fits as fits
+
+from pypher.pypher import kernel_header, format_kernel_header
+from pypher.fitsutils import (get_pixscale, add_pixelscale, update_header,
+                              read_image)
+
+from .common import FITS_SIZES, gaussian
+
+Args = collections.namedtuple('Args', ['psf_source', 'psf_target',
+                                       'reg_fact'])
+
+
+class Headers(object):
+    """Reading and writing the pixel scale and the kernel header"""
+    params = FITS_SIZES
+    param_names = ['size']
+
+    def setup(self, size):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'psf.fits')
+        header = fits.Header()
+        header['PIXSCALE'] = 0.1
+        fits.writeto(self.filename, gaussian(size, size / 16), header)
+        self.args = Args('psf_source.fits', 'psf_target.fits',
+                         [1e-5, 1e-4, 1e-3])
+
+    def teardown(self, size):
+        shutil.rmtree(self.tmpdir)
+
+    def time_get_pixscale(self, size):
+        get_pixscale(self.filename)
+
+    def time_update_header(self, size):
+        update_header(self.filename, [('BENCH', 1, 'Benchmark keyword')])
+
+    def time_kernel_header(self, size):
+        kernel_header(self.args, 0.1)
+
+    def time_format_kernel_header(self, size):
+        format_kernel_header(self.filename, self.args, 0.1)
+
+    def time_read_image(self, size):
+        read_image(self.filename, dtype=np.float32)
+
+
+class AddPixelscale(object):
+    """Writing the pixel scale to a file lacking it"""
+    params = FITS_SIZES
+    param_names = ['size']
+    # The file is rewritten by every call: a single call per sample, on a
+    # file recreated by `setup` before each sample, times the header write
+    # rather than the early exit on the keyword found
+    number = 1
+    repeat = 10
+    warmup_time = 0
+
+    def setup(self, size):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'psf.fits')
+        fits.writeto(self.filename, gaussian(size, size / 16))
+
+    def teardown(self, size):
+        shutil.rmtree(self.tmpdir)
+
+    def time_add_pixelscale(self, size):
+        add_pixelscale(self.filename, 0.1)
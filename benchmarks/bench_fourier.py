@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+"""
+Benchmarks of the Fourier methods of pypher
+"""
+from __future__ import division
+
+from pypher.pypher import psf2otf, deconv_wiener, homogenization_kernel
+
+from .common import SIZES, psf_pair
+
+
+class OTF(object):
+    """Optical transfer function of a PSF"""
+    params = [SIZES, [True, False]]
+    param_names = ['size', 'real']
+    timeout = 300
+
+    def setup(self, size, real):
+        _, self.psf = psf_pair(size)
+
+    def time_psf2otf(self, size, real):
+        psf2otf(self.psf, self.psf.shape, real=real)
+
+    def peakmem_psf2otf(self, size, real):
+        psf2otf(self.psf, self.psf.shape, real=real)
+
+
+class Wiener(object):
+    """Wiener filter of a PSF, for one or several regularisations"""
+    params = [SIZES, [1, 4]]
+    param_names = ['size', 'n_reg']
+    timeout = 300
+
+    def setup(self, size, n_reg):
+        _, self.psf = psf_pair(size)
+        self.reg_fact = 1e-4 if n_reg == 1 else [1e-4] * n_reg
+
+    def time_deconv_wiener(self, size, n_reg):
+        deconv_wiener(self.psf, self.reg_fact, real=True)
+
+    def peakmem_deconv_wiener(self, size, n_reg):
+        deconv_wiener(self.psf, self.reg_fact, real=True)
+
+
+class Homogenization(object):
+    """Homogenization kernel between two PSFs"""
+    params = [SIZES, ['double', 'single']]
+    param_names = ['size', 'precision']
+    timeout = 300
+
+    def setup(self, size, precision):
+        self.psf_target, self.psf_source = psf_pair(size)
+        self.dtype = 'float32' if precision == 'single' else 'float64'
+
+    def time_homogenization_kernel(self, size, precision):
+        homogenization_kernel(self.psf_target, self.psf_source,
+                              dtype=self.dtype)
+
+    def peakmem_homogenization_kernel(self, size, precision):
+        homogenization_kernel(self.psf_target, self.psf_source,
+                              dtype=self.dtype)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+"""
+Benchmarks of the image methods of pypher
+"""
+from __future__ import division
+
+from pypher.pypher import imrotate, imresample, trim, zero_pad
+
+from .common import SIZES, gaussian
+
+
+class Rotation(object):
+    """Rotation of a PSF by a non-trivial angle"""
+    params = SIZES
+    param_names = ['size']
+    timeout = 300
+
+    def setup(self, size):
+        self.psf = gaussian(size, size / 16)
+
+    def time_imrotate(self, size):
+        imrotate(self.psf, 27.45)
+
+    def peakmem_imrotate(self, size):
+        imrotate(self.psf, 27.45)
+
+
+class Resampling(object):
+    """Resampling of a PSF to a coarser or finer pixel scale"""
+    params = [SIZES, [0.1, 0.3]]
+    param_names = ['size', 'target_pixscale']
+    timeout = 300
+
+    def setup(self, size, target_pixscale):
+        self.psf = gaussian(size, size / 16)
+
+    def time_imresample(self, size, target_pixscale):
+        imresample(self.psf, 0.2, target_pixscale)
+
+    def peakmem_imresample(self, size, target_pixscale):
+        imresample(self.psf, 0.2, target_pixscale)
+
+
+class TrimPad(object):
+    """Centered trimming and zero padding of a PSF"""
+    params = SIZES
+    param_names = ['size']
+
+    def setup(self, size):
+        self.psf = gaussian(size, size / 16)
+        # Same parity as the PSF, as required by trim and zero_pad
+        small = size // 2 + (size // 2 + size) % 2
+        self.small = (small, small)
+        self.large = (2 * size + size % 2, 2 * size + size % 2)
+
+    def time_trim(self, size):
+        trim(self.psf, self.small)
+
+    def time_zero_pad(self, size):
+        zero_pad(self.psf, self.large, position='center')
+
+    def peakmem_zero_pad(self, size):
+        zero_pad(self.psf, self.large, position='center')
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+"""
+Benchmarks of the startup time of the command line tools
+
+Each benchmark runs in a fresh interpreter, so that it measures the
+imports done by ``pypher -h`` and friends (see `pypher.lazy`).
+"""
+
+
+class ImportTime(object):
+    """Import of the modules behind the command line tools"""
+
+    def timeraw_import_pypher(self):
+        return "import pypher.pypher"
+
+    def timeraw_import_batch(self):
+        return "import pypher.batch"
+
+    def timeraw_import_apply(self):
+        return "import pypher.apply"
+
+    def timeraw_import_addpixscl(self):
+        return "import pypher.addpixscl"
+
+    def timeraw_pypher_help(self):
+        return """
+        import sys
+        from pypher.pypher import parse_args
+        sys.argv = ['pypher', '--help']
+        try:
+            parse_args()
+        except SystemExit:
+            pass
+        """
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+"""
+Shared parameters and PSF models of the benchmarks
+"""
+from __future__ import division
+
+import numpy as np
+
+# Image sizes, powers of two and awkward (prime) sizes in between
+SIZES = [64, 127, 256, 509, 1024, 2039, 4096]
+
+# Sizes of the FITS files of the header benchmarks
+FITS_SIZES = [64, 1024]
+
+
+def gaussian(size, sigma, dtype=np.float64):
+    """Elliptical Gaussian PSF of unit sum, centered on pixel size // 2"""
+    y, x = np.indices((size, size)) - size // 2
+    psf = np.exp(-(x**2 + 0.7 * y**2) / (2 * sigma**2))
+    return (psf / psf.sum()).astype(dtype)
+
+
+def psf_pair(size):
+    """Target and source PSFs of a given size"""
+    sigma = max(size / 32, 1.)
+    return gaussian(size, 2 * sigma), gaussian(size, sigma)
@@ -11,18 +11,30 @@ addpixscl
 Write the pixel scale in FITS file headers
 
 Usage:
-  addpixscl fits_files pixel_scale [--ext EXT]
+  addpixscl fits_files pixel_scale [--ext EXT] [-j JOBS] [--dry-run]
   addpixscl (-h | --help)
 
 Example:
   addpixscl psf_*.fits 0.1
+  addpixscl psf_*.fits 0.1 -j 16 --dry-run
 """
 from __future__ import absolute_import, print_function, division
 
+import os
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from .parser import ThrowingArgumentParser, ArgumentParserError
-from .fitsutils import has_pixelscale, write_pixelscale
+from .fitsutils import add_pixelscale
+
+# Default number of threads, the work being bound by file I/O
+JOBS = 8
+
+FOUND = 'found'
+WRITTEN = 'written'
+MISSING = 'missing'
+FAILED = 'failed'
 
 
 def parse_args():
@@ -39,9 +51,79 @@ def parse_args():
     parser.add_argument('-e', '--ext', type=int, default=0,
                         help='FITS extension number')
 
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='Number of files processed concurrently')
+
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only report the files lacking a pixel scale')
+
     return parser.parse_args()
 
 
+def _process(fits_file, pixel_scale, ext, dry_run):
+    """Add the pixel scale to a single file and return its status"""
+    try:
+        keys = add_pixelscale(fits_file, pixel_scale, ext, dry_run)
+    except Exception as err:
+        return FAILED, str(err)
+
+    if keys:
+        return FOUND, keys
+    return (MISSING if dry_run else WRITTEN), None
+
+
+def add_pixelscales(fits_files, pixel_scale, ext=0, jobs=JOBS,
+                    dry_run=False):
+    """
+    Write the pixel scale to many FITS files concurrently
+
+    Each file is opened once and, if it has no pixel scale keyword yet,
+    updated with all the CD keywords at once. The files are processed
+    on a pool of ``jobs`` threads since the work is mostly file I/O.
+    Paths repeated in ``fits_files`` (e.g. by overlapping shell globs),
+    or pointing to the same file, are processed once so that no two
+    threads write the same file.
+
+    Parameters
+    ----------
+    fits_files: list of str
+        Paths to FITS image files
+    pixel_scale: float
+        Pixel scale value in arcseconds
+    ext: int, optional
+        Extension number in the FITS files
+    jobs: int, optional
+        Number of threads
+    dry_run: bool, optional
+        If `True`, the files are only read and never rewritten
+
+    Returns
+    -------
+    report: `collections.OrderedDict`
+        ``(status, info)`` per distinct file, in input order (first
+        occurrence), where status is
+        one of `FOUND` (info holds the keywords found), `WRITTEN`,
+        `MISSING` (dry run) or `FAILED` (info holds the error message)
+
+    """
+    def process(fits_file):
+        return _process(fits_file, pixel_scale, ext, dry_run)
+
+    # First path of every distinct file, in input order
+    unique = OrderedDict()
+    for fits_file in fits_files:
+        unique.setdefault(os.path.realpath(fits_file), fits_file)
+    fits_files = list(unique.values())
+
+    if jobs <= 1:
+        results = [process(fits_file) for fits_file in fits_files]
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(process, fits_files))
+
+    return OrderedDict(zip(fits_files, results))
+
+
 def main():  # pragma: no cover
     """Main script for addpixscl"""
     try:
@@ -50,10 +132,23 @@ def main():  # pragma: no cover
         print(__doc__)
         sys.exit()
 
-    for fits_file in args.fits_files:
-        if has_pixelscale(fits_file):
+    report = add_pixelscales(args.fits_files, args.pixel_scale, args.ext,
+                             args.jobs, args.dry_run)
+
+    for fits_file, (status, info) in report.items():
+        if status == FOUND:
             print("Found keywords refering to the pixel scale "
                   "in {0} header.".format(fits_file))
-            continue
-
-        write_pixelscale(fits_file, args.pixel_scale, args.ext)
+        elif status == MISSING:
+            print("No pixel scale in {0} header.".format(fits_file))
+        elif status == FAILED:
+            print("Could not process {0}: {1}".format(fits_file, info))
+
+    statuses = [status for status, _ in report.values()]
+    print("{0} files: {1} written, {2} with a pixel scale, {3} without, "
+          "{4} failed".format(len(statuses), statuses.count(WRITTEN),
+                              statuses.count(FOUND), statuses.count(MISSING),
+                              statuses.count(FAILED)))
+
+    if FAILED in statuses:
+        sys.exit(1)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+aio.py
+------
+asyncio counterparts of the kernel computations and FITS helpers
+
+The computations (FFTs and interpolations) and the FITS reads and
+writes block, so they are run in executors to keep the event loop
+responsive: the computations in a configurable executor, with a
+semaphore bounding how many run at once, and the FITS I/O in a separate
+thread pool so that reads and writes overlap with the computations.
+
+>>> kernel = await compute_kernel_async(psf_a, psf_b, 0.1, 0.2)
+>>> kernel = await kernel_from_files_async('psf_a.fits', 'psf_b.fits',
+...                                        'kernel_a_to_b.fits')
+
+The module level functions use a default `AsyncRunner`, replaced with
+`configure`.
+
+"""
+from __future__ import absolute_import, division
+
+import asyncio
+import functools
+import multiprocessing
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import fitsutils as fits
+from .batch import KernelTask
+from .pypher import (compute_kernel, homogenization_kernel, kernel_header,
+                     load_psf)
+
+# Threads of the default FITS I/O executor
+IO_THREADS = 4
+
+
+class AsyncRunner(object):
+    """
+    Run the blocking functions of pypher from coroutines
+
+    Parameters
+    ----------
+    executor: `concurrent.futures.Executor`, optional
+        Executor of the computations. A `ProcessPoolExecutor` runs them
+        in parallel whatever the GIL. By default, the default executor
+        of the event loop (a thread pool) is used.
+    max_concurrency: int, optional
+        Maximum number of computations running at once (default: the
+        number of CPUs)
+    io_executor: `concurrent.futures.Executor`, optional
+        Executor of the FITS reads and writes (default: a pool of
+        `IO_THREADS` threads, created on the first read or write)
+
+    Notes
+    -----
+    `close`, also called on leaving ``async with``, shuts down the I/O
+    thread pool created by the runner. The executors given as arguments
+    are left to the caller.
+
+    Example
+    -------
+    >>> async with AsyncRunner(ProcessPoolExecutor(8), 8) as runner:
+    ...     kernels = await asyncio.gather(*[
+    ...         runner.compute_kernel(psf, psf_target, 0.1, 0.2)
+    ...         for psf in psfs])
+
+    """
+    def __init__(self, executor=None, max_concurrency=None,
+                 io_executor=None):
+        self.executor = executor
+        self.max_concurrency = max_concurrency or multiprocessing.cpu_count()
+        self.io_executor = io_executor
+        self._own_io = io_executor is None
+        # One semaphore per event loop, as they are bound to it
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self, wait=True):
+        """
+        Shut down the I/O thread pool created by the runner
+
+        The runner can still be used afterwards, a new pool being
+        created on the next read or write.
+
+        Parameters
+        ----------
+        wait: bool, optional
+            If `True` (default), wait for the pending reads and writes
+
+        """
+        if self._own_io and self.io_executor is not None:
+            self.io_executor.shutdown(wait=wait)
+            self.io_executor = None
+
+    def _semaphore(self):
+        """Return the semaphore of the running event loop"""
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def compute(self, func, *args, **kwargs):
+        """
+        Run a computation in the executor, once a slot is free
+
+        Parameters
+        ----------
+        func: callable
+            Blocking function, picklable for a process executor
+        args, kwargs:
+            Arguments of the function
+
+        Returns
+        -------
+        result:
+            Result of ``func(*args, **kwargs)``
+
+        """
+        async with self._semaphore():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs))
+
+    async def io(self, func, *args, **kwargs):
+        """Run a FITS read or write in the I/O executor"""
+        if self.io_executor is None:
+            self.io_executor = ThreadPoolExecutor(IO_THREADS)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_executor, functools.partial(func, *args, **kwargs))
+
+    async def compute_kernel(self, *args, **kwargs):
+        """Awaitable `pypher.pypher.compute_kernel`"""
+        return await self.compute(compute_kernel, *args, **kwargs)
+
+    async def homogenization_kernel(self, *args, **kwargs):
+        """Awaitable `pypher.pypher.homogenization_kernel`"""
+        return await self.compute(homogenization_kernel, *args, **kwargs)
+
+    async def load_psf(self, fits_file, dtype=None):
+        """Awaitable `pypher.pypher.load_psf`"""
+        return await self.io(load_psf, fits_file, dtype)
+
+    async def read_image(self, fits_file, *args, **kwargs):
+        """Awaitable `pypher.fitsutils.read_image`"""
+        return await self.io(fits.read_image, fits_file, *args, **kwargs)
+
+    async def get_pixscale(self, fits_file):
+        """Awaitable `pypher.fitsutils.get_pixscale`"""
+        return await self.io(fits.get_pixscale, fits_file)
+
+    async def update_header(self, fits_file, *args, **kwargs):
+        """Awaitable `pypher.fitsutils.update_header`"""
+        return await self.io(fits.update_header, fits_file, *args, **kwargs)
+
+    async def writeto(self, fits_file, data, *args, **kwargs):
+        """Awaitable `pypher.fitsutils.writeto`"""
+        return await self.io(fits.writeto, fits_file, data, *args, **kwargs)
+
+    async def kernel_from_files(self, psf_source, psf_target, output=None,
+                                angle_source=0.0, angle_target=0.0,
+                                reg_fact=1e-4, dtype=None,
+                                resample='spline'):
+        """
+        Compute the kernel between two PSF files, as the `pypher` command
+
+        Both PSFs are read concurrently, and the kernel is written in the
+        I/O executor, so that the I/O of several kernels overlaps with
+        their computations.
+
+        Parameters
+        ----------
+        psf_source: str
+            FITS file of the source PSF
+        psf_target: str
+            FITS file of the target PSF
+        output: str, optional
+            FITS file the kernel is written to, with the header of the
+            `pypher` command
+        angle_source, angle_target, reg_fact, dtype, resample:
+            See `pypher.pypher.compute_kernel`
+
+        Returns
+        -------
+        kernel: `numpy.ndarray`
+            Homogenization kernel
+        pixel_scale: float
+            Pixel scale of the kernel in arcseconds
+
+        """
+        (source, pixscale_source), (target, pixscale_target) = (
+            await asyncio.gather(self.load_psf(psf_source, dtype),
+                                 self.load_psf(psf_target, dtype)))
+
+        kernel = await self.compute_kernel(source, target, pixscale_source,
+                                           pixscale_target, angle_source,
+                                           angle_target, reg_fact,
+                                           dtype=dtype, resample=resample)
+
+        if output is not None:
+            task = KernelTask(psf_source, psf_target, output, angle_source,
+                              angle_target, reg_fact)
+            await self.writeto(output, kernel,
+                               header=kernel_header(task, pixscale_target),
+                               overwrite=True)
+
+        return kernel, pixscale_target
+
+
+_default = {'runner': None}
+
+
+def configure(executor=None, max_concurrency=None, io_executor=None):
+    """
+    Replace the `AsyncRunner` of the module level functions
+
+    The I/O thread pool of the previous default runner is shut down.
+    See `AsyncRunner` for the parameters.
+
+    Returns
+    -------
+    runner: `AsyncRunner`
+        New default runner
+
+    """
+    if _default['runner'] is not None:
+        _default['runner'].close(wait=False)
+    _default['runner'] = AsyncRunner(executor, max_concurrency, io_executor)
+    return _default['runner']
+
+
+def get_runner():
+    """Return the default `AsyncRunner`, created on first use"""
+    if _default['runner'] is None:
+        configure()
+    return _default['runner']
+
+
+async def compute_kernel_async(*args, **kwargs):
+    """Awaitable `pypher.pypher.compute_kernel` (default runner)"""
+    return await get_runner().compute_kernel(*args, **kwargs)
+
+
+async def homogenization_kernel_async(*args, **kwargs):
+    """Awaitable `pypher.pypher.homogenization_kernel` (default runner)"""
+    return await get_runner().homogenization_kernel(*args, **kwargs)
+
+
+async def kernel_from_files_async(*args, **kwargs):
+    """Awaitable `AsyncRunner.kernel_from_files` (default runner)"""
+    return await get_runner().kernel_from_files(*args, **kwargs)
+
+
+async def load_psf_async(fits_file, dtype=None):
+    """Awaitable `pypher.pypher.load_psf` (default runner)"""
+    return await get_runner().load_psf(fits_file, dtype)
+
+
+async def read_image_async(fits_file, *args, **kwargs):
+    """Awaitable `pypher.fitsutils.read_image` (default runner)"""
+    return await get_runner().read_image(fits_file, *args, **kwargs)
+
+
+async def get_pixscale_async(fits_file):
+    """Awaitable `pypher.fitsutils.get_pixscale` (default runner)"""
+    return await get_runner().get_pixscale(fits_file)
+
+
+async def update_header_async(fits_file, *args, **kwargs):
+    """Awaitable `pypher.fitsutils.update_header` (default runner)"""
+    return await get_runner().update_header(fits_file, *args, **kwargs)
+
+
+async def writeto_async(fits_file, data, *args, **kwargs):
+    """Awaitable `pypher.fitsutils.writeto` (default runner)"""
+    return await get_runner().writeto(fits_file, data, *args, **kwargs)
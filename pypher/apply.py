@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher-apply
+------------
+Convolve a (large) FITS image with a homogenization kernel
+
+The image is memory-mapped (or read block by block when scaled by the
+BSCALE/BZERO keywords) and convolved tile by tile with the
+overlap-save method: each output tile is computed from an input block
+extended by the kernel size, with FFTs of a fixed size and the kernel
+transform computed once. The tiles are written as they are computed to
+an output FITS file created beforehand on disk, so that the memory used
+only depends on the tile size, not on the image size.
+
+The tiles are distributed over a pool of threads (default) or of
+processes. NaNs of the image are set to 0 before the convolution.
+
+Usage:
+  pypher-apply image kernel output [--ext EXT] [--tile TILE]
+               [-j JOBS] [--processes] [--threads THREADS]
+               [--fft-backend BACKEND] [--overwrite]
+  pypher-apply (-h | --help)
+
+Example:
+  pypher-apply mosaic.fits kernel_a_to_b.fits mosaic_b.fits -j 16
+"""
+from __future__ import absolute_import, print_function, division
+
+import sys
+import argparse
+import threading
+import multiprocessing
+import warnings
+
+import numpy as np
+
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+from . import fftutils
+from . import fitsutils as fits
+from .fitsutils import pyfits
+from .parser import ThrowingArgumentParser, ArgumentParserError
+from .pypher import __version__
+
+# Default size of the output tiles (pixels)
+TILE_SIZE = 1024
+
+
+def parse_args():
+    """Argument parser for the command line interface of `pypher-apply`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher-apply',
+        description="Convolve a FITS image with a kernel tile by tile")
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument('image', type=str,
+                        help="FITS file of the image to convolve")
+
+    parser.add_argument('kernel', type=str,
+                        help="FITS file of the kernel")
+
+    parser.add_argument('output', type=str,
+                        help="File name for the convolved image")
+
+    parser.add_argument('-e', '--ext', type=int, default=None,
+                        help="FITS extension of the image "
+                             "(default: first one with data)")
+
+    parser.add_argument('--tile', type=int, default=TILE_SIZE,
+                        help="Approximate size of the output tiles")
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of tiles convolved concurrently")
+
+    parser.add_argument('--processes', action='store_true',
+                        help="Use a pool of processes instead of threads")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used by the FFTs "
+                             "of each job (-1 for all CPUs)")
+
+    parser.add_argument('--fft-backend', type=str, default='scipy',
+                        choices=fftutils.BACKENDS,
+                        help="Library used to compute the FFTs")
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Overwrite the output file if it exists")
+
+    return parser.parse_args()
+
+
+class TiledConvolution(object):
+    """
+    Overlap-save convolution of images with a kernel
+
+    The kernel is centered on its pixel ``shape // 2``, as the kernels
+    produced by pypher, and the images are padded with zeros.
+
+    Parameters
+    ----------
+    kernel: `numpy.ndarray`
+        2D kernel
+    tile: int, optional
+        Approximate size of the output tiles. It is enlarged so that the
+        FFT length ``tile + kernel size - 1`` is a fast FFT length.
+    dtype: `numpy.dtype`, optional
+        Floating point type of the computation (default: kernel type)
+
+    Example
+    -------
+    >>> conv = TiledConvolution(kernel, tile=512)
+    >>> result = conv.convolve(image, jobs=8)
+
+    """
+    def __init__(self, kernel, tile=TILE_SIZE, dtype=None):
+        kernel = np.asarray(kernel)
+        if kernel.ndim != 2:
+            raise ValueError("The kernel must be a 2D image")
+        if dtype is None:
+            dtype = kernel.dtype if kernel.dtype.kind == 'f' else np.float64
+
+        self.dtype = np.dtype(dtype)
+        self.kernel_shape = kernel.shape
+        self.fft_shape = tuple(fftutils.next_fast_len(tile + size - 1)
+                               for size in kernel.shape)
+        self.tile = tuple(length - size + 1
+                          for length, size in zip(self.fft_shape,
+                                                  kernel.shape))
+        # Part of the kernel before its center, i.e. of the input block
+        # before the output tile
+        self.margin = tuple(size - 1 - size // 2 for size in kernel.shape)
+
+        padded = np.zeros(self.fft_shape, dtype=self.dtype)
+        padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+        self.kernel_fourier = fftutils.rfft2(padded)
+        self._local = threading.local()
+
+    def tiles(self, shape):
+        """
+        List the output tiles of an image
+
+        Parameters
+        ----------
+        shape: tuple of int
+            Shape of the image
+
+        Returns
+        -------
+        tiles: list of tuple
+            ``(y0, y1, x0, x1)`` bounds of the tiles
+
+        """
+        return [(y0, min(y0 + self.tile[0], shape[0]),
+                 x0, min(x0 + self.tile[1], shape[1]))
+                for y0 in range(0, shape[0], self.tile[0])
+                for x0 in range(0, shape[1], self.tile[1])]
+
+    def convolve_tile(self, image, bounds):
+        """
+        Convolve a single tile of an image
+
+        Only the block of ``image`` needed by the tile is read, so that
+        ``image`` can be a memory-mapped array or a
+        `fitsutils.ImageSection`.
+
+        Parameters
+        ----------
+        image: `numpy.ndarray`
+            2D image
+        bounds: tuple of int
+            ``(y0, y1, x0, x1)`` bounds of the output tile
+
+        Returns
+        -------
+        tile: `numpy.ndarray`
+            Convolved tile
+
+        """
+        y0, y1, x0, x1 = bounds
+        block = getattr(self._local, 'block', None)
+        if block is None:
+            block = self._local.block = np.empty(self.fft_shape,
+                                                 dtype=self.dtype)
+        block.fill(0)
+
+        # Input region of the tile, clipped to the image
+        first = (y0 - self.margin[0], x0 - self.margin[1])
+        start = (max(first[0], 0), max(first[1], 0))
+        stop = (min(first[0] + self.fft_shape[0], image.shape[0]),
+                min(first[1] + self.fft_shape[1], image.shape[1]))
+        region = block[start[0] - first[0]:stop[0] - first[0],
+                       start[1] - first[1]:stop[1] - first[1]]
+        np.copyto(region, image[start[0]:stop[0], start[1]:stop[1]],
+                  casting='unsafe')
+        np.nan_to_num(region, copy=False)
+
+        product = fftutils.rfft2(block)
+        product *= self.kernel_fourier
+        result = fftutils.irfft2(product, self.fft_shape, overwrite_x=True)
+
+        # Circular convolution is exact after the first kernel size - 1
+        offset = (self.kernel_shape[0] - 1, self.kernel_shape[1] - 1)
+        return result[offset[0]:offset[0] + y1 - y0,
+                      offset[1]:offset[1] + x1 - x0]
+
+    def convolve(self, image, out=None, jobs=1):
+        """
+        Convolve a whole image, tile by tile
+
+        Parameters
+        ----------
+        image: `numpy.ndarray`
+            2D image, possibly memory-mapped
+        out: `numpy.ndarray`, optional
+            Output array, possibly memory-mapped (default: new array)
+        jobs: int, optional
+            Number of threads convolving the tiles (default 1)
+
+        Returns
+        -------
+        out: `numpy.ndarray`
+            Convolved image
+
+        """
+        if out is None:
+            out = np.empty(image.shape, dtype=self.dtype)
+
+        def process(bounds):
+            y0, y1, x0, x1 = bounds
+            out[y0:y1, x0:x1] = self.convolve_tile(image, bounds)
+
+        tiles = self.tiles(image.shape)
+        if jobs <= 1:
+            for bounds in tiles:
+                process(bounds)
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for future in as_completed([executor.submit(process, bounds)
+                                            for bounds in tiles]):
+                    future.result()
+
+        return out
+
+
+_WORKER = {}
+
+
+def _init_worker(kernel, tile, dtype, image_file, ext, output_file,
+                 offset, fft_backend, threads):
+    """Open the input and output images of a worker process"""
+    fftutils.set_backend(fft_backend, workers=threads)
+    hdulist = pyfits.open(image_file)
+    image = fits.image_data(fits.image_hdu(hdulist, ext))
+    _WORKER['hdulist'] = hdulist
+    _WORKER['image'] = image
+    _WORKER['conv'] = TiledConvolution(kernel, tile, dtype)
+    _WORKER['out'] = fits.image_memmap(output_file, image.shape, dtype,
+                                       offset)
+
+
+def _run_tiles(tiles):
+    """Convolve a list of tiles in a worker process"""
+    conv, image, out = _WORKER['conv'], _WORKER['image'], _WORKER['out']
+    for bounds in tiles:
+        y0, y1, x0, x1 = bounds
+        out[y0:y1, x0:x1] = conv.convolve_tile(image, bounds)
+    out.flush()
+    return len(tiles)
+
+
+def apply_kernel(image_file, kernel, output_file, ext=None, tile=TILE_SIZE,
+                 jobs=1, processes=False, threads=1, fft_backend='scipy',
+                 overwrite=False):
+    """
+    Convolve a FITS image with a kernel and write the result to disk
+
+    The output image is created on disk with the header of the input
+    image and filled tile by tile, so neither the input nor the output
+    image is ever loaded in memory.
+
+    Parameters
+    ----------
+    image_file: str
+        Path to the FITS image
+    kernel: str or `numpy.ndarray`
+        Path to the FITS kernel, or kernel array
+    output_file: str
+        Path to the output FITS image
+    ext: int, optional
+        Extension of the image (default: first HDU with data)
+    tile: int, optional
+        Approximate size of the output tiles
+    jobs: int, optional
+        Number of tiles convolved concurrently (default 1)
+    processes: bool, optional
+        If `True`, use a pool of processes instead of threads
+    threads: int, optional
+        Number of threads of the FFTs of each job (default 1)
+    fft_backend: str, optional
+        FFT backend (default 'scipy')
+    overwrite: bool, optional
+        If `True`, overwrite an existing output file
+
+    Returns
+    -------
+    ntiles: int
+        Number of tiles convolved
+
+    """
+    if not isinstance(kernel, np.ndarray):
+        kernel_file = kernel
+        kernel = fits.read_image(kernel_file)
+        if fits.has_pixelscale(kernel_file) and \
+                fits.has_pixelscale(image_file):
+            kernel_scale = fits.get_pixscale(kernel_file)
+            image_scale = fits.get_pixscale(image_file)
+            if not np.isclose(kernel_scale, image_scale, rtol=1e-3):
+                warnings.warn("Kernel pixel scale {0} differs from the "
+                              "image one {1}".format(kernel_scale,
+                                                     image_scale))
+
+    dtype = kernel.dtype if kernel.dtype.kind == 'f' else np.float64
+
+    with pyfits.open(image_file) as hdulist:
+        hdu = fits.image_hdu(hdulist, ext)
+        if hdu.header['NAXIS'] != 2:
+            raise ValueError("The image must be 2D")
+        shape = hdu.shape
+        tile = min(tile, max(shape))
+        offset = fits.create_image(output_file, shape, dtype, hdu.header,
+                                   overwrite=overwrite)
+
+        if not processes:
+            fftutils.set_backend(fft_backend, workers=threads)
+            conv = TiledConvolution(kernel, tile, dtype)
+            out = fits.image_memmap(output_file, shape, dtype, offset)
+            conv.convolve(fits.image_data(hdu), out=out, jobs=jobs)
+            out.flush()
+            return len(conv.tiles(shape))
+
+    tiles = TiledConvolution(kernel, tile, dtype).tiles(shape)
+    nchunks = min(len(tiles), 4 * jobs)
+    chunks = [tiles[idx * len(tiles) // nchunks:
+                    (idx + 1) * len(tiles) // nchunks]
+              for idx in range(nchunks)]
+
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(kernel, tile, dtype, image_file, ext, output_file,
+                      offset, fft_backend, threads)) as executor:
+        return sum(executor.map(_run_tiles, chunks))
+
+
+def main():  # pragma: no cover
+    """Main script for pypher-apply"""
+    try:
+        args = parse_args()
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    ntiles = apply_kernel(args.image, args.kernel, args.output,
+                          ext=args.ext, tile=args.tile, jobs=args.jobs,
+                          processes=args.processes, threads=args.threads,
+                          fft_backend=args.fft_backend,
+                          overwrite=args.overwrite)
+
+    print("pypher-apply: {0} tiles convolved, image saved to "
+          "{1}".format(ntiles, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher-batch
+------------
+Compute many homogenization kernels in a single process
+
+The kernels are described in a manifest file, either
+  * a CSV file with a header line and the columns
+    psf_source, psf_target and optionally output, angle_source,
+    angle_target and reg_fact
+  * a JSON file with a list of such pairs, or a cross product
+    {"sources": [...], "targets": [...]} where each PSF is a file
+    name or a {"psf": file, "angle": deg} object
+
+The PSFs and the transforms of the prepared PSFs are kept in bounded
+LRU caches and shared between the kernels involving them. The kernels
+being computed grouped by target PSF, each PSF is usually loaded once.
+
+With several jobs, the kernels are distributed over a pool of
+processes, each of them keeping its own cache. A failing kernel is
+reported in the log without aborting the rest of the batch.
+
+Usage:
+  pypher-batch manifest [-o OUTPUT_DIR] [-r REG_FACT] [--log LOG]
+               [-j JOBS] [--threads THREADS] [--resample RESAMPLE]
+  pypher-batch (-h | --help)
+
+Example:
+  pypher-batch kernels.csv -o kernels/ -r 1.e-5 -j 32
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import csv
+import json
+import argparse
+import contextlib
+import collections
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import fftutils
+from . import fitsutils as fits
+from .parser import ThrowingArgumentParser, ArgumentParserError
+from .pypher import (load_psf, prepare_source, prepare_source_otf,
+                     prepare_target, psf2otf, urdft2, kernel_from_otf,
+                     kernel_header, setup_logger, RESAMPLINGS,
+                     __version__)
+
+KernelTask = collections.namedtuple('KernelTask',
+                                    ['psf_source', 'psf_target', 'output',
+                                     'angle_source', 'angle_target',
+                                     'reg_fact'])
+
+# Number of PSFs, target transforms and source OTFs kept by `KernelBatch`
+CACHE_ENTRIES = 32
+
+# Environment variables capping the threads of the BLAS/OpenMP libraries
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+
+def parse_args():
+    """Argument parser for the command line interface of `pypher-batch`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher-batch',
+        description="Compute many homogenization kernels "
+                    "from a manifest file")
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument('manifest', type=str,
+                        help="CSV or JSON file listing the kernels")
+
+    parser.add_argument('-o', '--output_dir', type=str, default='.',
+                        help="Directory of the kernels without explicit "
+                             "output name")
+
+    parser.add_argument('-r', '--reg_fact', type=float, nargs='+',
+                        default=[1.e-4],
+                        help="Default regularisation parameter(s) for the "
+                             "Wiener filter")
+
+    parser.add_argument('--log', type=str, default='pypher_batch.log',
+                        help="Log file of the batch")
+
+    parser.add_argument('--fft-backend', type=str, default='scipy',
+                        choices=fftutils.BACKENDS,
+                        help="Library used to compute the FFTs")
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used by the FFTs "
+                             "of each job (-1 for all CPUs)")
+
+    parser.add_argument('--resample', type=str, default='spline',
+                        choices=RESAMPLINGS,
+                        help="Resampling of the source PSFs, see pypher")
+
+    return parser.parse_args()
+
+
+def kernel_name(psf_source, psf_target, output_dir='.'):
+    """
+    Default file name of the kernel between two PSFs
+
+    Parameters
+    ----------
+    psf_source: str
+        Path to the source PSF
+    psf_target: str
+        Path to the target PSF
+    output_dir: str, optional
+        Directory of the kernel (default '.')
+
+    Returns
+    -------
+    output: str
+        Path of the kernel, ``<source>_to_<target>.fits``
+
+    """
+    source, _ = os.path.splitext(os.path.basename(psf_source))
+    target, _ = os.path.splitext(os.path.basename(psf_target))
+    return os.path.join(output_dir, '{0}_to_{1}.fits'.format(source, target))
+
+
+def _psf_entry(entry):
+    """Return the file name and angle of a JSON manifest PSF entry"""
+    if isinstance(entry, dict):
+        return entry['psf'], float(entry.get('angle', 0.0))
+    return entry, 0.0
+
+
+def _reg_fact(value, default):
+    """Parse the regularisation parameter(s) of a manifest entry"""
+    if value is None or value == '':
+        value = default
+    elif not isinstance(value, list):
+        value = [float(val) for val in str(value).split()]
+    return value[0] if len(value) == 1 else list(value)
+
+
+def read_manifest(manifest, output_dir='.', reg_fact=1.e-4):
+    """
+    Read the list of kernels to compute from a manifest file
+
+    Parameters
+    ----------
+    manifest: str
+        Path to a CSV or JSON manifest (see module docstring)
+    output_dir: str, optional
+        Directory of the kernels without explicit output name
+    reg_fact: float or list of float, optional
+        Regularisation parameter(s) of the kernels without explicit one
+
+    Returns
+    -------
+    tasks: list of `KernelTask`
+        The kernels to compute
+
+    """
+    default_reg = reg_fact if isinstance(reg_fact, list) else [reg_fact]
+
+    if manifest.lower().endswith('.json'):
+        with open(manifest) as jfile:
+            content = json.load(jfile)
+        if isinstance(content, dict) and 'sources' in content:
+            pairs = []
+            for source in content['sources']:
+                for target in content['targets']:
+                    (psf_source, angle_source) = _psf_entry(source)
+                    (psf_target, angle_target) = _psf_entry(target)
+                    pairs.append({'psf_source': psf_source,
+                                  'psf_target': psf_target,
+                                  'angle_source': angle_source,
+                                  'angle_target': angle_target,
+                                  'reg_fact': content.get('reg_fact')})
+        elif isinstance(content, dict):
+            pairs = content['pairs']
+        else:
+            pairs = content
+    else:
+        with open(manifest) as cfile:
+            pairs = list(csv.DictReader(cfile, skipinitialspace=True))
+
+    tasks = []
+    outputs = set()
+    for pair in pairs:
+        output = pair.get('output')
+        if output:
+            if output in outputs:
+                raise ValueError("Output {0} appears twice in "
+                                 "{1}".format(output, manifest))
+        else:
+            # Number the duplicated default names in manifest order
+            output = kernel_name(pair['psf_source'], pair['psf_target'],
+                                 output_dir)
+            basename, ext = os.path.splitext(output)
+            idx = 0
+            while output in outputs:
+                idx += 1
+                output = '{0}_{1}{2}'.format(basename, idx, ext)
+        outputs.add(output)
+
+        tasks.append(KernelTask(
+            psf_source=pair['psf_source'],
+            psf_target=pair['psf_target'],
+            output=output,
+            angle_source=float(pair.get('angle_source') or 0.0),
+            angle_target=float(pair.get('angle_target') or 0.0),
+            reg_fact=_reg_fact(pair.get('reg_fact'), default_reg)))
+
+    return tasks
+
+
+class KernelBatch(object):
+    """
+    Compute kernels while caching the PSFs and their transforms
+
+    The PSF files read and the Fourier transforms of the prepared
+    (rotated, normalized and resampled) PSFs are kept in LRU caches of
+    ``maxsize`` entries each, so that they are computed once for all
+    the kernels using them while the memory stays bounded whatever the
+    number of PSFs in the batch.
+
+    Parameters
+    ----------
+    log: `logging.Logger`, optional
+        Logger of the batch
+    resample: str, optional
+        Resampling of the source PSFs among `RESAMPLINGS`
+        (default 'spline')
+    maxsize: int, optional
+        Number of PSFs, of target transforms and of source OTFs kept
+        (default `CACHE_ENTRIES`)
+
+    """
+    def __init__(self, log=None, resample='spline', maxsize=CACHE_ENTRIES):
+        self.log = log
+        self.resample = resample
+        self.maxsize = maxsize
+        self._psfs = collections.OrderedDict()
+        self._targets = collections.OrderedDict()
+        self._sources = collections.OrderedDict()
+
+    def _cached(self, cache, key, build):
+        """Return a cached value, built and stored on a miss"""
+        if key in cache:
+            cache[key] = cache.pop(key)
+            return cache[key]
+
+        value = build()
+        cache[key] = value
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+    def load(self, fits_file):
+        """Return the PSF image and pixel scale of a FITS file"""
+        def build():
+            psf = load_psf(fits_file)
+            if self.log:
+                self.log.info('PSF loaded: %s', fits_file)
+            return psf
+
+        return self._cached(self._psfs, fits_file, build)
+
+    def target_fourier(self, fits_file, angle=0.0):
+        """Return the transform, shape and pixel scale of a target PSF"""
+        def build():
+            psf, pixel_scale = self.load(fits_file)
+            psf = prepare_target(psf, angle)
+            return urdft2(psf), psf.shape, pixel_scale
+
+        return self._cached(self._targets, (fits_file, angle), build)
+
+    def source_otf(self, fits_file, angle, target_pixscale, target_shape):
+        """Return the OTF of a source PSF on a target grid"""
+        def build():
+            psf, pixel_scale = self.load(fits_file)
+            if self.resample == 'fourier':
+                return prepare_source_otf(psf, pixel_scale, target_pixscale,
+                                          target_shape, angle)
+            psf = prepare_source(psf, pixel_scale, target_pixscale,
+                                 target_shape, angle)
+            return psf2otf(psf, target_shape, real=True)
+
+        key = (fits_file, angle, target_pixscale, target_shape)
+        return self._cached(self._sources, key, build)
+
+    def compute(self, task):
+        """
+        Compute the kernel of a task
+
+        Parameters
+        ----------
+        task: `KernelTask`
+            Description of the kernel
+
+        Returns
+        -------
+        kernel: `numpy.ndarray`
+            Kernel image (cube for several regularisation parameters)
+        pixel_scale: float
+            Pixel scale of the kernel in arcseconds
+
+        """
+        target_ft, shape, pixel_scale = self.target_fourier(
+            task.psf_target, task.angle_target)
+        trans_func = self.source_otf(task.psf_source, task.angle_source,
+                                     pixel_scale, shape)
+
+        kernel, _ = kernel_from_otf(trans_func, target_ft, shape,
+                                    reg_fact=task.reg_fact)
+
+        return kernel, pixel_scale
+
+    def run(self, task):
+        """Compute the kernel of a task and write it to disk"""
+        kernel, pixel_scale = self.compute(task)
+
+        fits.writeto(task.output, data=kernel,
+                     header=kernel_header(task, pixel_scale), overwrite=True)
+
+        return task.output
+
+    def try_run(self, task):
+        """
+        Run a task, isolating its errors from the rest of the batch
+
+        Returns
+        -------
+        error: str or None
+            Description of the error raised by the task, if any
+
+        """
+        try:
+            self.run(task)
+        except Exception as err:  # pylint: disable=broad-except
+            return '{0}: {1}'.format(type(err).__name__, err)
+        return None
+
+
+##############
+# PARALLELISM
+##############
+
+_WORKER = {}
+
+
+@contextlib.contextmanager
+def capped_threads(threads):
+    """
+    Cap the threads of the BLAS/OpenMP libraries of child processes
+
+    The environment variables are read when the libraries are loaded,
+    so they must be set before the worker processes are started.
+
+    Parameters
+    ----------
+    threads: int
+        Maximum number of threads per process
+
+    """
+    previous = dict((var, os.environ.get(var)) for var in THREAD_ENV_VARS)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(max(threads, 1))
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(fft_backend, threads, resample, maxsize):
+    """Set up the FFT backend and the kernel cache of a worker process"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        pass
+    else:
+        _WORKER['limits'] = threadpool_limits(max(threads, 1))
+
+    fftutils.set_backend(fft_backend, workers=threads)
+    _WORKER['batch'] = KernelBatch(resample=resample, maxsize=maxsize)
+
+
+def _run_chunk(tasks):
+    """Run a list of tasks in a worker process"""
+    batch = _WORKER['batch']
+    return [(task, batch.try_run(task)) for task in tasks]
+
+
+def _report(log, task, error):
+    """Write the outcome of a task to the batch log"""
+    if log is None:
+        return
+    if error is None:
+        log.info('Kernel %s -> %s (angles %.2f, %.2f deg, R = %s) '
+                 'saved in %s', task.psf_source, task.psf_target,
+                 task.angle_source, task.angle_target,
+                 task.reg_fact, task.output)
+    else:
+        log.error('Kernel %s -> %s FAILED: %s',
+                  task.psf_source, task.psf_target, error)
+
+
+def run_batch(tasks, jobs=1, threads=1, fft_backend='scipy', log=None,
+              resample='spline', maxsize=CACHE_ENTRIES):
+    """
+    Compute and write the kernels of a list of tasks
+
+    The tasks are sorted by target PSF and distributed in contiguous
+    chunks over ``jobs`` worker processes, so that each worker reuses
+    its cached transforms as much as possible.
+
+    Parameters
+    ----------
+    tasks: list of `KernelTask`
+        The kernels to compute
+    jobs: int, optional
+        Number of worker processes (default 1: no pool)
+    threads: int, optional
+        Number of threads of each job (default 1)
+    fft_backend: str, optional
+        FFT backend of each job (default 'scipy')
+    log: `logging.Logger`, optional
+        Logger of the batch
+    resample: str, optional
+        Resampling of the source PSFs (default 'spline')
+    maxsize: int, optional
+        Size of the caches of the `KernelBatch` of each job
+
+    Returns
+    -------
+    failures: list of tuple
+        The ``(task, error)`` pairs of the tasks that failed
+
+    """
+    tasks = sorted(tasks, key=lambda task: (task.psf_target,
+                                            task.angle_target))
+    failures = []
+
+    if jobs <= 1:
+        fftutils.set_backend(fft_backend, workers=threads)
+        batch = KernelBatch(log, resample, maxsize)
+        for task in tasks:
+            error = batch.try_run(task)
+            _report(log, task, error)
+            if error is not None:
+                failures.append((task, error))
+        return failures
+
+    nchunks = min(len(tasks), 4 * jobs)
+    chunks = [tasks[idx * len(tasks) // nchunks:
+                    (idx + 1) * len(tasks) // nchunks]
+              for idx in range(nchunks)]
+
+    with capped_threads(threads):
+        with ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(fft_backend, threads, resample,
+                          maxsize)) as executor:
+            futures = dict((executor.submit(_run_chunk, chunk), chunk)
+                           for chunk in chunks)
+            for future in as_completed(futures):
+                try:
+                    results = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    # The worker itself died, e.g. out of memory
+                    error = '{0}: {1}'.format(type(err).__name__, err)
+                    results = [(task, error) for task in futures[future]]
+                for task, error in results:
+                    _report(log, task, error)
+                    if error is not None:
+                        failures.append((task, error))
+
+    return failures
+
+
+def main():  # pragma: no cover
+    """Main script for pypher-batch"""
+    try:
+        args = parse_args()
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    if os.path.exists(args.log):
+        os.remove(args.log)
+    log = setup_logger(args.log)
+
+    tasks = read_manifest(args.manifest, args.output_dir, args.reg_fact)
+    log.info('%d kernels listed in %s', len(tasks), args.manifest)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    failures = run_batch(tasks, jobs=args.jobs, threads=args.threads,
+                         fft_backend=args.fft_backend, log=log,
+                         resample=args.resample)
+
+    print("pypher-batch: {0} kernels computed, {1} failed - "
+          "see {2}".format(len(tasks) - len(failures), len(failures),
+                           args.log))
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+fftutils.py
+-----------
+Pluggable FFT backend used by the Fourier methods of pypher
+
+Every transform of `pypher.pypher` goes through the functions of this
+module, which dispatch to the selected backend:
+
+* 'scipy'
+    `scipy.fft` (default), multithreaded through ``workers``
+* 'numpy'
+    `numpy.fft`, single-threaded fallback
+* 'pyfftw'
+    `pyfftw.interfaces.scipy_fft`, multithreaded, if installed
+
+All backends keep a cache of the FFT plans per transform shape, so
+repeated transforms of the same shape do not pay the planning cost
+twice (pocketfft internal cache for scipy and numpy, `pyfftw` interface
+cache for pyfftw).
+
+The default backend is only imported by the first transform, so that
+importing pypher does not import `scipy`.
+
+The transforms accept an ``out`` buffer. With the numpy backend
+(numpy >= 2.0) the result is written straight into it, the other
+backends copy their result into it.
+
+"""
+from __future__ import absolute_import, division
+
+import warnings
+
+import numpy as np
+
+BACKENDS = ['scipy', 'numpy', 'pyfftw']
+
+# The module of the default backend is imported on first use
+_state = {'name': 'scipy', 'module': None, 'workers': 1}
+
+# numpy.fft functions accept an ``out`` argument since numpy 2.0
+NUMPY_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+
+def _load_backend(name):
+    """Import and return the FFT module of a given backend"""
+    if name == 'scipy':
+        import scipy.fft as module
+    elif name == 'numpy':
+        module = np.fft
+    elif name == 'pyfftw':
+        import pyfftw.interfaces.cache
+        import pyfftw.interfaces.scipy_fft as module
+        pyfftw.interfaces.cache.enable()
+    else:
+        raise ValueError("Unknown FFT backend '{0}', choose among "
+                         "{1}".format(name, BACKENDS))
+    return module
+
+
+def set_backend(name='scipy', workers=None):
+    """
+    Select the FFT backend and the number of threads it uses
+
+    If the requested backend cannot be imported, a warning is issued
+    and `numpy.fft` is used instead.
+
+    Parameters
+    ----------
+    name: str, optional
+        Name of the backend among `BACKENDS` (default 'scipy')
+    workers: int, optional
+        Number of threads used by the transforms. Negative values wrap
+        around the number of CPUs (-1 uses them all). Ignored by the
+        numpy backend. If `None`, keep the current value.
+
+    """
+    try:
+        module = _load_backend(name)
+    except ImportError:
+        warnings.warn("FFT backend '{0}' not available, "
+                      "falling back to numpy.fft".format(name))
+        name, module = 'numpy', np.fft
+
+    _state['name'] = name
+    _state['module'] = module
+    if workers is not None:
+        _state['workers'] = int(workers)
+
+
+def get_backend():
+    """
+    Return the current FFT backend settings
+
+    Returns
+    -------
+    backend: tuple
+        Name of the backend and number of workers
+
+    """
+    _current_module()
+    return _state['name'], _state['workers']
+
+
+def _current_module():
+    """
+    Return the module of the current backend, importing it if needed
+
+    The default scipy backend silently falls back to numpy.fft if
+    `scipy.fft` is not available (scipy < 1.4).
+
+    """
+    if _state['module'] is None:
+        try:
+            _state['module'] = _load_backend(_state['name'])
+        except ImportError:
+            _state.update(name='numpy', module=np.fft)
+    return _state['module']
+
+
+class fft_backend(object):
+    """
+    Context manager temporarily switching the FFT backend
+
+    Example
+    -------
+    >>> with fft_backend('scipy', workers=8):
+    ...     kernel, _ = homogenization_kernel(psf_target, psf_source)
+
+    """
+    def __init__(self, name='scipy', workers=None):
+        self.name = name
+        self.workers = workers
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = get_backend()
+        set_backend(self.name, self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        set_backend(*self._previous)
+
+
+def _transform(func_name, *args, **kwargs):
+    """Dispatch a transform to the current backend"""
+    out = kwargs.pop('out', None)
+    module = _current_module()
+
+    if _state['name'] == 'numpy':
+        if out is not None and NUMPY_FFT_OUT:
+            return getattr(np.fft, func_name)(*args, out=out, **kwargs)
+    else:
+        kwargs['workers'] = _state['workers']
+
+    result = getattr(module, func_name)(*args, **kwargs)
+    if out is None:
+        return result
+
+    out[...] = result
+    return out
+
+
+def fft2(image, axes=(-2, -1), norm=None, out=None):
+    """2D complex FFT over the given axes"""
+    return _transform('fft2', image, axes=axes, norm=norm, out=out)
+
+
+def ifft2(image, axes=(-2, -1), norm=None, out=None):
+    """2D complex inverse FFT over the given axes"""
+    return _transform('ifft2', image, axes=axes, norm=norm, out=out)
+
+
+def rfft2(image, axes=(-2, -1), norm=None, out=None):
+    """2D real-to-complex FFT over the given axes (half-plane output)"""
+    return _transform('rfft2', image, axes=axes, norm=norm, out=out)
+
+
+def irfft2(image, shape, axes=(-2, -1), norm=None, out=None,
+           overwrite_x=False):
+    """
+    2D complex-to-real inverse FFT over the given axes
+
+    With ``overwrite_x``, the input array may be destroyed, which lets
+    the numpy backend run the transform without any temporary array
+    when an ``out`` buffer is given.
+
+    """
+    shape = tuple(shape)[-2:]
+    _current_module()
+
+    if not overwrite_x:
+        return _transform('irfft2', image, s=shape, axes=axes,
+                          norm=norm, out=out)
+
+    if _state['name'] != 'numpy':
+        return _transform('irfft2', image, s=shape, axes=axes,
+                          norm=norm, out=out, overwrite_x=True)
+
+    if out is not None and NUMPY_FFT_OUT:
+        # Complex inverse transform in place, then real one into out
+        np.fft.ifft(image, n=shape[0], axis=axes[0], norm=norm, out=image)
+        return np.fft.irfft(image, n=shape[1], axis=axes[1], norm=norm,
+                            out=out)
+
+    return _transform('irfft2', image, s=shape, axes=axes,
+                      norm=norm, out=out)
+
+
+def next_fast_len(size):
+    """
+    Smallest FFT-friendly length greater than or equal to ``size``
+
+    The length is a product of 2, 3 and 5 (5-smooth number), for which
+    all the backends are efficient.
+
+    """
+    best = 2 * size
+    factor5 = 1
+    while factor5 < best:
+        factor3 = factor5
+        while factor3 < best:
+            length = factor3
+            while length < size:
+                length *= 2
+            best = min(best, length)
+            factor3 *= 3
+        factor5 *= 5
+    return best
@@ -13,14 +13,321 @@ A set of convenience methods to deal with FITS files
 """
 from __future__ import absolute_import, print_function, division
 
-import astropy.io.fits as pyfits
-from astropy.io.fits import getdata, writeto
+import os
 
+import numpy as np
+
+from .lazy import LazyModule
+
+# Imported on first use (see `pypher.lazy`)
+pyfits = LazyModule('astropy.io.fits')
 
 PIXSCL_KEY_DEG = ['CD1_1', 'CD2_2', 'CDELT1', 'CDELT2']
 PIXSCL_KEY_ARCSEC = ['PIXSCALE', 'SECPIX', 'PIXSCALX', 'PIXSCALY']
 PIXSCL_KEYS = PIXSCL_KEY_DEG + PIXSCL_KEY_ARCSEC
 
+# Size of the chunks read from disk by `read_image` (bytes)
+CHUNK_SIZE = 64 * 2**20
+
+# Keywords describing the data layout, not copied by `create_image`
+STRUCTURAL_KEYS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND',
+                   'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'BLANK',
+                   'CHECKSUM', 'DATASUM']
+
+# Keywords of scaled images, whose data cannot be memory-mapped
+SCALING_KEYS = ['BSCALE', 'BZERO', 'BLANK']
+
+
+def getdata(*args, **kwargs):
+    """Read the data of a FITS file, see `astropy.io.fits.getdata`"""
+    return pyfits.getdata(*args, **kwargs)
+
+
+def writeto(*args, **kwargs):
+    """Write a FITS file, see `astropy.io.fits.writeto`"""
+    return pyfits.writeto(*args, **kwargs)
+
+
+def image_hdu(hdulist, ext=None):
+    """
+    Return the requested HDU of a FITS file, or the first one with data
+
+    Parameters
+    ----------
+    hdulist: `astropy.io.fits.HDUList`
+        Opened FITS file
+    ext: int, optional
+        Extension number in the FITS file (default: first HDU with data)
+
+    Returns
+    -------
+    hdu: `astropy.io.fits.ImageHDU`
+        Image HDU
+
+    """
+    if ext is not None:
+        return hdulist[ext]
+    for hdu in hdulist:
+        if hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    raise IOError("No image data found in {0}.".format(hdulist.filename()))
+
+
+class ImageSection(object):
+    """
+    Image data read block by block on slicing
+
+    Thin wrapper of `ImageHDU.section` exposing the ``shape`` of the
+    image, so that it can stand for the data array in the functions
+    only slicing it.
+
+    Parameters
+    ----------
+    hdu: `astropy.io.fits.ImageHDU`
+        Image HDU
+
+    """
+    def __init__(self, hdu):
+        self.hdu = hdu
+        self.shape = hdu.shape
+
+    def __getitem__(self, key):
+        return self.hdu.section[key]
+
+
+def image_data(hdu):
+    """
+    Return the data of an image HDU without loading it in memory
+
+    The data of an unscaled image is the memory-mapped array of the
+    file. The data of an image scaled by the `SCALING_KEYS` cannot be
+    memory-mapped, and reading it would load and scale the whole image:
+    an `ImageSection` reading and scaling the sliced blocks only is
+    returned instead. The file must be opened with the default
+    ``memmap`` option of `astropy.io.fits.open`, ``memmap=True``
+    forbidding the access to scaled images.
+
+    Parameters
+    ----------
+    hdu: `astropy.io.fits.ImageHDU`
+        Image HDU
+
+    Returns
+    -------
+    data: `numpy.memmap` or `ImageSection`
+        Sliceable image data
+
+    """
+    if any(key in hdu.header for key in SCALING_KEYS):
+        return ImageSection(hdu)
+    return hdu.data
+
+
+def replace_nonfinite(data, value=0.0):
+    """
+    Replace in place the NaNs and infinities of an array
+
+    Parameters
+    ----------
+    data: `numpy.ndarray`
+        Array to clean, left untouched unless floating point or complex
+    value: float, optional
+        Value replacing the non-finite elements (default 0)
+
+    Returns
+    -------
+    data: `numpy.ndarray`
+        The input array
+
+    """
+    # Not nan_to_num(nan=...), which requires numpy >= 1.17
+    if data.dtype.kind in 'fc':
+        data[~np.isfinite(data)] = value
+    return data
+
+
+def read_image(fits_file, ext=None, dtype=None, nan=0.0,
+               chunk_size=CHUNK_SIZE):
+    """
+    Read a FITS image chunk-wise into a native array
+
+    The file is memory-mapped and read by chunks along the first axis,
+    each chunk being converted to ``dtype`` and cleaned from its NaNs
+    and infinities in place. The peak memory is thus the size of the
+    output array plus a single chunk, instead of several copies of the
+    whole image. The chunks of images scaled by BSCALE/BZERO are scaled
+    as they are read.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    ext: int, optional
+        Extension number in the FITS file (default: first HDU with data)
+    dtype: `numpy.dtype`, optional
+        Data type of the output array (default: stored type, in native
+        byte order)
+    nan: float or None, optional
+        Value replacing the NaNs and infinities (default 0). If `None`,
+        they are kept.
+    chunk_size: int, optional
+        Approximate size in bytes of the chunks read from disk
+
+    Returns
+    -------
+    data: `numpy.ndarray`
+        Image data
+
+    """
+    with pyfits.open(fits_file) as hdulist:
+        hdu = image_hdu(hdulist, ext)
+        shape = hdu.shape
+        section = hdu.section
+
+        first = section[0:1]
+        if dtype is None:
+            dtype = first.dtype.newbyteorder('=')
+        data = np.empty(shape, dtype=dtype)
+
+        row_size = max(first.nbytes, 1)
+        step = max(1, int(chunk_size // row_size))
+
+        for start in range(0, shape[0], step):
+            chunk = data[start:start + step]
+            np.copyto(chunk, section[start:start + step], casting='unsafe')
+            if nan is not None:
+                replace_nonfinite(chunk, nan)
+
+    return data
+
+
+def read_section(fits_file, key, ext=None):
+    """
+    Lazily read a section of a FITS image
+
+    Only the part of the file holding the requested section is read,
+    which allows to access a few images of a large cube or a small
+    region of a large image.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    key: slice or tuple of slices
+        Section of the data to read, e.g. ``slice(10, 20)`` for images
+        10 to 19 of a cube
+    ext: int, optional
+        Extension number in the FITS file (default: first HDU with data)
+
+    Returns
+    -------
+    data: `numpy.ndarray`
+        Requested section, in native byte order
+
+    """
+    with pyfits.open(fits_file) as hdulist:
+        data = image_hdu(hdulist, ext).section[key]
+
+    return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+
+def image_shape(fits_file, ext=None):
+    """
+    Return the shape of a FITS image without reading its data
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    ext: int, optional
+        Extension number in the FITS file (default: first HDU with data)
+
+    Returns
+    -------
+    shape: tuple of int
+        Shape of the data array
+
+    """
+    with pyfits.open(fits_file) as hdulist:
+        return image_hdu(hdulist, ext).shape
+
+
+def create_image(fits_file, shape, dtype=np.float32, header=None,
+                 overwrite=False):
+    """
+    Create a FITS image of zeros on disk without allocating it in memory
+
+    The header is written and the file is extended to its final size,
+    the data being filled in afterwards, e.g. through `image_memmap`.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the new FITS file
+    shape: tuple of int
+        Shape of the image
+    dtype: `numpy.dtype`, optional
+        Floating point type of the image (default `numpy.float32`)
+    header: `astropy.io.fits.Header`, optional
+        Header whose non structural keywords are copied, e.g. the WCS
+        of the input image
+    overwrite: bool, optional
+        If `True`, overwrite an existing file
+
+    Returns
+    -------
+    offset: int
+        Position of the data in the file in bytes
+
+    """
+    if os.path.exists(fits_file) and not overwrite:
+        raise IOError("File {0} already exists.".format(fits_file))
+
+    hdu = pyfits.PrimaryHDU(np.zeros((1,) * len(shape), dtype=dtype))
+    for axis, size in enumerate(shape[::-1]):
+        hdu.header['NAXIS{0}'.format(axis + 1)] = size
+    if header is not None:
+        for card in header.cards:
+            if card.keyword.rstrip('0123456789') not in STRUCTURAL_KEYS:
+                hdu.header.append(card)
+
+    header_bytes = hdu.header.tostring().encode('ascii')
+    data_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    padded_size = -(-data_size // 2880) * 2880
+
+    with open(fits_file, 'wb') as fobj:
+        fobj.write(header_bytes)
+        fobj.truncate(len(header_bytes) + padded_size)
+
+    return len(header_bytes)
+
+
+def image_memmap(fits_file, shape, dtype, offset, mode='r+'):
+    """
+    Memory-map the data of a FITS image created by `create_image`
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the FITS file
+    shape: tuple of int
+        Shape of the image
+    dtype: `numpy.dtype`
+        Floating point type of the image
+    offset: int
+        Position of the data in the file, as returned by `create_image`
+    mode: str, optional
+        Memory-map mode (default 'r+': read and write)
+
+    Returns
+    -------
+    data: `numpy.memmap`
+        Big endian view of the image data
+
+    """
+    return np.memmap(fits_file, dtype=np.dtype(dtype).newbyteorder('>'),
+                     mode=mode, offset=offset, shape=tuple(shape))
+
 
 def has_pixelscale(fits_file):
     """
@@ -38,6 +345,34 @@ def has_pixelscale(fits_file):
             if key in list(header.keys())]
 
 
+def pixelscale_cards(value):
+    """
+    Header cards holding a pixel scale
+
+    The input pixel scale value is given in arcseconds but is stored
+    in degrees since the chosen header KEYS are the linear
+    transformation matrix parameters CDi_ja
+
+    Parameters
+    ----------
+    value: float
+        Pixel scale value in arcseconds
+
+    Returns
+    -------
+    cards: list of tuple
+        Header cards as ``(key, value, comment)`` tuples
+
+    """
+    pixscl = value / 3600
+    comment = 'Linear transformation matrix'
+
+    return [('CD1_1', pixscl, comment),
+            ('CD1_2', 0.0, comment),
+            ('CD2_1', 0.0, comment),
+            ('CD2_2', pixscl, comment)]
+
+
 def write_pixelscale(fits_file, value, ext=0):
     """
     Write pixel scale information to a FITS file header
@@ -56,13 +391,113 @@ def write_pixelscale(fits_file, value, ext=0):
         Extension number in the FITS file
 
     """
-    pixscl = value / 3600
-    comment = 'Linear transformation matrix'
+    update_header(fits_file, cards=pixelscale_cards(value), ext=ext)
+
 
-    pyfits.setval(fits_file, 'CD1_1', value=pixscl, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD1_2', value=0.0, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD2_1', value=0.0, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD2_2', value=pixscl, ext=ext, comment=comment)
+def _edit_header(header, cards=(), comments=(), clear_comments=False):
+    """Apply keyword and comment edits to a header object"""
+    if clear_comments:
+        header.remove('COMMENT', ignore_missing=True, remove_all=True)
+
+    for key, value, comment in cards:
+        header[key] = (value, comment)
+
+    if isinstance(comments, str):
+        comments = [comments]
+    for comment in comments:
+        header.add_comment(comment)
+
+    return header
+
+
+def build_header(cards=(), comments=(), header=None):
+    """
+    Build a FITS header in memory
+
+    The header can then be written together with the data in a single
+    `writeto` call.
+
+    Parameters
+    ----------
+    cards: list of tuple, optional
+        Header cards as ``(key, value, comment)`` tuples
+    comments: str or str list, optional
+        Comment(s) to add
+    header: `astropy.io.fits.Header`, optional
+        Header to complete (default: new empty header)
+
+    Returns
+    -------
+    header: `astropy.io.fits.Header`
+        The header
+
+    """
+    if header is None:
+        header = pyfits.Header()
+
+    return _edit_header(header, cards, comments)
+
+
+def update_header(fits_file, cards=(), comments=(), clear_comments=False,
+                  ext=0):
+    """
+    Apply many keyword and comment edits to a FITS header at once
+
+    The file is opened and rewritten only once, whatever the number
+    of edits.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    cards: list of tuple, optional
+        Header cards as ``(key, value, comment)`` tuples
+    comments: str or str list, optional
+        Comment(s) to add
+    clear_comments: bool, optional
+        If `True`, delete the existing COMMENT cards first
+    ext: int, optional
+        Extension number in the FITS file
+
+    """
+    with pyfits.open(fits_file, mode='update') as hdulist:
+        _edit_header(hdulist[ext].header, cards, comments, clear_comments)
+
+
+def add_pixelscale(fits_file, value, ext=0, dry_run=False):
+    """
+    Write the pixel scale to a FITS header unless one is already there
+
+    The file is opened only once: the header is checked for pixel scale
+    keywords and, if none is found, all the CD keywords are written in
+    the same update.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    value: float
+        Pixel scale value in arcseconds
+    ext: int, optional
+        Extension number in the FITS file
+    dry_run: bool, optional
+        If `True`, the file is only read and never rewritten
+
+    Returns
+    -------
+    keys: list of str
+        Pixel scale keywords found in the header, empty if the pixel
+        scale has been (or, with ``dry_run``, would be) written
+
+    """
+    mode = 'readonly' if dry_run else 'update'
+    with pyfits.open(fits_file, mode=mode) as hdulist:
+        header = hdulist[ext].header
+        keys = [key for key in PIXSCL_KEYS if key in header]
+        if not (keys or dry_run):
+            _edit_header(header, pixelscale_cards(value))
+
+    return keys
 
 
 def get_pixscale(fits_file):
@@ -80,13 +515,14 @@ def get_pixscale(fits_file):
         The pixel scale of the image in arcseconds
 
     """
-    pixel_keys = has_pixelscale(fits_file)
+    header = pyfits.getheader(fits_file)
+    pixel_keys = [key for key in PIXSCL_KEYS if key in header]
 
     if not pixel_keys:
         raise IOError("Pixel scale not found in {0}.".format(fits_file))
 
     pixel_key = pixel_keys.pop()
-    pixel_scale = abs(pyfits.getval(fits_file, pixel_key))
+    pixel_scale = abs(header[pixel_key])
 
     if pixel_key in PIXSCL_KEY_DEG:
         pixel_scale *= 3600
@@ -104,11 +540,7 @@ def clear_comments(fits_file):
         Path to a FITS image file
 
     """
-    for comment_key in ['COMMENT', 'comment', 'Comment']:
-        try:
-            pyfits.delval(fits_file, comment_key)
-        except KeyError:
-            pass
+    update_header(fits_file, clear_comments=True)
 
 
 def add_comments(fits_file, values):
@@ -123,8 +555,4 @@ def add_comments(fits_file, values):
         Comment(s) to add
 
     """
-    if isinstance(values, str):
-        pyfits.setval(fits_file, 'COMMENT', value=values)
-    else:
-        for value in values:
-            pyfits.setval(fits_file, 'COMMENT', value=value)
+    update_header(fits_file, comments=values)
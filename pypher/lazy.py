@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+lazy.py
+-------
+Deferred import of the heavy dependencies
+
+`astropy.io.fits` and `scipy.ndimage` take longer to import than most
+kernel computations on small PSFs. They are bound to `LazyModule`
+objects that only import them on first attribute access, so that the
+command line tools print their help or version without importing them.
+
+"""
+from __future__ import absolute_import
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    Module imported on first attribute access
+
+    Parameters
+    ----------
+    name: str
+        Absolute name of the module
+
+    Example
+    -------
+    >>> ndimage = LazyModule('scipy.ndimage')  # nothing imported yet
+    >>> ndimage.rotate(image, 30.)             # imports scipy.ndimage
+
+    """
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__module is not None else 'not loaded'
+        return "<lazy module '{0}' ({1})>".format(self.__name, state)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+metrics.py
+----------
+Per-stage timing and memory metrics of the pypher commands
+
+A `StageMetrics` object times the stages of a run entered with its
+`stage` context manager, optionally together with the peak memory
+traced by `tracemalloc` (which sees the numpy arrays) during each stage,
+and writes them to a JSON file:
+
+>>> metrics = StageMetrics(trace_memory=True)
+>>> with metrics.stage('load'):
+...     psf = read_image('psf.fits')
+...     metrics.describe(psf=psf)
+>>> metrics.write('metrics.json')
+
+"""
+from __future__ import absolute_import, division
+
+import sys
+import json
+import time
+import contextlib
+import tracemalloc
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def max_rss():
+    """
+    Return the peak resident memory of the process in bytes
+
+    Returns
+    -------
+    nbytes: int or `None`
+        Maximum resident set size, `None` if unknown on this platform
+
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return int(rss) if sys.platform == 'darwin' else int(rss) * 1024
+
+
+class StageMetrics(object):
+    """
+    Wall time, peak memory and arrays of the stages of a run
+
+    Parameters
+    ----------
+    trace_memory: bool, optional
+        If `True`, trace the memory allocations with `tracemalloc` to
+        record the peak memory of every stage (default `False`). This
+        slows down the allocations a little.
+    log: `logging.Logger`, optional
+        Logger the duration of every stage is written to
+
+    Attributes
+    ----------
+    info: `collections.OrderedDict`
+        Free-form description of the run (parameters, settings), written
+        with the metrics
+
+    """
+    def __init__(self, trace_memory=False, log=None):
+        self.trace_memory = trace_memory
+        self.log = log
+        self.info = OrderedDict()
+        self.stages = OrderedDict()
+        self._current = None
+        self._started = None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage of the run
+
+        A stage entered several times accumulates its durations and
+        keeps the largest peak memory.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage
+
+        """
+        entry = self.stages.setdefault(name, OrderedDict(
+            [('time', 0.), ('calls', 0)]))
+        previous, self._current = self._current, entry
+
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            duration = time.perf_counter() - start
+            entry['time'] += duration
+            entry['calls'] += 1
+            if self.trace_memory:
+                # Peak since the start of the run on Python < 3.9
+                peak = tracemalloc.get_traced_memory()[1]
+                entry['peak_memory'] = max(entry.get('peak_memory', 0),
+                                           peak)
+            self._current = previous
+            if self.log is not None:
+                self.log.info('Stage %s: %.3f s', name, duration)
+
+    def describe(self, **arrays):
+        """
+        Record the shape and dtype of arrays in the current stage
+
+        Parameters
+        ----------
+        arrays: `numpy.ndarray`
+            Arrays given by name, e.g. ``describe(kernel=kernel)``
+
+        """
+        if self._current is None:
+            raise RuntimeError("describe must be called within a stage")
+        described = self._current.setdefault('arrays', OrderedDict())
+        for name in sorted(arrays):
+            array = arrays[name]
+            described[name] = OrderedDict([
+                ('shape', list(array.shape)),
+                ('dtype', str(array.dtype)),
+                ('nbytes', int(array.nbytes))])
+
+    def as_dict(self):
+        """
+        Return the metrics as a JSON serializable dictionary
+
+        Returns
+        -------
+        metrics: `collections.OrderedDict`
+            The run ``info``, the stages with their ``time`` in seconds,
+            number of ``calls``, ``peak_memory`` in bytes (with
+            ``trace_memory``) and ``arrays``, the ``total_time``, the
+            traced ``peak_memory`` and the ``max_rss`` of the process
+
+        """
+        metrics = OrderedDict()
+        metrics['info'] = self.info
+        metrics['stages'] = self.stages
+        metrics['total_time'] = sum(entry['time']
+                                    for entry in self.stages.values())
+        metrics['peak_memory'] = None
+        if self.trace_memory:
+            metrics['peak_memory'] = max([entry.get('peak_memory', 0)
+                                          for entry in self.stages.values()]
+                                         or [0])
+        metrics['max_rss'] = max_rss()
+        return metrics
+
+    def write(self, filename):
+        """
+        Write the metrics to a JSON file
+
+        Parameters
+        ----------
+        filename: str
+            Output JSON file
+
+        """
+        with open(filename, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2)
+
+    def close(self):
+        """Stop tracing the memory if this object started it"""
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
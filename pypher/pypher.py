@@ -14,6 +14,9 @@ Compute the homogenization kernel between two PSFs
 Usage:
   pypher psf_source psf_target output
          [-s ANGLE_SOURCE] [-t ANGLE_TARGET] [-r REG_FACT]
+         [--fft-backend BACKEND] [--threads THREADS]
+         [--precision {single,double}] [--check-precision]
+  pypher serve [--socket SOCKET | --port PORT] [--root ROOT] [-j JOBS]
   pypher (-h | --help)
 
 Example:
@@ -23,18 +26,61 @@ from __future__ import absolute_import, print_function, division
 
 import os
 import sys
+import glob
+import hashlib
+import tempfile
+import time
 import logging
 import logging.handlers
+import json
 import argparse
+import cProfile
+import warnings
+import threading
+import multiprocessing
 import numpy as np
 
-from scipy.ndimage import rotate, zoom
+from collections import OrderedDict
 
+from . import fftutils
 from . import fitsutils as fits
+from .lazy import LazyModule
+from .metrics import StageMetrics
 from .parser import ThrowingArgumentParser, ArgumentParserError
 
 __version__ = '0.6.4'
 
+# Imported on first use (see `pypher.lazy`)
+ndimage = LazyModule('scipy.ndimage')
+
+# Floating point types of the computation precisions
+PRECISIONS = {'single': np.float32, 'double': np.float64}
+
+# Methods resampling the source PSF to the target pixel scale
+RESAMPLINGS = ['spline', 'fourier']
+
+# Criteria and grid of the automatic selection of the regularisation
+# parameter (``-r auto``)
+REG_METHODS = ['gcv', 'lcurve']
+REG_GRID = np.logspace(-8, 0, 41)
+
+# Sustained floating point operations per second of a single thread,
+# used to turn the operation counts of `plan_kernel` into runtimes
+FLOP_RATE = 1e9
+
+# Binary prefixes of the memory sizes given on the command line
+MEMORY_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+# Environment variable and default size of the on-disk kernel cache
+CACHE_ENV = 'PYPHER_CACHE_DIR'
+CACHE_SIZE = 2**30
+
+# Prefix and suffix of the temporary files of the atomic writes, and age
+# in seconds beyond which one left by an interrupted run is deleted
+TMP_PREFIX = '.pypher-'
+TMP_SUFFIX = '.tmp'
+TMP_MAX_AGE = 3600
+
 
 def parse_args():
     """Argument parser for the command line interface of `pypher`"""
@@ -43,6 +89,9 @@ def parse_args():
         prog='pypher',
         description="Compute the homogenization kernel between two PSFs")
 
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+
     parser.add_argument('psf_source', type=str,
                         help="FITS file of PSF image with highest resolution")
 
@@ -58,36 +107,177 @@ def parse_args():
     parser.add_argument('-t', '--angle_target', type=float, default=0.0,
                         help="Rotation angle to apply to `psf_target` (deg)")
 
-    parser.add_argument('-r', '--reg_fact', type=float, default=1.e-4,
-                        help="Regularisation parameter for the Wiener filter")
+    parser.add_argument('-r', '--reg_fact', type=reg_factor, nargs='+',
+                        default=[1.e-4],
+                        help="Regularisation parameter(s) for the Wiener "
+                             "filter, several values yield a kernel cube, "
+                             "'auto' selects it with --reg-method")
+
+    parser.add_argument('--reg-method', type=str, default='gcv',
+                        choices=REG_METHODS,
+                        help="Criterion of -r auto: generalized "
+                             "cross-validation or L-curve corner")
+
+    parser.add_argument('--fft-backend', type=str, default='scipy',
+                        choices=fftutils.BACKENDS,
+                        help="Library used to compute the FFTs")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used by the FFTs "
+                             "(-1 for all CPUs)")
+
+    parser.add_argument('--precision', type=str, default='double',
+                        choices=sorted(PRECISIONS),
+                        help="Floating point precision of the computation "
+                             "and of the output kernel")
+
+    parser.add_argument('--check-precision', action='store_true',
+                        help="In single precision, also compute the double "
+                             "precision kernel to log the deviation")
+
+    parser.add_argument('--resample', type=str, default='spline',
+                        choices=RESAMPLINGS,
+                        help="Resampling of the source PSF: spline "
+                             "interpolation in image space, or evaluation "
+                             "of its spectrum on the target frequency grid")
+
+    parser.add_argument('--crop-energy', type=float, default=None,
+                        help="Crop the kernel to the smallest odd square "
+                             "holding this fraction of its energy")
+
+    parser.add_argument('--crop-tol', type=float, default=None,
+                        help="Crop the kernel to the smallest odd square "
+                             "outside of which it is below this fraction "
+                             "of its peak")
+
+    parser.add_argument('--cache-dir', type=str,
+                        default=os.environ.get(CACHE_ENV),
+                        help="Directory of the kernel cache, reusing the "
+                             "kernels computed from identical inputs, "
+                             "also set by ${0}".format(CACHE_ENV))
+
+    parser.add_argument('--cache-size', type=memory_size,
+                        default=CACHE_SIZE,
+                        help="Maximum size of the kernel cache in bytes, "
+                             "e.g. 500M")
+
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Neither read nor write the kernel cache")
+
+    parser.add_argument('--metrics', type=str, default=None,
+                        help="JSON file receiving the duration, peak "
+                             "memory and arrays of every stage")
+
+    parser.add_argument('--profile', type=str, default=None,
+                        help="File receiving the cProfile statistics of "
+                             "the run")
+
+    parser.add_argument('--plan', action='store_true',
+                        help="Only print (JSON) the predicted memory and "
+                             "runtime of each stage, from the FITS headers")
+
+    parser.add_argument('--max-memory', type=memory_size, default=None,
+                        help="Memory budget, e.g. 4G, used to recommend "
+                             "settings with --plan")
+
+    args = parser.parse_args()
+    if 'auto' in args.reg_fact and len(args.reg_fact) > 1:
+        parser.error("-r auto cannot be combined with other values")
+
+    return args
+
+
+def reg_factor(value):
+    """
+    Convert a regularisation parameter given on the command line
+
+    Parameters
+    ----------
+    value: str
+        Number or 'auto'
+
+    Returns
+    -------
+    reg_fact: float or str
+        Regularisation parameter, or 'auto'
+
+    """
+    if value.lower() == 'auto':
+        return 'auto'
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid regularisation parameter '{0}'".format(value))
+
+
+def memory_size(value):
+    """
+    Convert a memory size such as '512M' or '4G' to bytes
+
+    Parameters
+    ----------
+    value: str
+        Number of bytes, optionally followed by a K, M, G or T binary
+        prefix (and an optional B)
 
-    return parser.parse_args()
+    Returns
+    -------
+    nbytes: int
+        Number of bytes
+
+    """
+    text = value.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in MEMORY_UNITS else ''
+    try:
+        number = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid memory size '{0}'".format(value))
+    return int(number * MEMORY_UNITS[unit])
 
 ################
 # IMAGE METHODS
 ################
 
 
-def format_kernel_header(fits_file, args, pixel_scale):
+def kernel_header_entries(args, pixel_scale):
     """
-    Write the input parameters of pypher as comments in the header
-
-    The kernel header therefore contains the name of the PSF files
-    it has been created from.
-    The pixel scale of the kernel is also written as a dedicated
-    kernel key.
+    Header cards and comments recording the input parameters of pypher
 
     Parameters
     ----------
-    fits_file: str
-        Path to the FITS kernel image
     args: `argparse.Namespace`
         Container for the parsed values
     pixel_scale: float
         Pixel scale of the kernel
 
+    Returns
+    -------
+    cards: list of tuple
+        Header cards as ``(key, value, comment)`` tuples
+    comments: list of str
+        Header comments
+
     """
-    fits.clear_comments(fits_file)
+    reg_facts = np.atleast_1d(args.reg_fact)
+    if reg_facts.size == 1:
+        reg_comments = ['using a regularisation parameter '
+                        'R = {0:1.1e}'.format(reg_facts[0]), '']
+        reg_cards = [('REGFACT', float(reg_facts[0]),
+                      'Regularisation parameter')]
+    else:
+        reg_comments = ['using the regularisation parameters', '']
+        reg_comments += ['R = {0:1.1e} (plane {1})'.format(reg_fact, idx + 1)
+                         for idx, reg_fact in enumerate(reg_facts)]
+        reg_comments += ['']
+        reg_cards = [('NREGFACT', reg_facts.size,
+                      'Number of regularisation parameters')]
+        reg_cards += [('REGF{0:04d}'.format(idx + 1), float(reg_fact),
+                       'Regularisation parameter of plane {0}'.format(idx + 1))
+                      for idx, reg_fact in enumerate(reg_facts)]
 
     pypher_comments = [
         '=' * 50, '',
@@ -97,23 +287,74 @@ def format_kernel_header(fits_file, args, pixel_scale):
         '=> {0}'.format(os.path.basename(args.psf_source)), '',
         'to PSF', '',
         '=> {0}'.format(os.path.basename(args.psf_target)), '',
-        'using a regularisation parameter '
-        'R = {0:1.1e}'.format(args.reg_fact), '',
-        '=' * 50
-    ]
-    fits.add_comments(fits_file, pypher_comments)
+    ] + reg_comments + ['=' * 50]
+
+    return reg_cards + fits.pixelscale_cards(pixel_scale), pypher_comments
+
+
+def kernel_header(args, pixel_scale, cards=()):
+    """
+    Build in memory the header of a kernel FITS file
+
+    The header contains the name of the PSF files the kernel has been
+    created from, the regularisation parameter(s) used, one per plane
+    for a kernel cube, and the pixel scale of the kernel. It is meant to
+    be written with the kernel data in a single `writeto` call.
+
+    Parameters
+    ----------
+    args: `argparse.Namespace`
+        Container for the parsed values
+    pixel_scale: float
+        Pixel scale of the kernel
+    cards: list of tuple, optional
+        Additional header cards as ``(key, value, comment)`` tuples
+
+    Returns
+    -------
+    header: `astropy.io.fits.Header`
+        Kernel header
+
+    """
+    entries, comments = kernel_header_entries(args, pixel_scale)
+    return fits.build_header(entries + list(cards), comments)
+
+
+def format_kernel_header(fits_file, args, pixel_scale):
+    """
+    Write the input parameters of pypher as comments in the header
+
+    The kernel header therefore contains the name of the PSF files
+    it has been created from.
+    The pixel scale of the kernel is also written as a dedicated
+    kernel key, as well as the regularisation parameter(s) used, one
+    per plane for a kernel cube.
+    All the edits are done with a single update of the file.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the FITS kernel image
+    args: `argparse.Namespace`
+        Container for the parsed values
+    pixel_scale: float
+        Pixel scale of the kernel
 
-    fits.write_pixelscale(fits_file, pixel_scale)
+    """
+    cards, comments = kernel_header_entries(args, pixel_scale)
+    fits.update_header(fits_file, cards, comments, clear_comments=True)
 
 
 def imrotate(image, angle, interp_order=1):
     """
     Rotate an image from North to East given an angle in degrees
 
+    For a cube, every image along the leading axis is rotated.
+
     Parameters
     ----------
     image : `numpy.ndarray`
-        Input data array
+        Input data array (2D image or 3D cube)
     angle : float
         Angle in degrees
     interp_order : int, optional
@@ -125,8 +366,9 @@ def imrotate(image, angle, interp_order=1):
         Rotated data array
 
     """
-    return rotate(image, -1.0 * angle,
-                  order=interp_order, reshape=False, prefilter=False)
+    return ndimage.rotate(image, -1.0 * angle,
+                          axes=(image.ndim - 1, image.ndim - 2),
+                          order=interp_order, reshape=False, prefilter=False)
 
 
 def imresample(image, source_pscale, target_pscale, interp_order=1):
@@ -135,11 +377,12 @@ def imresample(image, source_pscale, target_pscale, interp_order=1):
 
     The resampling ensures the parity of the image is conserved
     to preserve the centering.
+    For a cube, every image along the leading axis is resampled.
 
     Parameters
     ----------
     image : `numpy.ndarray`
-        Input data array
+        Input data array (2D image or 3D cube)
     source_pscale : float
         Pixel scale of ``image`` in arcseconds
     target_pscale : float
@@ -153,11 +396,46 @@ def imresample(image, source_pscale, target_pscale, interp_order=1):
         Resampled data array
 
     """
-    old_size = image.shape[0]
+    old_size = image.shape[-2]
+    ratio = resampled_size(old_size, source_pscale, target_pscale) / old_size
+    zoom_factors = (1,) * (image.ndim - 2) + (ratio, ratio)
+
+    return ndimage.zoom(image, zoom_factors, order=interp_order) / ratio**2
+
+
+def resampled_size(old_size, source_pscale, target_pscale, max_size=10000):
+    """
+    Size of an image resampled from one pixel scale to another
+
+    The size is rounded up to keep the parity of the original size,
+    which preserves the centering.
+
+    Parameters
+    ----------
+    old_size : int
+        Size of the image
+    source_pscale : float
+        Pixel scale of the image in arcseconds
+    target_pscale : float
+        Pixel scale of the resampled image in arcseconds
+    max_size : int or None, optional
+        Maximum size allowed (default 10000), `None` for no limit
+
+    Returns
+    -------
+    new_size : int
+        Size of the resampled image
+
+    Raises
+    ------
+    MemoryError
+        If the resampled image would be larger than ``max_size``
+
+    """
     new_size_raw = old_size * source_pscale / target_pscale
     new_size = int(np.ceil(new_size_raw))
 
-    if new_size > 10000:
+    if max_size is not None and new_size > max_size:
         raise MemoryError("The resampling will yield a too large image. "
                           "Please resize the input PSF image.")
 
@@ -165,32 +443,115 @@ def imresample(image, source_pscale, target_pscale, interp_order=1):
     if (old_size - new_size) % 2 == 1:
         new_size += 1
 
-    ratio = new_size / old_size
+    return new_size
+
+
+def imwarp(image, angle, source_pscale, target_pscale, shape=None,
+           interp_order=1):
+    """
+    Rotate and resample an image with a single interpolation
+
+    This is equivalent to `imrotate` followed by `imresample` and
+    a centered `trim` or `zero_pad` to ``shape``, but the rotation and
+    the scaling are combined in one affine transform evaluated directly
+    on the output grid. The image is therefore interpolated only once
+    and no intermediate image is allocated.
+    For a cube, every image along the leading axis is warped.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input data array (2D image or 3D cube)
+    angle : float
+        Rotation angle from North to East in degrees
+    source_pscale : float
+        Pixel scale of ``image`` in arcseconds
+    target_pscale : float
+        Pixel scale of output array in arcseconds
+    shape : tuple of int, optional
+        Shape of the output image (only the last two axes are used),
+        with the same parity as the resampled image (default: resampled
+        image shape)
+    interp_order : int, optional
+        Spline interpolation order [0, 5] (default 1: linear)
+
+    Returns
+    -------
+    output : `numpy.ndarray`
+        Rotated and resampled data array
+
+    Raises
+    ------
+    MemoryError
+        If the resampled image would be too large
+    ValueError
+        If ``shape`` and the resampled image have different parity
+
+    """
+    in_shape = np.asarray(image.shape[-2:], dtype=int)
+    ratio = resampled_size(in_shape[0], source_pscale,
+                           target_pscale) / in_shape[0]
+    new_shape = np.array([int(round(size * ratio)) for size in in_shape])
+
+    if shape is None:
+        shape = new_shape
+    shape = np.asarray(tuple(shape)[-2:], dtype=int)
+
+    if np.any((new_shape - shape) % 2 != 0):
+        raise ValueError("WARP: resampled and output shapes "
+                         "have different parity")
+
+    # Part of the output grid covered by the resampled image
+    offsets = (new_shape - shape) // 2
+    start = np.maximum(-offsets, 0)
+    stop = np.minimum(shape, new_shape - offsets)
+    window = tuple(slice(first, last) for first, last in zip(start, stop))
 
-    return zoom(image, ratio, order=interp_order) / ratio**2
+    # Output pixel -> resampled pixel (as in `zoom`) -> rotated pixel
+    # (as in `rotate`, around the image center)
+    scale = (in_shape - 1) / np.maximum(new_shape - 1, 1)
+    theta = np.deg2rad(angle)
+    rot_matrix = np.array([[np.cos(theta), -np.sin(theta)],
+                           [np.sin(theta), np.cos(theta)]])
+    matrix = rot_matrix * scale
+    center = (in_shape - 1) / 2
+    offset = matrix.dot(start + offsets) + center - rot_matrix.dot(center)
+
+    output = np.zeros(image.shape[:-2] + tuple(shape), dtype=image.dtype)
+    for index in np.ndindex(*image.shape[:-2]):
+        ndimage.affine_transform(image[index], matrix, offset,
+                                 output=output[index + window],
+                                 order=interp_order, prefilter=False)
+
+    output /= ratio**2
+
+    return output
 
 
 def trim(image, shape):
     """
     Trim image to a given shape
 
+    The shape applies to the trailing axes of the array, so that every
+    image of a cube is trimmed the same way.
+
     Parameters
     ----------
-    image: 2D `numpy.ndarray`
-        Input image
+    image: `numpy.ndarray`
+        Input image (2D) or cube of images (3D)
     shape: tuple of int
         Desired output shape of the image
 
     Returns
     -------
-    new_image: 2D `numpy.ndarray`
+    new_image: `numpy.ndarray`
         Input image trimmed
 
     """
-    shape = np.asarray(shape, dtype=int)
-    imshape = np.asarray(image.shape, dtype=int)
+    shape = np.atleast_1d(np.asarray(shape, dtype=int))
+    imshape = np.asarray(image.shape[image.ndim - shape.size:], dtype=int)
 
-    if np.alltrue(imshape == shape):
+    if np.all(imshape == shape):
         return image
 
     if np.any(shape <= 0):
@@ -204,20 +565,24 @@ def trim(image, shape):
         raise ValueError("TRIM: source and target shapes "
                          "have different parity")
 
-    idx, idy = np.indices(shape)
-    offx, offy = dshape // 2
+    offsets = dshape // 2
+    region = tuple(slice(off, off + size)
+                   for off, size in zip(offsets, shape))
 
-    return image[idx + offx, idy + offy]
+    return image[(Ellipsis,) + region].copy()
 
 
 def zero_pad(image, shape, position='corner'):
     """
     Extends image to a certain size with zeros
 
+    The shape applies to the trailing axes of the array, so that every
+    image of a cube is padded the same way.
+
     Parameters
     ----------
-    image: real 2d `numpy.ndarray`
-        Input image
+    image: real `numpy.ndarray`
+        Input image (2D) or cube of images (3D)
     shape: tuple of int
         Desired output shape of the image
     position : str, optional
@@ -233,10 +598,11 @@ def zero_pad(image, shape, position='corner'):
         The zero-padded image
 
     """
-    shape = np.asarray(shape, dtype=int)
-    imshape = np.asarray(image.shape, dtype=int)
+    shape = np.atleast_1d(np.asarray(shape, dtype=int))
+    nlead = image.ndim - shape.size
+    imshape = np.asarray(image.shape[nlead:], dtype=int)
 
-    if np.alltrue(imshape == shape):
+    if np.all(imshape == shape):
         return image
 
     if np.any(shape <= 0):
@@ -246,41 +612,205 @@ def zero_pad(image, shape, position='corner'):
     if np.any(dshape < 0):
         raise ValueError("ZERO_PAD: target size smaller than source one")
 
-    pad_img = np.zeros(shape, dtype=image.dtype)
-
-    idx, idy = np.indices(imshape)
+    pad_img = np.zeros(image.shape[:nlead] + tuple(shape), dtype=image.dtype)
 
     if position == 'center':
         if np.any(dshape % 2 != 0):
             raise ValueError("ZERO_PAD: source and target shapes "
                              "have different parity.")
-        offx, offy = dshape // 2
+        offsets = dshape // 2
     else:
-        offx, offy = (0, 0)
+        offsets = np.zeros_like(dshape)
 
-    pad_img[idx + offx, idy + offy] = image
+    region = tuple(slice(off, off + size)
+                   for off, size in zip(offsets, imshape))
+    pad_img[(Ellipsis,) + region] = image
 
     return pad_img
 
 
+def crop_kernel(kernel, energy=None, tol=None):
+    """
+    Crop a kernel to the smallest odd square meeting a criterion
+
+    The square is centered on the kernel center (pixel ``shape // 2``,
+    see `psf2otf`). Its size is found from the Chebyshev distance of
+    every pixel to the center, by cumulative sums (energy) or cumulative
+    maxima (tolerance) of the kernel binned by distance, so that all the
+    square sizes are tested in a single pass over the kernel.
+    For a cube, every image is cropped to the size required by the most
+    demanding one.
+
+    Parameters
+    ----------
+    kernel: `numpy.ndarray`
+        Kernel image (2D) or cube of kernels (3D)
+    energy: float, optional
+        Minimum fraction of the kernel energy (sum of the absolute
+        values) inside the square, e.g. 0.999
+    tol: float, optional
+        Maximum absolute value left outside of the square, relative to
+        the kernel peak, e.g. 1e-4
+
+    Returns
+    -------
+    cropped: `numpy.ndarray`
+        Cropped kernel (the input kernel if no odd square smaller than
+        the kernel meets the criteria)
+    flux_lost: float
+        Fraction of the kernel flux (sum) lost to the cropping, the
+        largest absolute value over the images of a cube
+
+    """
+    shape = kernel.shape[-2:]
+    center = np.array(shape) // 2
+    max_radius = min(np.min(center), np.min(np.array(shape) - 1 - center))
+
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    radius = np.maximum(np.abs(y - center[0]), np.abs(x - center[1]))
+    radius = radius.ravel()
+    nbins = radius.max() + 1
+
+    # Smallest half-size meeting the criteria for every image
+    half_size = 0
+    for image in np.abs(kernel).reshape((-1,) + shape):
+        image = image.ravel()
+        if energy is not None:
+            inside = np.cumsum(np.bincount(radius, image, nbins))
+            half_size = max(half_size,
+                            np.argmax(inside >= energy * inside[-1]))
+        if tol is not None:
+            ring_max = np.zeros(nbins)
+            np.maximum.at(ring_max, radius, image)
+            # largest value outside of the square of each half-size
+            outside = np.append(np.maximum.accumulate(ring_max[::-1])[-2::-1],
+                                0)
+            half_size = max(half_size,
+                            np.argmax(outside <= tol * image.max()))
+
+    if half_size > max_radius or (2 * half_size + 1,) * 2 == shape:
+        return kernel, 0.0
+
+    region = tuple(slice(c - half_size, c + half_size + 1) for c in center)
+    cropped = kernel[(Ellipsis,) + region].copy()
+
+    total = kernel.sum(axis=(-2, -1))
+    flux_lost = (total - cropped.sum(axis=(-2, -1))) / total
+
+    return cropped, float(np.max(np.abs(flux_lost)))
+
+
 ##########
 # FOURIER
 ##########
 
 
-def udft2(image):
-    """Unitary fft2"""
-    norm = np.sqrt(image.size)
-    return np.fft.fft2(image) / norm
+def udft2(image, out=None):
+    """Unitary fft2 (over the last two axes)"""
+    norm = np.sqrt(np.prod(image.shape[-2:]))
+    result = fftutils.fft2(image, out=out)
+    result /= norm
+    return result
+
+
+def uidft2(image, out=None):
+    """Unitary ifft2 (over the last two axes)"""
+    norm = np.sqrt(np.prod(image.shape[-2:]))
+    result = fftutils.ifft2(image, out=out)
+    result *= norm
+    return result
+
+
+def urdft2(image, out=None):
+    """Unitary rfft2 (over the last two axes, half-plane output)"""
+    norm = np.sqrt(np.prod(image.shape[-2:]))
+    result = fftutils.rfft2(image, out=out)
+    result /= norm
+    return result
+
+
+def uirdft2(image, shape, out=None, overwrite_x=False):
+    """Unitary irfft2 back to real arrays of given (trailing) shape"""
+    norm = np.sqrt(np.prod(shape[-2:]))
+    result = fftutils.irfft2(image, shape, out=out, overwrite_x=overwrite_x)
+    result *= norm
+    return result
+
+
+def shift_pad(psf, out):
+    """
+    Zero-pad a PSF with its center moved to the [0, 0] element
+
+    This is equivalent to padding the PSF at the corner of the output
+    and circularly shifting it by half its size, as done by `psf2otf`,
+    but writes directly into ``out`` without intermediate arrays.
+
+    Parameters
+    ----------
+    psf : `numpy.ndarray`
+        PSF array (2D image or 3D cube)
+    out : `numpy.ndarray`
+        Output array, at least as large as ``psf`` on the last two axes
+
+    Returns
+    -------
+    out : `numpy.ndarray`
+        The shifted and padded PSF
+
+    """
+    nrow, ncol = psf.shape[-2:]
+    orow, ocol = out.shape[-2:]
+    if nrow > orow or ncol > ocol:
+        raise ValueError("SHIFT_PAD: target size smaller than source one")
+
+    crow, ccol = nrow // 2, ncol // 2
+
+    if (nrow, ncol) != (orow, ocol):
+        out.fill(0)
+
+    out[..., :nrow - crow, :ncol - ccol] = psf[..., crow:, ccol:]
+    out[..., :nrow - crow, ocol - ccol:] = psf[..., crow:, :ccol]
+    out[..., orow - crow:, :ncol - ccol] = psf[..., :crow, ccol:]
+    out[..., orow - crow:, ocol - ccol:] = psf[..., :crow, :ccol]
+
+    return out
+
+
+def hermitian_full(half, shape):
+    """
+    Rebuild a full-plane spectrum from its half-plane counterpart
+
+    The spectrum of a real array is Hermitian, i.e.
+    X[-k, -l] = conj(X[k, l]), so the columns dropped by the real
+    transforms can be recovered without any additional FFT.
+
+    Parameters
+    ----------
+    half : complex `numpy.ndarray`
+        Half-plane spectrum as returned by `numpy.fft.rfft2`
+    shape : tuple of int
+        Shape of the real array in image space
+
+    Returns
+    -------
+    full : complex `numpy.ndarray`
+        Full-plane spectrum as returned by `numpy.fft.fft2`
+
+    """
+    nrow, ncol = shape[-2:]
+    nhalf = half.shape[-1]
+
+    full = np.empty(half.shape[:-1] + (ncol,), dtype=half.dtype)
+    full[..., :nhalf] = half
 
+    rows = -np.arange(nrow) % nrow
+    cols = ncol - np.arange(nhalf, ncol)
+    full[..., nhalf:] = np.conj(half[..., rows, :][..., cols])
 
-def uidft2(image):
-    """Unitary ifft2"""
-    norm = np.sqrt(image.size)
-    return np.fft.ifft2(image) * norm
+    return full
 
 
-def psf2otf(psf, shape):
+def psf2otf(psf, shape, real=False):
     """
     Convert point-spread function to optical transfer function.
 
@@ -295,12 +825,19 @@ def psf2otf(psf, shape):
     the PSF array up (or to the left) until the central pixel reaches (1,1)
     position.
 
+    For a cube of PSFs, the OTFs of all the images along the leading axis
+    are computed at once with a batched FFT.
+
     Parameters
     ----------
     psf : `numpy.ndarray`
-        PSF array
+        PSF array (2D image or 3D cube)
     shape : int
-        Output shape of the OTF array
+        Output shape of the OTF array (last two axes)
+    real : bool, optional
+        If `True`, use a real-to-complex FFT and only return the
+        half-plane of the OTF (last axis of length ``shape[-1] // 2 + 1``)
+        (default `False`)
 
     Returns
     -------
@@ -312,31 +849,127 @@ def psf2otf(psf, shape):
     Adapted from MATLAB psf2otf function
 
     """
+    shape = tuple(shape)[-2:]
+
     if np.all(psf == 0):
+        if real:
+            return np.zeros(psf.shape[:-2] + (shape[0], shape[1] // 2 + 1))
         return np.zeros_like(psf)
 
-    inshape = psf.shape
-    # Pad the PSF to outsize
-    psf = zero_pad(psf, shape, position='corner')
-
-    # Circularly shift OTF so that the 'center' of the PSF is
-    # [0,0] element of the array
-    for axis, axis_size in enumerate(inshape):
-        psf = np.roll(psf, -int(axis_size / 2), axis=axis)
+    # Pad the PSF to outsize and circularly shift it so that
+    # the 'center' of the PSF is [0,0] element of the array
+    psf = shift_pad(psf, np.empty(psf.shape[:-2] + shape, dtype=psf.dtype))
 
     # Compute the OTF
-    otf = np.fft.fft2(psf)
+    if real:
+        otf = fftutils.rfft2(psf)
+    else:
+        otf = fftutils.fft2(psf)
 
     # Estimate the rough number of operations involved in the FFT
     # and discard the PSF imaginary part if within roundoff error
     # roundoff error  = machine epsilon = sys.float_info.epsilon
     # or np.finfo().eps
-    n_ops = np.sum(psf.size * np.log2(psf.shape))
+    n_ops = np.sum(psf.size * np.log2(shape))
     otf = np.real_if_close(otf, tol=n_ops)
 
     return otf
 
 
+def _fold(image, size, axis):
+    """
+    Sum the pixels of an axis modulo ``size``
+
+    The DFT of length ``size`` of the folded axis is the spectrum of
+    the original axis sampled at the same frequencies.
+
+    """
+    axis %= image.ndim
+    length = image.shape[axis]
+    if length <= size:
+        return image
+
+    nfolds = -(-length // size)
+    padding = [(0, 0)] * image.ndim
+    padding[axis] = (0, nfolds * size - length)
+    image = np.pad(image, padding, mode='constant')
+    shape = image.shape[:axis] + (nfolds, size) + image.shape[axis + 1:]
+    return image.reshape(shape).sum(axis=axis)
+
+
+def psf2otf_resampled(psf, pixscale, target_pixscale, shape):
+    """
+    Half-plane OTF of a PSF resampled to another pixel scale
+
+    The PSF is zero padded (or folded, if larger) to the grid of its own
+    pixels spanning the field of view of an image of the given ``shape``
+    at ``target_pixscale``, and Fourier transformed. Since both grids
+    cover the same field, the OTF on the output grid is that spectrum
+    cropped (downsampling) or zero padded (upsampling), the frequencies
+    above the Nyquist frequency of the PSF being set to zero, with a
+    phase shift centering the PSF as `psf2otf` does.
+    The result matches ``psf2otf(psf_resampled, shape, real=True)``
+    where ``psf_resampled`` is the PSF resampled to ``target_pixscale``
+    and centered on an image of the given shape, without ever building
+    that image: there is thus no limit on the resampling ratio.
+
+    The number of PSF pixels spanning the output field is rounded to an
+    integer, so the resampling ratio is exact up to half a pixel over
+    the field, as with `resampled_size`.
+
+    Parameters
+    ----------
+    psf : `numpy.ndarray`
+        Normalized PSF array (2D image or 3D cube)
+    pixscale : float
+        Pixel scale of ``psf`` in arcseconds
+    target_pixscale : float
+        Pixel scale of the output grid in arcseconds
+    shape : tuple of int
+        Shape of the output grid in image space (last two axes)
+
+    Returns
+    -------
+    otf : `numpy.ndarray`
+        Half-plane OTF array (last axis of length ``shape[-1] // 2 + 1``)
+
+    """
+    shape = tuple(shape)[-2:]
+    ratio = pixscale / target_pixscale
+    ctype = np.result_type(psf.dtype, np.complex64)
+
+    # PSF pixels spanning the field of view of the output grid
+    sizes = [max(int(round(out_size / ratio)), 1) for out_size in shape]
+    centers = [(in_size - 1) / 2 for in_size in psf.shape[-2:]]
+
+    grid = _fold(_fold(psf, sizes[0], -2), sizes[1], -1)
+    grid = zero_pad(grid, sizes)
+    spectrum = fftutils.rfft2(grid)
+    del grid
+
+    def axis_phase(freqs, center, size, out_size):
+        # Phases referenced to the PSF center and to the pixel
+        # out_size // 2 of the output grid, as in `psf2otf`
+        shift = center / size
+        shift -= ((out_size - 1) / 2 - out_size // 2) / out_size
+        phase = np.exp(2j * np.pi * shift * freqs).astype(ctype)
+        phase[np.abs(freqs) > size / 2] = 0
+        return phase
+
+    row_freqs = np.fft.fftfreq(shape[0], 1 / shape[0])
+    col_freqs = np.arange(shape[1] // 2 + 1)
+    rows = row_freqs.round().astype(int) % sizes[0]
+    cols = np.minimum(col_freqs, sizes[1] // 2)
+
+    otf = spectrum.take(rows, axis=-2)
+    del spectrum
+    otf = otf.take(cols, axis=-1).astype(ctype, copy=False)
+    otf *= axis_phase(row_freqs, centers[0], sizes[0], shape[0])[:, None]
+    otf *= axis_phase(col_freqs, centers[1], sizes[1], shape[1])
+
+    return otf
+
+
 ################
 # DECONVOLUTION
 ################
@@ -346,7 +979,123 @@ LAPLACIAN = np.array([[ 0, -1,  0],
                       [ 0, -1,  0]])
 
 
-def deconv_wiener(psf, reg_fact):
+class RegularizationCache(object):
+    """
+    Bounded LRU cache of the squared modulus of regularization OTFs
+
+    The regularization term of the Wiener filter only depends on the
+    shape of the PSF, its dtype and the regularization operator, so it
+    can be shared between all the kernels computed on a same grid.
+    The cached arrays are read-only.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        Maximum number of cached OTFs (default 16)
+
+    Example
+    -------
+    >>> reg_cache.warm([(255, 255), (101, 101)])
+    >>> reg_cache.info()
+    {'hits': 0, 'misses': 2, 'size': 2, 'maxsize': 16}
+    >>> reg_cache.clear()
+
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def _key(shape, dtype, operator, real):
+        """Hashable key of a regularization OTF"""
+        return (tuple(int(size) for size in shape), np.dtype(dtype).str,
+                operator.shape, operator.tobytes(), bool(real))
+
+    def get(self, shape, dtype=float, operator=LAPLACIAN, real=False):
+        """
+        Return the squared modulus of the OTF of a regularization operator
+
+        Parameters
+        ----------
+        shape: tuple of int
+            Shape of the OTF array
+        dtype: `numpy.dtype`, optional
+            Data type of the PSF the OTF is used with (default float)
+        operator: `numpy.ndarray`, optional
+            Regularization operator (default `LAPLACIAN`)
+        real: bool, optional
+            If `True`, only return the half-plane of the OTF
+            (default `False`)
+
+        Returns
+        -------
+        reg_otf2: `numpy.ndarray`
+            Read-only array holding the squared modulus of the OTF
+
+        """
+        operator = np.asarray(operator, dtype=dtype)
+        key = self._key(shape, dtype, operator, real)
+
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache[key] = self._cache.pop(key)
+                return self._cache[key]
+            self.misses += 1
+
+        reg_otf2 = np.abs(psf2otf(operator, shape, real=real))**2
+        reg_otf2.setflags(write=False)
+
+        with self._lock:
+            self._cache[key] = reg_otf2
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+        return reg_otf2
+
+    def warm(self, shapes, dtype=float, operator=LAPLACIAN, real=True):
+        """
+        Pre-compute the regularization OTFs for a list of shapes
+
+        Parameters
+        ----------
+        shapes: list of tuple of int
+            Shapes of the OTF arrays
+        dtype: `numpy.dtype`, optional
+            Data type of the PSFs (default float)
+        operator: `numpy.ndarray`, optional
+            Regularization operator (default `LAPLACIAN`)
+        real: bool, optional
+            If `True`, cache the half-plane OTFs used by
+            `homogenization_kernel` (default `True`)
+
+        """
+        for shape in shapes:
+            self.get(shape, dtype=dtype, operator=operator, real=real)
+
+    def clear(self):
+        """Empty the cache and reset its statistics"""
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return the cache statistics as a dictionary"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache), 'maxsize': self.maxsize}
+
+
+reg_cache = RegularizationCache()
+
+
+def deconv_wiener(psf, reg_fact, real=False):
     r"""
     Create a Wiener filter using a PSF image
 
@@ -356,30 +1105,70 @@ def deconv_wiener(psf, reg_fact):
     instead of simple Fourier transform, since it ensures the phase
     of the psf is adequately placed.
 
+    The regularization term only depends on the shape of the PSF and
+    is therefore memoized in `reg_cache`.
+
     Parameters
     ----------
     psf: `numpy.ndarray`
         PSF array
-    reg_fact: float
-        Regularisation parameter for the Wiener filter
+    reg_fact: float or sequence of float
+        Regularisation parameter(s) for the Wiener filter
+    real: bool, optional
+        If `True`, only compute the half-plane of the filter using
+        real-to-complex FFTs (default `False`)
 
     Returns
     -------
     wiener: complex `numpy.ndarray`
-        Fourier space Wiener filter
+        Fourier space Wiener filter. For a sequence of regularisation
+        parameters, the filters are stacked along a new leading axis.
 
     """
     # Optical transfer functions
-    trans_func = psf2otf(psf, psf.shape)
-    reg_op = psf2otf(LAPLACIAN, psf.shape)
+    trans_func = psf2otf(psf, psf.shape, real=real)
+
+    return wiener_filter(trans_func, reg_fact, psf.shape[-2:], real=real)
+
+
+def wiener_filter(trans_func, reg_fact, shape, real=False):
+    """
+    Create a Wiener filter from the OTF of a PSF
+
+    Parameters
+    ----------
+    trans_func: `numpy.ndarray`
+        OTF of the PSF, as returned by `psf2otf`
+    reg_fact: float or sequence of float
+        Regularisation parameter(s) for the Wiener filter
+    shape: tuple of int
+        Shape of the PSF image(s) in image space
+    real: bool, optional
+        If `True`, ``trans_func`` is a half-plane OTF (default `False`)
+
+    Returns
+    -------
+    wiener: complex `numpy.ndarray`
+        Fourier space Wiener filter
+
+    """
+    reg_otf2 = reg_cache.get(tuple(shape)[-2:], trans_func.real.dtype,
+                             real=real)
+
+    if np.ndim(reg_fact):
+        # Broadcast the denominator over a new leading axis
+        reg_fact = np.reshape(np.asarray(reg_fact, dtype=reg_otf2.dtype),
+                              (-1,) + (1,) * trans_func.ndim)
 
     wiener = np.conj(trans_func) / (np.abs(trans_func)**2 +
-                                    reg_fact * np.abs(reg_op)**2)
+                                    reg_fact * reg_otf2)
 
     return wiener
 
 
-def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True):
+def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True,
+                          full_fourier=False, workspace=None, dtype=None,
+                          crop_energy=None, crop_tol=None):
     r"""
     Compute the homogenization kernel to match two PSFs
 
@@ -388,38 +1177,1154 @@ def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True):
     The output is given both in Fourier and in the image domain to serve
     different purposes.
 
+    Since both PSFs are real, the whole computation is done with
+    real-to-complex FFTs and the Fourier space arrays only hold the
+    non-redundant half-plane of the Hermitian spectra.
+
+    Several regularisation parameters can be given at once: the OTFs
+    are then computed only once and the kernels are returned as a cube,
+    one plane per parameter.
+
+    The PSFs can also be cubes of PSFs (e.g. spatially varying PSFs) of
+    same shape, or a cube and a single image. The kernels are then
+    computed with batched FFTs along the leading axis, and the
+    regularisation term is shared by all the images.
+
     Parameters
     ----------
     psf_target: `numpy.ndarray`
-        2D array
+        2D array or 3D cube
     psf_source: `numpy.ndarray`
-        2D array
-    reg_fact: float, optional
-        Regularisation parameter for the Wiener filter
+        2D array or 3D cube
+    reg_fact: float or sequence of float, optional
+        Regularisation parameter(s) for the Wiener filter
     clip: bool, optional
-        If `True`, enforces the non-amplification of the noise
-        (default `True`)
+        Unused, kept for backward compatibility: the kernel is not
+        clipped
+    full_fourier: bool, optional
+        If `True`, return the full-plane `kernel_fourier` instead of
+        the half-plane one (default `False`)
+    workspace: `KernelWorkspace`, optional
+        Preallocated buffers used to compute the kernel without
+        temporary arrays. The returned half-plane `kernel_fourier` is
+        then a workspace buffer, overwritten by the next call.
+    dtype: `numpy.dtype`, optional
+        Real floating point type of the computation, e.g. `numpy.float32`
+        to run it in single precision (complex64 transforms). By default
+        the precision of the PSFs is used.
+    crop_energy: float, optional
+        If given, crop ``kernel_image`` to the smallest odd square
+        holding this fraction of its energy (see `crop_kernel`)
+    crop_tol: float, optional
+        If given, crop ``kernel_image`` to the smallest odd square
+        outside of which the kernel is below this fraction of its peak
+        (see `crop_kernel`)
 
     Returns
     -------
     kernel_image: `numpy.ndarray`
-        2D deconvolved image
+        2D deconvolved image, or cube of images for PSF cubes and/or a
+        sequence of ``reg_fact`` (the latter being the leading axis)
     kernel_fourier: `numpy.ndarray`
-        2D discrete Fourier transform of deconvolved image
+        2D discrete Fourier transform of deconvolved image, restricted
+        to the half-plane unless ``full_fourier`` is set, with the same
+        leading axes as ``kernel_image``. It is not cropped.
 
     """
-    wiener = deconv_wiener(psf_source, reg_fact)
+    if dtype is not None:
+        psf_target = np.asarray(psf_target, dtype=dtype)
+        psf_source = np.asarray(psf_source, dtype=dtype)
+
+    if workspace is not None:
+        kernel_image, kernel_fourier = workspace.homogenization_kernel(
+            psf_target, psf_source, reg_fact=reg_fact)
+        if full_fourier:
+            kernel_fourier = hermitian_full(kernel_fourier,
+                                            psf_target.shape)
+    else:
+        trans_func = psf2otf(psf_source, psf_source.shape, real=True)
 
-    kernel_fourier = wiener * udft2(psf_target)
-    kernel_image = np.real(uidft2(kernel_fourier))
+        kernel_image, kernel_fourier = kernel_from_otf(
+            trans_func, urdft2(psf_target), psf_target.shape[-2:],
+            reg_fact=reg_fact, full_fourier=full_fourier)
 
-    if clip:
-        kernel_image.clip(-1, 1)
+        if dtype is not None:
+            # FFT libraries without single precision support promote
+            # to double
+            kernel_image = kernel_image.astype(dtype, copy=False)
+            kernel_fourier = kernel_fourier.astype(
+                np.result_type(dtype, np.complex64), copy=False)
+
+    if crop_energy is not None or crop_tol is not None:
+        kernel_image, _ = crop_kernel(kernel_image, crop_energy, crop_tol)
 
     return kernel_image, kernel_fourier
 
 
-########
+def kernel_from_otf(trans_func, target_fourier, shape, reg_fact=1e-4,
+                    clip=True, full_fourier=False):
+    """
+    Compute the homogenization kernel from pre-computed transforms
+
+    This is the Fourier space part of `homogenization_kernel`, which
+    allows to reuse the transforms of PSFs involved in several kernels.
+
+    Parameters
+    ----------
+    trans_func: `numpy.ndarray`
+        Half-plane OTF of the source PSF, i.e.
+        ``psf2otf(psf_source, shape, real=True)``
+    target_fourier: `numpy.ndarray`
+        Half-plane unitary transform of the target PSF, i.e.
+        ``urdft2(psf_target)``
+    shape: tuple of int
+        Shape of the PSF images in image space
+    reg_fact: float or sequence of float, optional
+        Regularisation parameter(s) for the Wiener filter
+    clip: bool, optional
+        Unused, kept for backward compatibility: the kernel is not
+        clipped
+    full_fourier: bool, optional
+        If `True`, return the full-plane `kernel_fourier` instead of
+        the half-plane one (default `False`)
+
+    Returns
+    -------
+    kernel_image: `numpy.ndarray`
+        Deconvolved image
+    kernel_fourier: `numpy.ndarray`
+        Discrete Fourier transform of deconvolved image
+
+    """
+    shape = tuple(shape)[-2:]
+
+    # Align the PSF axes of a single source with a cube of targets,
+    # ahead of the regularisation axis
+    if target_fourier.ndim > trans_func.ndim:
+        trans_func = trans_func.reshape(
+            (1,) * (target_fourier.ndim - trans_func.ndim) + trans_func.shape)
+
+    wiener = wiener_filter(trans_func, reg_fact, shape, real=True)
+
+    kernel_fourier = wiener * target_fourier
+    kernel_image = uirdft2(kernel_fourier, shape)
+
+    if full_fourier:
+        kernel_fourier = hermitian_full(kernel_fourier, shape)
+
+    return kernel_image, kernel_fourier
+
+
+def _half_plane_weights(shape):
+    """Multiplicity of the half-plane frequencies in the full plane"""
+    weights = np.full(shape[-1] // 2 + 1, 2.)
+    weights[0] = 1.
+    if shape[-1] % 2 == 0:
+        weights[-1] = 1.
+    return weights
+
+
+def reg_curve(trans_func, target_fourier, shape, reg_facts=REG_GRID,
+              chunk_size=2**22):
+    """
+    Residual and regularisation norms of the kernels over a grid of R
+
+    The Wiener filter being diagonal in Fourier space, the norms of the
+    kernels and the trace of the influence operator are computed in
+    closed form from the half-plane transforms, without any inverse FFT.
+    For a parameter R, the filter factors are
+    ``F = |H|^2 / (|H|^2 + R |L|^2)`` and
+
+    * residual: ``||psf_target - psf_source * kernel||^2 =
+      sum(|T|^2 (1 - F)^2)``
+    * seminorm: ``||L * kernel||^2 = sum(|L|^2 |K|^2)``
+    * gcv: ``N residual / (sum(1 - F))^2``, N being the number of pixels
+
+    The sums run over the full plane, i.e. over the half-plane weighted
+    by the multiplicity of each frequency. The grid is evaluated by
+    chunks of at most ``chunk_size`` elements.
+
+    Parameters
+    ----------
+    trans_func: `numpy.ndarray`
+        Half-plane OTF of the source PSF
+    target_fourier: `numpy.ndarray`
+        Half-plane unitary transform of the target PSF
+    shape: tuple of int
+        Shape of the PSF images in image space
+    reg_facts: sequence of float, optional
+        Regularisation parameters to evaluate (default `REG_GRID`)
+    chunk_size: int, optional
+        Maximum number of elements of the temporary arrays
+
+    Returns
+    -------
+    curve: `collections.OrderedDict`
+        Arrays ``reg_fact``, ``residual``, ``seminorm`` and ``gcv``
+
+    """
+    shape = tuple(shape)[-2:]
+    reg_facts = np.asarray(reg_facts, dtype=float).ravel()
+
+    # Every quantity only depends on |H|^2, |L|^2 and |T|^2, flattened
+    # over the frequencies (and the PSFs of a cube)
+    trans_func, target_fourier = np.broadcast_arrays(trans_func,
+                                                     target_fourier)
+    otf2 = np.abs(trans_func).astype(float).ravel()**2
+    target2 = np.abs(target_fourier).astype(float).ravel()**2
+    reg_otf2 = np.broadcast_to(reg_cache.get(shape, float, real=True),
+                               trans_func.shape).ravel()
+    weights = np.broadcast_to(_half_plane_weights(shape),
+                              trans_func.shape).ravel()
+    npix = weights.sum()
+
+    residual = np.empty(len(reg_facts))
+    seminorm = np.empty(len(reg_facts))
+    trace = np.empty(len(reg_facts))
+    step = max(1, chunk_size // len(weights))
+    for start in range(0, len(reg_facts), step):
+        reg = reg_facts[start:start + step, np.newaxis]
+        denom = otf2 + reg * reg_otf2
+        # 1 - F and |K|^2 = |H|^2 |T|^2 / denom^2
+        complement = reg * reg_otf2 / denom
+        residual[start:start + step] = np.dot(complement**2,
+                                              weights * target2)
+        seminorm[start:start + step] = np.dot(otf2 / denom**2,
+                                              weights * reg_otf2 * target2)
+        trace[start:start + step] = np.dot(complement, weights)
+
+    curve = OrderedDict()
+    curve['reg_fact'] = reg_facts
+    curve['residual'] = residual
+    curve['seminorm'] = seminorm
+    curve['gcv'] = npix * residual / trace**2
+    return curve
+
+
+def select_reg_fact(trans_func, target_fourier, shape, reg_facts=REG_GRID,
+                    method='gcv'):
+    """
+    Select the regularisation parameter of the Wiener filter
+
+    The parameter is picked over a grid, either as the minimum of the
+    generalized cross-validation function, or at the corner of the
+    L-curve, i.e. the point of maximum curvature of the log residual
+    versus log seminorm curve (see `reg_curve`).
+
+    Parameters
+    ----------
+    trans_func: `numpy.ndarray`
+        Half-plane OTF of the source PSF, i.e.
+        ``psf2otf(psf_source, shape, real=True)``
+    target_fourier: `numpy.ndarray`
+        Half-plane unitary transform of the target PSF, i.e.
+        ``urdft2(psf_target)``
+    shape: tuple of int
+        Shape of the PSF images in image space
+    reg_facts: sequence of float, optional
+        Increasing regularisation parameters to choose from, evenly
+        spaced in log (default `REG_GRID`)
+    method: str, optional
+        Criterion among `REG_METHODS`: 'gcv' (default) or 'lcurve'
+
+    Returns
+    -------
+    reg_fact: float
+        Selected regularisation parameter
+    curve: `collections.OrderedDict`
+        Curve of `reg_curve`, with the L-curve ``curvature`` in addition
+
+    Warns
+    -----
+    UserWarning
+        If the selection failed (see `reg_selection_issue`), e.g. for
+        noise-free PSFs, which favour the smallest parameter
+
+    """
+    if method not in REG_METHODS:
+        raise ValueError("Unknown selection method '{0}', choose among "
+                         "{1}".format(method, REG_METHODS))
+
+    curve = reg_curve(trans_func, target_fourier, shape, reg_facts)
+
+    # Signed curvature of (log residual, log seminorm) along log R,
+    # positive at the corner
+    tiny = np.finfo(float).tiny
+    log_reg = np.log(curve['reg_fact'])
+    rho = np.log(curve['residual'] + tiny)
+    eta = np.log(curve['seminorm'] + tiny)
+    drho, deta = np.gradient(rho, log_reg), np.gradient(eta, log_reg)
+    ddrho, ddeta = np.gradient(drho, log_reg), np.gradient(deta, log_reg)
+    curve['curvature'] = ((drho * ddeta - deta * ddrho) /
+                          ((drho**2 + deta**2)**1.5 + tiny))
+
+    if method == 'gcv':
+        best = np.argmin(curve['gcv'])
+    else:
+        best = np.argmax(curve['curvature'])
+    reg_fact = float(curve['reg_fact'][best])
+
+    issue = reg_selection_issue(curve, reg_fact, method)
+    if issue is not None:
+        warnings.warn("Selection of the regularisation parameter by {0} "
+                      "failed: {1}".format(method, issue))
+
+    return reg_fact, curve
+
+
+def reg_selection_issue(curve, reg_fact, method='gcv'):
+    """
+    Tell why a regularisation parameter selected on a curve is unreliable
+
+    A parameter at either end of the grid is not an extremum of the
+    criterion, and an L-curve without positive curvature has no corner.
+
+    Parameters
+    ----------
+    curve: `collections.OrderedDict`
+        Curve returned by `select_reg_fact`
+    reg_fact: float
+        Selected regularisation parameter
+    method: str, optional
+        Criterion of the selection among `REG_METHODS` (default 'gcv')
+
+    Returns
+    -------
+    issue: str or None
+        Description of the issue, `None` if the selection is reliable
+
+    """
+    reg_facts = curve['reg_fact']
+    if method == 'lcurve' and not np.max(curve['curvature']) > 0:
+        return "the L-curve has no corner (no positive curvature)"
+    if reg_fact in (reg_facts[0], reg_facts[-1]):
+        return ("{0:.2e} is at an end of the grid [{1:.2e}, {2:.2e}]"
+                .format(reg_fact, reg_facts[0], reg_facts[-1]))
+    return None
+
+
+class KernelWorkspace(object):
+    """
+    Preallocated buffers for repeated homogenization kernel computations
+
+    Passing a workspace to `homogenization_kernel` makes the whole
+    computation run inside these buffers, so that repeated calls on
+    PSFs of the same shape and dtype only allocate the output kernel.
+    The transforms write straight into the buffers with the numpy FFT
+    backend (numpy >= 2.0); other backends allocate their result before
+    it is copied into the buffers.
+
+    Parameters
+    ----------
+    shape: tuple of int
+        Shape of the PSF arrays (2D image or 3D cube)
+    dtype: `numpy.dtype`, optional
+        Real data type of the PSFs (default float)
+
+    Example
+    -------
+    >>> workspace = KernelWorkspace(psf_target.shape)
+    >>> for psf_source in psf_sources:
+    ...     kernel, _ = homogenization_kernel(psf_target, psf_source,
+    ...                                       workspace=workspace)
+
+    """
+    def __init__(self, shape, dtype=float):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        cdtype = np.result_type(self.dtype, np.complex64)
+        half = self.shape[:-1] + (self.shape[-1] // 2 + 1,)
+
+        self.padded = np.empty(self.shape, dtype=self.dtype)
+        self.otf = np.empty(half, dtype=cdtype)
+        self.target = np.empty(half, dtype=cdtype)
+        self.work = np.empty(half, dtype=cdtype)
+        self.denom = np.empty(half, dtype=self.dtype)
+        self.reg = np.empty(half[-2:], dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        """Total size of the buffers in bytes"""
+        return sum(buf.nbytes for buf in [self.padded, self.otf,
+                                          self.target, self.work,
+                                          self.denom, self.reg])
+
+    def homogenization_kernel(self, psf_target, psf_source, reg_fact=1e-4):
+        """
+        Compute the homogenization kernel within the workspace buffers
+
+        See `homogenization_kernel` for the parameters. Only a single
+        regularisation parameter is supported, and both PSFs must have
+        the shape and dtype of the workspace.
+
+        Returns
+        -------
+        kernel_image: `numpy.ndarray`
+            Deconvolved image, newly allocated
+        kernel_fourier: `numpy.ndarray`
+            Half-plane transform of the deconvolved image. This is a
+            workspace buffer, overwritten by the next call.
+
+        """
+        for psf in [psf_target, psf_source]:
+            if psf.shape != self.shape or psf.dtype != self.dtype:
+                raise ValueError("PSF of shape {0} and dtype {1} does not "
+                                 "match the workspace".format(psf.shape,
+                                                              psf.dtype))
+        if np.ndim(reg_fact):
+            raise ValueError("A workspace only supports a single "
+                             "regularisation parameter")
+
+        shape = self.shape[-2:]
+        otf = self.otf
+        denom = self.denom
+
+        # Source OTF and target transform
+        fftutils.rfft2(shift_pad(psf_source, self.padded), out=otf)
+        urdft2(psf_target, out=self.target)
+
+        # Wiener denominator |H|^2 + R |L|^2
+        np.abs(otf, out=denom)
+        np.square(denom, out=denom)
+        reg_otf2 = reg_cache.get(shape, self.dtype, real=True)
+        np.multiply(reg_otf2, reg_fact, out=self.reg)
+        denom += self.reg
+
+        # Kernel transform conj(H) T / denominator, computed in place
+        np.conjugate(otf, out=otf)
+        otf *= self.target
+        otf /= denom
+
+        # The inverse transform runs on a copy to keep the kernel transform
+        np.copyto(self.work, otf)
+        kernel_image = uirdft2(self.work, shape,
+                               out=np.empty(self.shape, dtype=self.dtype),
+                               overwrite_x=True)
+
+        return kernel_image, otf
+
+
+###########
+# PIPELINE
+###########
+
+
+def load_psf(fits_file, dtype=None):
+    """
+    Load a PSF image and its pixel scale from a FITS file
+
+    NaNs in the image are set to 0. The file can also hold a cube of
+    PSFs (positions x height x width). The file is memory-mapped and
+    read chunk-wise to keep the peak memory close to the image size.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the FITS PSF image
+    dtype: `numpy.dtype`, optional
+        Data type of the returned image (default: as stored in the file)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        PSF image
+    pixel_scale: float
+        Pixel scale of the image in arcseconds
+
+    """
+    psf = fits.read_image(fits_file, dtype=dtype)
+    pixel_scale = fits.get_pixscale(fits_file)
+
+    return psf, pixel_scale
+
+
+def normalize(psf, inplace=False):
+    """
+    Normalize a PSF image, or every image of a PSF cube, to unit sum
+
+    Parameters
+    ----------
+    psf: `numpy.ndarray`
+        PSF image or cube
+    inplace: bool, optional
+        If `True`, normalize a floating point ``psf`` in place instead
+        of returning a normalized copy (default `False`)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        Normalized PSF
+
+    """
+    total = psf.sum(axis=(-2, -1), keepdims=True)
+
+    if inplace and psf.dtype.kind == 'f':
+        psf /= total
+        return psf
+
+    return psf / total
+
+
+def prepare_target(psf, angle=0.0, copy=True):
+    """
+    Rotate and normalize the target PSF
+
+    Parameters
+    ----------
+    psf: `numpy.ndarray`
+        Target PSF image or cube
+    angle: float, optional
+        Rotation angle in degrees (default 0)
+    copy: bool, optional
+        If `False`, ``psf`` may be normalized in place instead of being
+        left untouched (default `True`)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        Normalized target PSF
+
+    """
+    if angle != 0.0:
+        psf = imrotate(psf, angle)
+        copy = False
+
+    return normalize(psf, inplace=not copy)
+
+
+def prepare_source(psf, pixscale, target_pixscale, target_shape, angle=0.0,
+                   copy=True):
+    """
+    Rotate and resample the source PSF onto the target grid, and normalize it
+
+    Parameters
+    ----------
+    psf: `numpy.ndarray`
+        Source PSF image or cube
+    pixscale: float
+        Pixel scale of the source PSF in arcseconds
+    target_pixscale: float
+        Pixel scale of the target PSF in arcseconds
+    target_shape: tuple of int
+        Shape of the target PSF (only the last two axes are used)
+    angle: float, optional
+        Rotation angle in degrees (default 0)
+    copy: bool, optional
+        If `False`, ``psf`` may be normalized in place instead of being
+        left untouched (default `True`)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        Normalized source PSF with the shape and pixel scale of the target
+
+    Raises
+    ------
+    MemoryError
+        If the resampled image would be too large
+
+    """
+    resampled = resample_source(psf, pixscale, target_pixscale, target_shape,
+                                angle)
+
+    # The interpolation does not preserve the sum, hence the normalization
+    # of the warped PSF
+    return normalize(resampled, inplace=resampled is not psf or not copy)
+
+
+def resample_source(psf, pixscale, target_pixscale, target_shape, angle=0.0):
+    """
+    Rotate and resample the source PSF onto the target grid
+
+    This is `prepare_source` without the normalization. The rotation,
+    resampling and centering onto the target grid are done in a single
+    interpolation (`imwarp`), or by `trim`/`zero_pad` alone if neither
+    a rotation nor a resampling is needed.
+
+    Parameters
+    ----------
+    psf: `numpy.ndarray`
+        Source PSF image or cube
+    pixscale: float
+        Pixel scale of the source PSF in arcseconds
+    target_pixscale: float
+        Pixel scale of the target PSF in arcseconds
+    target_shape: tuple of int
+        Shape of the target PSF (only the last two axes are used)
+    angle: float, optional
+        Rotation angle in degrees (default 0)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        Source PSF with the shape and pixel scale of the target
+
+    Raises
+    ------
+    MemoryError
+        If the resampled image would be too large
+
+    """
+    target_shape = tuple(target_shape)[-2:]
+    if angle != 0.0 or pixscale != target_pixscale:
+        return imwarp(psf, angle, pixscale, target_pixscale, target_shape)
+
+    if psf.shape[-2:] > target_shape:
+        psf = trim(psf, target_shape)
+    else:
+        psf = zero_pad(psf, target_shape, position='center')
+
+    return psf
+
+
+def prepare_source_otf(psf, pixscale, target_pixscale, target_shape,
+                       angle=0.0, copy=True):
+    """
+    Rotate and normalize the source PSF and compute its OTF on the target grid
+
+    This is the Fourier resampling counterpart of `prepare_source`
+    followed by `psf2otf`: the source PSF is resampled by evaluating
+    its spectrum on the target frequency grid (see `psf2otf_resampled`).
+
+    Parameters
+    ----------
+    psf: `numpy.ndarray`
+        Source PSF image or cube
+    pixscale: float
+        Pixel scale of the source PSF in arcseconds
+    target_pixscale: float
+        Pixel scale of the target PSF in arcseconds
+    target_shape: tuple of int
+        Shape of the target PSF (only the last two axes are used)
+    angle: float, optional
+        Rotation angle in degrees (default 0)
+    copy: bool, optional
+        If `False`, ``psf`` may be normalized in place instead of being
+        left untouched (default `True`)
+
+    Returns
+    -------
+    trans_func: `numpy.ndarray`
+        Half-plane OTF of the source PSF on the target grid
+
+    """
+    if angle != 0.0:
+        psf = imrotate(psf, angle)
+        copy = False
+
+    psf = normalize(psf, inplace=not copy)
+
+    return psf2otf_resampled(psf, pixscale, target_pixscale, target_shape)
+
+
+def compute_kernel(psf_source, psf_target, pixscale_source, pixscale_target,
+                   angle_source=0.0, angle_target=0.0, reg_fact=1e-4,
+                   dtype=None, resample='spline', cache=None):
+    """
+    Compute the homogenization kernel between two loaded PSFs
+
+    This chains `prepare_target`, `prepare_source` and
+    `homogenization_kernel`, as done by the `pypher` command.
+    With a ``cache``, a kernel already computed from the same inputs is
+    returned without any computation.
+
+    Parameters
+    ----------
+    psf_source: `numpy.ndarray`
+        Source PSF image or cube, left untouched
+    psf_target: `numpy.ndarray`
+        Target PSF image or cube, left untouched
+    pixscale_source: float
+        Pixel scale of the source PSF in arcseconds
+    pixscale_target: float
+        Pixel scale of the target PSF in arcseconds
+    angle_source: float, optional
+        Rotation angle to apply to the source PSF in degrees
+    angle_target: float, optional
+        Rotation angle to apply to the target PSF in degrees
+    reg_fact: float or sequence of float, optional
+        Regularisation parameter(s) for the Wiener filter
+    dtype: `numpy.dtype`, optional
+        Real floating point type of the whole computation
+    resample: str, optional
+        Resampling of the source PSF among `RESAMPLINGS`: 'spline'
+        (`prepare_source`, default) or 'fourier' (`prepare_source_otf`)
+    cache: `KernelCache`, optional
+        On-disk cache the kernel is looked up in and stored to
+
+    Returns
+    -------
+    kernel: `numpy.ndarray`
+        Homogenization kernel (image or cube)
+
+    """
+    if dtype is not None:
+        psf_source = np.asarray(psf_source, dtype=dtype)
+        psf_target = np.asarray(psf_target, dtype=dtype)
+
+    if cache is not None:
+        key = kernel_key(psf_source, psf_target, pixscale_source,
+                         pixscale_target, angle_source, angle_target,
+                         reg_fact, resample)
+        kernel = cache.get(key)
+        if kernel is None:
+            kernel = compute_kernel(psf_source, psf_target,
+                                    pixscale_source, pixscale_target,
+                                    angle_source, angle_target, reg_fact,
+                                    dtype, resample)
+            cache.put(key, kernel)
+        return kernel
+
+    psf_target = prepare_target(psf_target, angle_target)
+
+    if resample == 'fourier':
+        trans_func = prepare_source_otf(psf_source, pixscale_source,
+                                        pixscale_target, psf_target.shape,
+                                        angle_source)
+        kernel, _ = kernel_from_otf(trans_func, urdft2(psf_target),
+                                    psf_target.shape, reg_fact=reg_fact)
+        if dtype is not None:
+            kernel = kernel.astype(dtype, copy=False)
+        return kernel
+
+    psf_source = prepare_source(psf_source, pixscale_source, pixscale_target,
+                                psf_target.shape, angle_source)
+
+    kernel, _ = homogenization_kernel(psf_target, psf_source,
+                                      reg_fact=reg_fact, dtype=dtype)
+
+    return kernel
+
+
+###############
+# KERNEL CACHE
+###############
+
+
+def _array_digest(sha, array):
+    """Feed the dtype, shape and pixels of an array to a hash object"""
+    array = np.asarray(array)
+    array = np.ascontiguousarray(array,
+                                 dtype=array.dtype.newbyteorder('<'))
+    sha.update('{0}{1}'.format(array.dtype.str, array.shape).encode())
+    sha.update(array.view(np.uint8).reshape(-1))
+
+
+def kernel_key(psf_source, psf_target, pixscale_source, pixscale_target,
+               angle_source=0.0, angle_target=0.0, reg_fact=1e-4,
+               resample='spline'):
+    """
+    Content hash of the inputs of a homogenization kernel
+
+    The key covers the pixels (and dtype) of both PSFs, the arguments
+    of `compute_kernel` and the version of pypher, so that a kernel is
+    only reused for bit-identical inputs.
+
+    Parameters
+    ----------
+    psf_source: `numpy.ndarray`
+        Source PSF image or cube, as loaded
+    psf_target: `numpy.ndarray`
+        Target PSF image or cube, as loaded
+    pixscale_source, pixscale_target: float
+        Pixel scales of the PSFs in arcseconds
+    angle_source, angle_target: float, optional
+        Rotation angles of the PSFs in degrees
+    reg_fact: float or sequence of float, optional
+        Regularisation parameter(s) for the Wiener filter
+    resample: str, optional
+        Resampling of the source PSF among `RESAMPLINGS`
+
+    Returns
+    -------
+    key: str
+        SHA-256 hexadecimal digest
+
+    """
+    sha = hashlib.sha256()
+    _array_digest(sha, psf_source)
+    _array_digest(sha, psf_target)
+    params = [__version__, float(pixscale_source), float(pixscale_target),
+              float(angle_source), float(angle_target),
+              np.atleast_1d(reg_fact).astype(float).tolist(),
+              np.ndim(reg_fact), resample]
+    sha.update(json.dumps(params).encode())
+    return sha.hexdigest()
+
+
+def remove_stale_tmp(directory, max_age=TMP_MAX_AGE):
+    """
+    Delete the temporary files left in a directory by interrupted writes
+
+    Only the files named after `TMP_PREFIX` and `TMP_SUFFIX` and older
+    than ``max_age`` are deleted, so that the writes in progress of
+    concurrent runs sharing the directory are left alone.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the atomically written files
+    max_age: float, optional
+        Minimum age of the deleted files in seconds (default
+        `TMP_MAX_AGE`)
+
+    Returns
+    -------
+    nfiles: int
+        Number of files deleted
+
+    """
+    pattern = os.path.join(directory, TMP_PREFIX + '*' + TMP_SUFFIX)
+    deadline = time.time() - max_age
+    nfiles = 0
+    for path in glob.glob(pattern):
+        try:
+            if os.stat(path).st_mtime <= deadline:
+                os.remove(path)
+                nfiles += 1
+        except OSError:
+            # Renamed or deleted meanwhile by a concurrent run
+            continue
+    return nfiles
+
+
+class KernelCache(object):
+    """
+    Size-bounded on-disk cache of homogenization kernels
+
+    The kernels are stored as ``<key>.npy`` files named after their
+    `kernel_key`. Files are written to a temporary name and atomically
+    renamed, so concurrent runs sharing the directory never read a
+    partial kernel. The temporary files left by interrupted runs are
+    deleted when the cache is opened (see `remove_stale_tmp`). Reading a
+    kernel refreshes its modification time, and the least recently used
+    kernels are deleted once the directory exceeds ``max_size`` bytes.
+
+    Parameters
+    ----------
+    directory: str
+        Cache directory, created if needed
+    max_size: int, optional
+        Maximum total size of the cached kernels in bytes (default 1 GiB)
+
+    Example
+    -------
+    >>> cache = KernelCache('~/.cache/pypher')
+    >>> kernel = compute_kernel(psf_a, psf_b, 0.1, 0.2, cache=cache)
+    >>> cache.info()
+    {'hits': 0, 'misses': 1, 'size': 1, 'nbytes': 80128, ...}
+
+    """
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created meanwhile by a concurrent run
+                if not os.path.isdir(self.directory):
+                    raise
+        remove_stale_tmp(self.directory)
+
+    def path(self, key):
+        """Return the file name of a cached kernel"""
+        return os.path.join(self.directory, key + '.npy')
+
+    def _entries(self):
+        """List the cached files as (mtime, size, path) tuples"""
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        """
+        Return a cached kernel
+
+        Parameters
+        ----------
+        key: str
+            Key of the kernel (see `kernel_key`)
+
+        Returns
+        -------
+        kernel: `numpy.ndarray` or `None`
+            Cached kernel, or `None` if it is not in the cache
+
+        """
+        path = self.path(key)
+        try:
+            kernel = np.load(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return kernel
+
+    def put(self, key, kernel):
+        """
+        Store a kernel in the cache and evict the oldest ones if needed
+
+        Parameters
+        ----------
+        key: str
+            Key of the kernel (see `kernel_key`)
+        kernel: `numpy.ndarray`
+            Kernel to store
+
+        """
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix=TMP_PREFIX,
+                                            suffix=TMP_SUFFIX)
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                np.save(tmp_file, np.asarray(kernel))
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used kernels beyond ``max_size``"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by a concurrent run
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete all the cached kernels and reset the statistics"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Return the cache statistics as a dictionary"""
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(entries),
+                'nbytes': sum(size for _, size, _ in entries),
+                'max_size': self.max_size}
+
+
+###########
+# PLANNING
+###########
+
+
+def _fft_flops(npix, nplanes=1):
+    """Operation count of real 2D FFTs of ``npix`` pixels"""
+    return 2.5 * nplanes * npix * np.log2(max(npix, 2))
+
+
+def _stage_costs(source_shape, target_shape, pixscale_source,
+                 pixscale_target, angle_source, angle_target, n_reg,
+                 itemsize, resample):
+    """
+    Predicted peak memory and operation count of each pipeline stage
+
+    The memory is the total size of the arrays alive at the peak of the
+    stage, the internal buffers of the FFT libraries being neglected.
+
+    """
+    src_lead = int(np.prod(source_shape[:-2]))
+    tgt_lead = int(np.prod(target_shape[:-2]))
+    nsrc = source_shape[-2] * source_shape[-1]
+    nt_y, nt_x = target_shape[-2:]
+    npix = nt_y * nt_x
+    half = nt_y * (nt_x // 2 + 1)
+    nplanes = max(src_lead, tgt_lead)
+    nkernels = nplanes * n_reg
+    real, cplx = itemsize, 2 * itemsize
+
+    source = src_lead * nsrc * real
+    target = tgt_lead * npix * real
+    warped = src_lead * npix * real
+    source_otf = src_lead * half * cplx
+    target_ft = tgt_lead * half * cplx
+
+    stages = []
+    stages.append(('load', source + target + min(source, fits.CHUNK_SIZE),
+                   0.))
+
+    # The source is only rotated on its own grid when resampled in
+    # Fourier space, `imwarp` rotating it otherwise
+    tgt_rotated = angle_target != 0.0
+    src_rotated = resample == 'fourier' and angle_source != 0.0
+    rotated = target * tgt_rotated + source * src_rotated
+    stages.append(('rotation', source + target + rotated,
+                   10. * (tgt_lead * npix * tgt_rotated +
+                          src_lead * nsrc * src_rotated)))
+
+    if resample == 'fourier':
+        # Source padded or folded to the grid of its pixels spanning the
+        # target field, its spectrum, then the rows and columns of the
+        # spectrum on the target frequency grid (`psf2otf_resampled`)
+        ratio = pixscale_source / pixscale_target
+        ns_y, ns_x = source_shape[-2:]
+        ng_y, ng_x = [max(int(round(size / ratio)), 1)
+                      for size in (nt_y, nt_x)]
+        folded = src_lead * max(ns_y, ng_y) * max(ns_x, ng_x) * real
+        grid = src_lead * ng_y * ng_x * real
+        spectrum = src_lead * ng_y * (ng_x // 2 + 1) * cplx
+        rows = src_lead * nt_y * (ng_x // 2 + 1) * cplx
+        stages.append(('resampling',
+                       source + target + rotated +
+                       max(folded + grid, grid + spectrum,
+                           spectrum + rows + source_otf),
+                       src_lead * nsrc + _fft_flops(ng_y * ng_x, src_lead) +
+                       12. * src_lead * half))
+        stages.append(('padding', 0, 0.))
+        stages.append(('otf', source + target + source_otf + target_ft,
+                       _fft_flops(npix, tgt_lead)))
+        warped = source
+    else:
+        # `imwarp` (or `trim`/`zero_pad`) writes the source directly onto
+        # the target grid, so there is no separate padding step
+        stages.append(('resampling', source + target + warped,
+                       10. * src_lead * npix))
+        stages.append(('padding', 0, 0.))
+        stages.append(('otf', target + warped + source_otf + target_ft,
+                       _fft_flops(npix, src_lead + tgt_lead)))
+
+    # |OTF|^2 and denominator, filter, kernel transform and kernel image
+    wiener = (warped + target + source_otf + target_ft +
+              2 * src_lead * half * real + src_lead * n_reg * half * cplx +
+              nkernels * half * cplx + nkernels * npix * real)
+    stages.append(('wiener', wiener,
+                   _fft_flops(npix, nkernels) + 20. * nkernels * half))
+
+    return stages
+
+
+def plan_kernel(psf_source, psf_target, angle_source=0.0, angle_target=0.0,
+                reg_fact=1e-4, precision='double', resample='spline',
+                threads=1, max_memory=None):
+    """
+    Predict the memory and runtime of a kernel computation
+
+    Only the headers of the FITS files are read. The peak memory and
+    the number of floating point operations of every stage of `main`
+    (loading, rotation, resampling, padding, OTF and Wiener filtering)
+    are derived from the image shapes, the pixel scales and the
+    options. The runtimes assume `FLOP_RATE` operations per second and
+    per thread.
+
+    Settings fitting a memory budget are also recommended, by switching
+    to single precision and/or to the Fourier resampling if needed.
+
+    Parameters
+    ----------
+    psf_source: str
+        Path to the source PSF FITS file
+    psf_target: str
+        Path to the target PSF FITS file
+    angle_source: float, optional
+        Rotation angle to apply to the source PSF in degrees
+    angle_target: float, optional
+        Rotation angle to apply to the target PSF in degrees
+    reg_fact: float or sequence of float, optional
+        Regularisation parameter(s) for the Wiener filter
+    precision: str, optional
+        Precision among `PRECISIONS` (default 'double')
+    resample: str, optional
+        Resampling among `RESAMPLINGS` (default 'spline')
+    threads: int, optional
+        Number of FFT threads (-1 for all CPUs)
+    max_memory: int, optional
+        Memory budget in bytes
+
+    Returns
+    -------
+    plan: `collections.OrderedDict`
+        Shapes, per stage ``memory`` (bytes), ``flops`` and ``time`` (s),
+        overall ``peak_memory`` and ``time``, and ``recommended`` settings
+        (`None` if no setting fits ``max_memory``)
+
+    """
+    source_shape = fits.image_shape(psf_source)
+    target_shape = fits.image_shape(psf_target)
+    pixscale_source = fits.get_pixscale(psf_source)
+    pixscale_target = fits.get_pixscale(psf_target)
+    n_reg = np.size(reg_fact)
+    cpus = multiprocessing.cpu_count()
+    threads = cpus if threads < 0 else max(threads, 1)
+
+    new_size = resampled_size(source_shape[-2], pixscale_source,
+                              pixscale_target, max_size=None)
+
+    def predict(precision, resample):
+        stages = _stage_costs(source_shape, target_shape, pixscale_source,
+                              pixscale_target, angle_source, angle_target,
+                              n_reg, PRECISIONS[precision]().itemsize,
+                              resample)
+        return stages, max(memory for _, memory, _ in stages)
+
+    stages, peak = predict(precision, resample)
+
+    if len(source_shape) > len(target_shape):
+        lead_shape = source_shape[:-2]
+    else:
+        lead_shape = target_shape[:-2]
+
+    plan = OrderedDict()
+    plan['source_shape'] = list(source_shape)
+    plan['target_shape'] = list(target_shape)
+    plan['resampled_size'] = new_size
+    plan['kernel_shape'] = ([n_reg] if n_reg > 1 else []) + \
+        list(lead_shape) + list(target_shape[-2:])
+    plan['precision'] = precision
+    plan['resample'] = resample
+    plan['threads'] = threads
+    plan['stages'] = OrderedDict(
+        (name, OrderedDict([('memory', int(memory)), ('flops', flops),
+                            ('time', flops / (FLOP_RATE * threads))]))
+        for name, memory, flops in stages)
+    plan['peak_memory'] = int(peak)
+    plan['time'] = sum(stage['time'] for stage in plan['stages'].values())
+
+    # Cheapest change of settings fitting the budget
+    candidates = [(precision, resample), ('single', resample),
+                  (precision, 'fourier'), ('single', 'fourier')]
+    recommended = None
+    for prec, method in candidates:
+        if method == 'spline' and new_size > 10000:
+            continue
+        _, needed = predict(prec, method)
+        if max_memory is None or needed <= max_memory:
+            recommended = OrderedDict([('precision', prec),
+                                       ('resample', method),
+                                       ('threads', cpus),
+                                       ('peak_memory', int(needed))])
+            break
+    plan['max_memory'] = max_memory
+    plan['recommended'] = recommended
+
+    return plan
+
+
+########
 # DEBUG
 ########
 
@@ -460,87 +2365,256 @@ def setup_logger(log_filename='pypher.log'):  # pragma: no cover
 
 def main():  # pragma: no cover
     """Main script for pypher"""
+    if sys.argv[1:2] == ['serve']:
+        from .serve import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+
     try:
         args = parse_args()
     except ArgumentParserError:
         print(__doc__)
         sys.exit()
 
+    if args.plan:
+        plan = plan_kernel(args.psf_source, args.psf_target,
+                           args.angle_source, args.angle_target,
+                           args.reg_fact, args.precision, args.resample,
+                           args.threads, args.max_memory)
+        print(json.dumps(plan, indent=2))
+        sys.exit(0 if plan['recommended'] is not None else 1)
+
     kernel_basename, _ = os.path.splitext(args.output)
-    kernel_fits = kernel_basename + '.fits'
 
     logname = '%s.log' % kernel_basename
     if os.path.exists(logname):
         os.remove(logname)
     log = setup_logger(logname)
 
-    # Load images (NaNs are set to 0)
-    psf_source = fits.getdata(args.psf_source)
-    psf_target = fits.getdata(args.psf_target)
+    metrics = StageMetrics(trace_memory=args.metrics is not None, log=log)
+    for name in ['psf_source', 'psf_target', 'output', 'angle_source',
+                 'angle_target', 'reg_fact', 'reg_method', 'precision',
+                 'resample', 'fft_backend', 'threads']:
+        metrics.info[name] = getattr(args, name)
+    metrics.info['version'] = __version__
 
-    log.info('Source PSF loaded: %s', args.psf_source)
-    log.info('Target PSF loaded: %s', args.psf_target)
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    # Set NaNs to 0.0
-    psf_source = np.nan_to_num(psf_source)
-    psf_target = np.nan_to_num(psf_target)
+    try:
+        kernel_fits = run(args, log, metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            log.info('Profile statistics saved in %s', args.profile)
+        if args.metrics is not None:
+            metrics.write(args.metrics)
+            log.info('Metrics saved in %s', args.metrics)
+        metrics.close()
 
-    # Retrieve the pixel scale of each image
-    pixscale_source = fits.get_pixscale(args.psf_source)
-    pixscale_target = fits.get_pixscale(args.psf_target)
+    print("pypher: Output kernel saved to %s" % kernel_fits)
 
-    log.info('Source PSF pixel scale: %.2f arcsec', pixscale_source)
-    log.info('Target PSF pixel scale: %.2f arcsec', pixscale_target)
 
-    # Rotate images (if necessary)
-    if args.angle_source != 0.0:
-        psf_source = imrotate(psf_source, args.angle_source)
-    if args.angle_target != 0.0:
-        psf_target = imrotate(psf_target, args.angle_target)
+def run(args, log, metrics):  # pragma: no cover
+    """
+    Compute and write the kernel requested on the command line
 
-    log.info('Source PSF rotated by %.2f degrees', args.angle_source)
-    log.info('Target PSF rotated by %.2f degrees', args.angle_target)
+    Every stage of the computation is timed by ``metrics``.
 
-    # Normalize the PSFs
-    psf_source /= psf_source.sum()
-    psf_target /= psf_target.sum()
+    Parameters
+    ----------
+    args: `argparse.Namespace`
+        Container for the parsed values
+    log: `logging.Logger`
+        Logger of the run
+    metrics: `pypher.metrics.StageMetrics`
+        Metrics of the run
 
-    # Resample high resolution image to the low one
-    if pixscale_source != pixscale_target:
-        try:
-            psf_source = imresample(psf_source,
-                                    pixscale_source,
-                                    pixscale_target)
-        except MemoryError:
-            log.error('- COMPUTATION ABORTED -')
-            log.error('The size of the resampled PSF would have '
-                      'exceeded 10K x 10K')
-            log.error('Please resize your image and try again')
-
-            print('Issue during the resampling step - see pypher.log')
-            sys.exit()
-
-        log.info('Source PSF resampled to the target pixel scale')
-
-    # check the new size of the source vs. the target
-    if psf_source.shape > psf_target.shape:
-        psf_source = trim(psf_source, psf_target.shape)
-    else:
-        psf_source = zero_pad(psf_source, psf_target.shape, position='center')
+    Returns
+    -------
+    kernel_fits: str
+        Name of the kernel FITS file
 
-    kernel, _ = homogenization_kernel(psf_target, psf_source,
-                                      reg_fact=args.reg_fact)
+    """
+    kernel_basename, _ = os.path.splitext(args.output)
+    kernel_fits = kernel_basename + '.fits'
+
+    fftutils.set_backend(args.fft_backend, workers=args.threads)
+    log.info('FFT backend: %s (%d threads)', *fftutils.get_backend())
 
-    log.info('Kernel computed using Wiener filtering and a regularisation '
-             'parameter r = %.2e', args.reg_fact)
+    dtype = PRECISIONS[args.precision]
+    log.info('Computation in %s precision', args.precision)
+
+    # Load images (NaNs are set to 0)
+    with metrics.stage('load'):
+        psf_source = fits.read_image(args.psf_source, dtype=dtype)
+        psf_target = fits.read_image(args.psf_target, dtype=dtype)
+        metrics.describe(psf_source=psf_source, psf_target=psf_target)
+
+    log.info('Source PSF loaded: %s', args.psf_source)
+    log.info('Target PSF loaded: %s', args.psf_target)
+
+    with metrics.stage('pixscale'):
+        pixscale_source = fits.get_pixscale(args.psf_source)
+        pixscale_target = fits.get_pixscale(args.psf_target)
+
+    log.info('Source PSF pixel scale: %.2f arcsec', pixscale_source)
+    log.info('Target PSF pixel scale: %.2f arcsec', pixscale_target)
+
+    if len(args.reg_fact) == 1:
+        reg_fact = args.reg_fact[0]
+    else:
+        reg_fact = args.reg_fact
+
+    kernel = None
+    cache = None
+    if reg_fact == 'auto' and args.cache_dir and not args.no_cache:
+        log.info('Kernel cache not used with an automatic regularisation')
+    elif args.cache_dir and not args.no_cache:
+        with metrics.stage('cache'):
+            cache = KernelCache(args.cache_dir, args.cache_size)
+            key = kernel_key(psf_source, psf_target, pixscale_source,
+                             pixscale_target, args.angle_source,
+                             args.angle_target, reg_fact, args.resample)
+            kernel = cache.get(key)
+        if kernel is not None:
+            log.info('Kernel read from the cache: %s', cache.path(key))
+
+    if kernel is None:
+        # Rotate (if necessary) and normalize the target, and the source
+        # if it is resampled in Fourier space
+        with metrics.stage('rotate'):
+            if args.angle_target != 0.0:
+                psf_target = imrotate(psf_target, args.angle_target)
+            if args.resample == 'fourier' and args.angle_source != 0.0:
+                psf_source = imrotate(psf_source, args.angle_source)
+
+        log.info('Target PSF rotated by %.2f degrees', args.angle_target)
+
+        with metrics.stage('normalize'):
+            psf_target = normalize(psf_target, inplace=True)
+            if args.resample == 'fourier':
+                psf_source = normalize(psf_source, inplace=True)
+
+        if args.resample == 'fourier':
+            # Compute the OTF of the source directly on the target
+            # frequency grid
+            with metrics.stage('otf'):
+                trans_func = psf2otf_resampled(psf_source, pixscale_source,
+                                               pixscale_target,
+                                               psf_target.shape)
+                metrics.describe(trans_func=trans_func)
+
+            log.info('Source PSF rotated by %.2f degrees', args.angle_source)
+            log.info('Source PSF resampled to the target pixel scale '
+                     'in Fourier space')
+        else:
+            # Rotate and resample the source to the target grid
+            try:
+                with metrics.stage('warp'):
+                    psf_source = resample_source(psf_source,
+                                                 pixscale_source,
+                                                 pixscale_target,
+                                                 psf_target.shape,
+                                                 args.angle_source)
+                    psf_source = normalize(psf_source, inplace=True)
+            except MemoryError:
+                log.error('- COMPUTATION ABORTED -')
+                log.error('The size of the resampled PSF would have '
+                          'exceeded 10K x 10K')
+                log.error('Please resize your image or use --resample fourier')
+
+                print('Issue during the resampling step - see pypher.log')
+                sys.exit()
+
+            log.info('Source PSF rotated by %.2f degrees', args.angle_source)
+            log.info('Source PSF resampled to the target pixel scale')
+
+            with metrics.stage('otf'):
+                trans_func = psf2otf(psf_source, psf_source.shape, real=True)
+                metrics.describe(trans_func=trans_func)
+
+        with metrics.stage('otf_target'):
+            target_fourier = urdft2(psf_target)
+            metrics.describe(target_fourier=target_fourier)
+
+        if reg_fact == 'auto':
+            with metrics.stage('regularisation'):
+                reg_fact, curve = select_reg_fact(trans_func, target_fourier,
+                                                  psf_target.shape,
+                                                  method=args.reg_method)
+            args.reg_fact = [reg_fact]
+            issue = reg_selection_issue(curve, reg_fact, args.reg_method)
+            metrics.info['reg_fact'] = args.reg_fact
+            metrics.info['reg_curve_size'] = len(curve['reg_fact'])
+            metrics.info['reg_issue'] = issue
+            log.info('Regularisation parameter selected by %s over '
+                     '%d values', args.reg_method, len(curve['reg_fact']))
+            if issue is not None:
+                log.warning('The selection of the regularisation parameter '
+                            'failed: %s', issue)
+            for values in zip(*curve.values()):
+                log.info('R = %.2e: residual %.3e, seminorm %.3e, '
+                         'GCV %.3e, curvature %.3e', *values)
+
+        with metrics.stage('wiener'):
+            kernel, _ = kernel_from_otf(trans_func, target_fourier,
+                                        psf_target.shape, reg_fact=reg_fact)
+            kernel = kernel.astype(dtype, copy=False)
+        del trans_func, target_fourier
+
+        for reg in args.reg_fact:
+            log.info('Kernel computed using Wiener filtering and a '
+                     'regularisation parameter r = %.2e', reg)
+
+        # Opt-in, as it doubles the work and the memory of the run
+        if dtype != np.float64 and args.check_precision:
+            del psf_source, psf_target
+            with metrics.stage('precision_check'):
+                psf_source, _ = load_psf(args.psf_source, np.float64)
+                psf_target, _ = load_psf(args.psf_target, np.float64)
+                kernel_ref = compute_kernel(psf_source, psf_target,
+                                            pixscale_source, pixscale_target,
+                                            args.angle_source,
+                                            args.angle_target, reg_fact,
+                                            resample=args.resample)
+                deviation = np.abs(kernel - kernel_ref).max()
+            log.info('Deviation from the double precision kernel: '
+                     '%.2e (%.2e of the kernel peak)',
+                     deviation, deviation / np.abs(kernel_ref).max())
+            del kernel_ref, psf_source, psf_target
+
+        if cache is not None:
+            with metrics.stage('cache'):
+                cache.put(key, kernel)
+            log.info('Kernel stored in the cache: %s', cache.path(key))
+
+    crop_cards = []
+    if args.crop_energy is not None or args.crop_tol is not None:
+        with metrics.stage('crop'):
+            kernel, flux_lost = crop_kernel(kernel, args.crop_energy,
+                                            args.crop_tol)
+        crop_cards = [('CROPSIZE', kernel.shape[-1],
+                       'Size of the cropped kernel'),
+                      ('FLUXLOST', flux_lost,
+                       'Fraction of the kernel flux lost to cropping')]
+        log.info('Kernel cropped to %d x %d pixels (%.2e of the flux lost)',
+                 kernel.shape[-2], kernel.shape[-1], flux_lost)
+
+    with metrics.stage('header'):
+        header = kernel_header(args, pixscale_target, crop_cards)
 
     # Write kernel to FITS file
-    fits.writeto(kernel_fits, data=kernel)
-    format_kernel_header(kernel_fits, args, pixscale_target)
+    with metrics.stage('write'):
+        fits.writeto(kernel_fits, data=kernel, header=header)
+        metrics.describe(kernel=kernel)
 
     log.info('Kernel saved in %s', kernel_fits)
 
-    print("pypher: Output kernel saved to %s" % kernel_fits)
+    return kernel_fits
 
 
 if __name__ == '__main__':
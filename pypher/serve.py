@@ -0,0 +1,876 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher serve
+------------
+Long-lived local service computing homogenization kernels
+
+The service answers JSON requests over HTTP, on a Unix socket (by
+default ``pypher.sock`` in the current directory) or a localhost port.
+It keeps between requests everything a new `pypher` process would have
+to rebuild: the imported modules, the FFT plans, the regularization
+OTFs (`reg_cache`), the loaded PSFs (LRU cache of ``--psf-cache``
+files, reloaded when modified) and optionally the on-disk kernel cache.
+At most ``--jobs`` kernels are computed at once, and requests beyond
+``--max-queue`` waiting ones are rejected (503).
+
+The FITS files of the requests must lie in the ``--root`` directory
+(the current directory by default), and kernels are only written to
+files with ``--allow-output``. Over TCP, the service only listens on a
+loopback address unless ``--allow-remote`` is given, the requests must
+be sent to a local host name, and the POST requests as
+``application/json``, so that web pages cannot send requests to the
+service. Request bodies larger than ``--max-body`` are rejected (413).
+An existing ``--socket`` path is only replaced if it is a stale socket.
+
+Endpoints:
+  GET  /health   service status
+  GET  /metrics  request counters, timings and cache statistics
+  POST /kernel   compute a kernel, the JSON body holding
+                 psf_source, psf_target: FITS file name, or
+                     {"data": base64, "shape": [...], "dtype": "<f8",
+                      "pixscale": 0.1} (or "data" as nested lists)
+                 angle_source, angle_target, reg_fact, resample,
+                 precision: optional, as for pypher
+                 output: optional FITS file the kernel is written to
+                     (with --allow-output), otherwise the kernel is
+                     returned as base64 data
+                 overwrite: optional, replace an existing output file
+
+Usage:
+  pypher serve [--socket SOCKET] [--host HOST] [--port PORT]
+               [--allow-remote] [--root ROOT] [--allow-output]
+               [--max-body MAX_BODY] [-j JOBS]
+               [--max-queue MAX_QUEUE] [--psf-cache PSF_CACHE]
+               [--cache-dir CACHE_DIR] [--fft-backend BACKEND]
+               [--threads THREADS] [--log LOG]
+  pypher serve (-h | --help)
+
+Example:
+  pypher serve --socket /tmp/pypher.sock --allow-output -j 4 &
+  curl --unix-socket /tmp/pypher.sock http://localhost/kernel \\
+       -H 'Content-Type: application/json' \\
+       -d '{"psf_source": "psf_a.fits", "psf_target": "psf_b.fits",
+            "output": "kernel_a_to_b.fits", "reg_fact": 1e-5}'
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import json
+import stat
+import time
+import base64
+import signal
+import socket
+import argparse
+import threading
+import ipaddress
+
+from collections import OrderedDict
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+from . import fftutils
+from . import fitsutils as fits
+from .batch import KernelTask
+from .parser import ThrowingArgumentParser, ArgumentParserError
+from .pypher import (compute_kernel, kernel_header, load_psf, memory_size,
+                     reg_cache, setup_logger, KernelCache, CACHE_SIZE,
+                     PRECISIONS, RESAMPLINGS, __version__)
+
+# Default Unix socket and TCP port of the service
+SOCKET = 'pypher.sock'
+PORT = 8457
+
+# Host names accepted in the requests sent over TCP, besides the address
+# the service listens on
+LOCAL_HOSTS = frozenset(['localhost', '127.0.0.1', '::1'])
+
+# Default maximum size of a request body in bytes, enough for two
+# 4096 x 4096 double precision PSFs sent in base64
+MAX_BODY = 2**29
+
+# Default number of loaded PSFs kept in memory
+PSF_CACHE_SIZE = 32
+
+
+def parse_args(argv=None):
+    """Argument parser for the command line interface of `pypher serve`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher serve',
+        description="Serve homogenization kernels over local HTTP")
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument('--socket', type=str, default=SOCKET,
+                        help="Unix socket the service listens on")
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help="Loopback address the service listens on "
+                             "with --port")
+
+    parser.add_argument('--port', type=int, default=None,
+                        help="Listen on this TCP port instead of the Unix "
+                             "socket (e.g. {0})".format(PORT))
+
+    parser.add_argument('--allow-remote', action='store_true',
+                        help="Let --host be a non-loopback address, exposing "
+                             "the service to the network without "
+                             "authentication")
+
+    parser.add_argument('--root', type=str, default='.',
+                        help="Directory holding the FITS files of the "
+                             "requests")
+
+    parser.add_argument('--allow-output', action='store_true',
+                        help="Let the requests write the kernels to FITS "
+                             "files in the root directory")
+
+    parser.add_argument('--max-body', type=memory_size, default=MAX_BODY,
+                        help="Maximum size of a request body in bytes")
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Maximum number of kernels computed at once")
+
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help="Maximum number of requests waiting for a "
+                             "job, beyond which they are rejected")
+
+    parser.add_argument('--psf-cache', type=int, default=PSF_CACHE_SIZE,
+                        help="Number of loaded PSF files kept in memory")
+
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="Directory of the on-disk kernel cache")
+
+    parser.add_argument('--cache-size', type=memory_size,
+                        default=CACHE_SIZE,
+                        help="Maximum size of the kernel cache in bytes")
+
+    parser.add_argument('--fft-backend', type=str, default='scipy',
+                        choices=fftutils.BACKENDS,
+                        help="Library used to compute the FFTs")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used by the FFTs of each "
+                             "kernel (-1 for all CPUs)")
+
+    parser.add_argument('--log', type=str, default='pypher_serve.log',
+                        help="Log file of the service")
+
+    return parser.parse_args(argv)
+
+
+class ServiceError(Exception):
+    """Error of a request, answered with an HTTP status code"""
+    def __init__(self, message, status=400):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+
+class PSFCache(object):
+    """
+    Bounded LRU cache of PSFs loaded from FITS files
+
+    The entries are keyed by the path, modification time and size of
+    the files, so that a modified file is loaded again. The cached
+    arrays are read-only.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        Maximum number of cached PSFs (default `PSF_CACHE_SIZE`)
+
+    """
+    def __init__(self, maxsize=PSF_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, fits_file):
+        """
+        Return the PSF and pixel scale of a FITS file
+
+        Parameters
+        ----------
+        fits_file: str
+            Path to the FITS PSF image
+
+        Returns
+        -------
+        psf: `numpy.ndarray`
+            Read-only PSF image or cube
+        pixel_scale: float
+            Pixel scale of the image in arcseconds
+
+        """
+        fits_file = os.path.abspath(fits_file)
+        stat = os.stat(fits_file)
+        key = (fits_file, stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                self._cache[key] = self._cache.pop(key)
+                return self._cache[key]
+            self.misses += 1
+
+        psf, pixel_scale = load_psf(fits_file)
+        psf.setflags(write=False)
+
+        with self._lock:
+            self._cache[key] = (psf, pixel_scale)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+        return psf, pixel_scale
+
+    def info(self):
+        """Return the cache statistics as a dictionary"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache), 'maxsize': self.maxsize}
+
+
+def decode_array(entry):
+    """
+    Decode an array sent in a request
+
+    Parameters
+    ----------
+    entry: dict
+        ``data`` as nested lists, or as base64 bytes together with
+        their ``shape`` and ``dtype``
+
+    Returns
+    -------
+    array: `numpy.ndarray`
+        Decoded array
+
+    """
+    data = entry['data']
+    if isinstance(data, list):
+        return np.asarray(data, dtype=entry.get('dtype', float))
+
+    array = np.frombuffer(base64.b64decode(data),
+                          dtype=np.dtype(entry.get('dtype', '<f8')))
+    return array.reshape(entry['shape'])
+
+
+def request_number(value, name):
+    """
+    Check a number sent in a request
+
+    Parameters
+    ----------
+    value:
+        Decoded JSON value
+    name: str
+        Name of the value in the request
+
+    Returns
+    -------
+    number: float
+        Finite number
+
+    Raises
+    ------
+    ServiceError
+        If the value is not a finite number
+
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ServiceError("{0} must be a number, not {1}".format(
+            name, json.dumps(value)))
+    if not np.isfinite(value):
+        raise ServiceError("{0} must be finite".format(name))
+    return float(value)
+
+
+def request_name(value, name):
+    """
+    Check the name of a PSF array sent in a request
+
+    Parameters
+    ----------
+    value:
+        Decoded JSON value
+    name: str
+        Name of the PSF in the request
+
+    Returns
+    -------
+    label: str
+        Name of the PSF written to the kernel header
+
+    Raises
+    ------
+    ServiceError
+        If the value is not a string
+
+    """
+    if not isinstance(value, str):
+        raise ServiceError("{0} name must be a string, not {1}".format(
+            name, json.dumps(value)))
+    return value
+
+
+def request_reg_fact(value):
+    """
+    Check the regularisation parameter(s) sent in a request
+
+    Parameters
+    ----------
+    value:
+        Decoded JSON value, a number or a list of numbers
+
+    Returns
+    -------
+    reg_fact: float or list of float
+        Positive regularisation parameter(s)
+
+    Raises
+    ------
+    ServiceError
+        If the value is not a positive number or a non-empty list of them
+
+    """
+    if isinstance(value, list):
+        if not value:
+            raise ServiceError("reg_fact must not be empty")
+        reg_fact = [request_number(item, 'reg_fact') for item in value]
+    else:
+        reg_fact = request_number(value, 'reg_fact')
+    if np.any(np.asarray(reg_fact) <= 0):
+        raise ServiceError("reg_fact must be positive")
+    return reg_fact
+
+
+def encode_array(array):
+    """
+    Encode an array as base64 bytes, with its shape and dtype
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`
+        Array to encode
+
+    Returns
+    -------
+    entry: dict
+        ``data``, ``shape`` and ``dtype`` (little-endian) of the array
+
+    """
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    return {'data': base64.b64encode(array.tobytes()).decode('ascii'),
+            'shape': list(array.shape), 'dtype': array.dtype.str}
+
+
+class KernelService(object):
+    """
+    Kernel computations shared by the requests of the service
+
+    Parameters
+    ----------
+    jobs: int, optional
+        Maximum number of kernels computed at once (default 1)
+    max_queue: int, optional
+        Maximum number of requests waiting for a job (default 16)
+    psf_cache: int, optional
+        Number of loaded PSF files kept in memory
+    kernel_cache: `pypher.pypher.KernelCache`, optional
+        On-disk cache of the kernels
+    log: `logging.Logger`, optional
+        Logger of the requests
+    root: str, optional
+        Directory the FITS files of the requests must lie in, relative
+        names being resolved from it (default: the current directory)
+    allow_output: bool, optional
+        If `True`, the requests can write the kernels to FITS files in
+        ``root`` (default `False`)
+
+    """
+    def __init__(self, jobs=1, max_queue=16, psf_cache=PSF_CACHE_SIZE,
+                 kernel_cache=None, log=None, root=None, allow_output=False):
+        self.jobs = jobs
+        self.max_queue = max_queue
+        self.psfs = PSFCache(psf_cache)
+        self.kernel_cache = kernel_cache
+        self.log = log
+        self.root = os.path.realpath(os.getcwd() if root is None else root)
+        self.allow_output = allow_output
+        self.started = time.time()
+        self.counters = OrderedDict([('requests', 0), ('kernels', 0),
+                                     ('errors', 0), ('rejected', 0),
+                                     ('active', 0), ('waiting', 0)])
+        self.compute_time = 0.
+        self._slots = threading.BoundedSemaphore(jobs)
+        self._lock = threading.Lock()
+
+    def _count(self, name, increment=1):
+        """Update a counter"""
+        with self._lock:
+            self.counters[name] += increment
+
+    def _path(self, path, name):
+        """
+        Resolve a file name of a request inside the root directory
+
+        Raises
+        ------
+        ServiceError
+            If the name is not a string (400) or the file, once the
+            symbolic links are resolved, is outside the root (403)
+
+        """
+        if not isinstance(path, str):
+            raise ServiceError("{0} must be a file name, not {1}".format(
+                name, json.dumps(path)))
+        real_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, real_path]) != self.root:
+            raise ServiceError("{0} is outside the root directory".format(
+                name), status=403)
+        return real_path
+
+    def _psf(self, entry, name):
+        """Return the PSF, pixel scale and label of a request entry"""
+        if isinstance(entry, dict):
+            if 'pixscale' not in entry:
+                raise ServiceError("{0} array without pixscale".format(name))
+            return (decode_array(entry),
+                    request_number(entry['pixscale'], name + ' pixscale'),
+                    request_name(entry.get('name', name), name))
+        try:
+            psf, pixel_scale = self.psfs.get(self._path(entry, name))
+        except (IOError, OSError) as err:
+            raise ServiceError("cannot read {0}: {1}".format(name, err))
+        return psf, pixel_scale, entry
+
+    def compute(self, request):
+        """
+        Compute the kernel of a request
+
+        Parameters
+        ----------
+        request: dict
+            Decoded JSON body of a /kernel request
+
+        Returns
+        -------
+        response: dict
+            ``shape``, ``dtype`` and ``time`` of the kernel, and either
+            the ``output`` file or the encoded ``kernel``
+
+        Raises
+        ------
+        ServiceError
+            If the request is invalid (400), reads or writes a file it is
+            not allowed to (403), would overwrite a file (409) or too many
+            requests are waiting (503)
+
+        """
+        self._count('requests')
+        try:
+            psf_source, pixscale_source, name_source = self._psf(
+                request['psf_source'], 'psf_source')
+            psf_target, pixscale_target, name_target = self._psf(
+                request['psf_target'], 'psf_target')
+        except KeyError as err:
+            raise ServiceError("missing {0}".format(err))
+        except (TypeError, ValueError) as err:
+            raise ServiceError(str(err))
+
+        reg_fact = request_reg_fact(request.get('reg_fact', 1e-4))
+        angle_source = request_number(request.get('angle_source', 0.0),
+                                      'angle_source')
+        angle_target = request_number(request.get('angle_target', 0.0),
+                                      'angle_target')
+        precision = request.get('precision', 'double')
+        resample = request.get('resample', 'spline')
+        if not isinstance(precision, str) or precision not in PRECISIONS:
+            raise ServiceError("unknown precision {0}".format(
+                json.dumps(precision)))
+        if not isinstance(resample, str) or resample not in RESAMPLINGS:
+            raise ServiceError("unknown resampling {0}".format(
+                json.dumps(resample)))
+
+        output = request.get('output')
+        if output is not None:
+            if not self.allow_output:
+                raise ServiceError("writing output files is disabled",
+                                   status=403)
+            output = self._path(output, 'output')
+            if os.path.exists(output) and request.get('overwrite') is not True:
+                raise ServiceError("output exists, set overwrite to "
+                                   "replace it", status=409)
+
+        with self._lock:
+            if self.counters['waiting'] >= self.max_queue:
+                self.counters['rejected'] += 1
+                raise ServiceError("too many requests waiting", status=503)
+            self.counters['waiting'] += 1
+
+        with self._slots:
+            self._count('waiting', -1)
+            self._count('active')
+            start = time.time()
+            try:
+                kernel = compute_kernel(psf_source, psf_target,
+                                        pixscale_source, pixscale_target,
+                                        angle_source, angle_target, reg_fact,
+                                        dtype=PRECISIONS[precision],
+                                        resample=resample,
+                                        cache=self.kernel_cache)
+            except (ValueError, MemoryError) as err:
+                raise ServiceError(str(err))
+            finally:
+                duration = time.time() - start
+                self._count('active', -1)
+
+        with self._lock:
+            self.counters['kernels'] += 1
+            self.compute_time += duration
+
+        response = OrderedDict([('shape', list(kernel.shape)),
+                                ('dtype', str(kernel.dtype)),
+                                ('time', duration)])
+
+        if output is not None:
+            task = KernelTask(name_source, name_target, output, angle_source,
+                              angle_target, reg_fact)
+            fits.writeto(output, data=kernel,
+                         header=kernel_header(task, pixscale_target),
+                         overwrite=True)
+            response['output'] = request['output']
+        else:
+            response['kernel'] = encode_array(kernel)
+            response['pixscale'] = pixscale_target
+
+        if self.log is not None:
+            self.log.info('Kernel %s -> %s computed in %.3f s',
+                          name_source, name_target, duration)
+
+        return response
+
+    def health(self):
+        """Return the status of the service"""
+        return OrderedDict([('status', 'ok'), ('version', __version__),
+                            ('uptime', time.time() - self.started)])
+
+    def metrics(self):
+        """Return the counters, timings and cache statistics"""
+        with self._lock:
+            metrics = OrderedDict(self.counters)
+            metrics['compute_time'] = self.compute_time
+        metrics['jobs'] = self.jobs
+        metrics['uptime'] = time.time() - self.started
+        metrics['fft_backend'] = fftutils.get_backend()
+        metrics['psf_cache'] = self.psfs.info()
+        metrics['reg_cache'] = reg_cache.info()
+        if self.kernel_cache is not None:
+            metrics['kernel_cache'] = self.kernel_cache.info()
+        return metrics
+
+
+class KernelRequestHandler(BaseHTTPRequestHandler):
+    """HTTP handler forwarding the requests to the `KernelService`"""
+    server_version = 'pypher/' + __version__
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _host_allowed(self):
+        """Check the Host header of a TCP request, answering 403 if wrong"""
+        if self.server.allowed_hosts is None:
+            return True
+        host = self.headers.get('Host', '').strip().lower()
+        if host.startswith('['):
+            # IPv6 address, with an optional port after the bracket
+            host = host[1:].partition(']')[0]
+        else:
+            host = host.partition(':')[0]
+        if host in self.server.allowed_hosts:
+            return True
+        self.server.service._count('errors')
+        self._reply(403, {'error': 'unexpected Host header'})
+        return False
+
+    def do_GET(self):
+        """Answer /health and /metrics"""
+        service = self.server.service
+        if not self._host_allowed():
+            return
+        if self.path == '/health':
+            self._reply(200, service.health())
+        elif self.path == '/metrics':
+            self._reply(200, service.metrics())
+        else:
+            self._reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        """Answer /kernel"""
+        service = self.server.service
+        if not self._host_allowed():
+            return
+        if self.path != '/kernel':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        # Web pages can only send other content types without a CORS
+        # preflight, which the service does not answer
+        if self.headers.get_content_type() != 'application/json':
+            service._count('errors')
+            self._reply(415, {'error': 'the content type must be '
+                                       'application/json'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            service._count('errors')
+            self._reply(400, {'error': 'invalid Content-Length'})
+            return
+        if length > self.server.max_body:
+            service._count('errors')
+            self._reply(413, {'error': 'the request body exceeds {0} '
+                                       'bytes'.format(self.server.max_body)})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as err:
+            service._count('errors')
+            self._reply(400, {'error': 'invalid JSON: {0}'.format(err)})
+            return
+
+        try:
+            if not isinstance(request, dict):
+                raise ServiceError("the request must be a JSON object")
+            self._reply(200, service.compute(request))
+        except ServiceError as err:
+            service._count('errors')
+            self._reply(err.status, {'error': str(err)})
+        except Exception as err:  # pylint: disable=broad-except
+            service._count('errors')
+            self._reply(500, {'error': '{0}: {1}'.format(
+                type(err).__name__, err)})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, fmt, *args):
+        log = self.server.service.log
+        if log is not None:
+            log.info('%s - %s', self.address_string(), fmt % args)
+
+
+class KernelServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server of a `KernelService` on a TCP port"""
+    daemon_threads = True
+
+    def __init__(self, address, service, max_body=MAX_BODY):
+        HTTPServer.__init__(self, address, KernelRequestHandler)
+        self.service = service
+        self.max_body = max_body
+        # Host names of the requests, against DNS rebinding. Browsers
+        # cannot reach a Unix socket, which accepts any.
+        self.allowed_hosts = None
+        if isinstance(address, tuple):
+            self.allowed_hosts = LOCAL_HOSTS | set([address[0].lower()])
+
+
+class UnixKernelServer(KernelServer):
+    """Threaded HTTP server of a `KernelService` on a Unix socket"""
+    address_family = getattr(socket, 'AF_UNIX', None)
+
+    _socket_id = None
+
+    def server_bind(self):
+        remove_stale_socket(self.server_address)
+        self.socket.bind(self.server_address)
+        # Only the user running the service can connect
+        os.chmod(self.server_address, 0o600)
+        info = os.lstat(self.server_address)
+        self._socket_id = (info.st_dev, info.st_ino)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def server_close(self):
+        KernelServer.server_close(self)
+        # Only remove the socket this server created
+        try:
+            info = os.lstat(self.server_address)
+        except OSError:
+            return
+        if (stat.S_ISSOCK(info.st_mode) and
+                (info.st_dev, info.st_ino) == self._socket_id):
+            os.remove(self.server_address)
+        self._socket_id = None
+
+
+def remove_stale_socket(path):
+    """
+    Remove a Unix socket nothing listens on any more
+
+    Parameters
+    ----------
+    path: str
+        Path of the socket
+
+    Raises
+    ------
+    OSError
+        If the path exists and is not a socket, or if a server listens
+        on it
+
+    """
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(info.st_mode):
+        raise OSError("{0} exists and is not a socket".format(path))
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except ConnectionRefusedError:
+        # Left by a service that did not stop cleanly
+        os.remove(path)
+        return
+    finally:
+        client.close()
+    raise OSError("a server already listens on {0}".format(path))
+
+
+def is_loopback(host):
+    """Whether a host name or address only accepts local connections"""
+    if host.lower() == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_server(service, socket_path=SOCKET, host='127.0.0.1', port=None,
+                allow_remote=False, max_body=MAX_BODY):
+    """
+    Create the HTTP server of a kernel service
+
+    Parameters
+    ----------
+    service: `KernelService`
+        Service answering the requests
+    socket_path: str, optional
+        Unix socket to listen on (default `SOCKET`)
+    host: str, optional
+        Address to listen on with ``port`` (default localhost)
+    port: int, optional
+        If given, listen on this TCP port instead of the Unix socket, 0
+        for any free port
+    allow_remote: bool, optional
+        Accept a non-loopback ``host`` (default False)
+    max_body: int, optional
+        Maximum size of a request body in bytes (default `MAX_BODY`)
+
+    Returns
+    -------
+    server: `KernelServer`
+        Server, to be run with ``serve_forever``
+
+    Raises
+    ------
+    ValueError
+        If ``host`` is not a loopback address and ``allow_remote`` is
+        False
+    OSError
+        If ``socket_path`` exists and is not a stale socket
+
+    """
+    if port is not None:
+        if not (allow_remote or is_loopback(host)):
+            raise ValueError("{0} is not a loopback address, use "
+                             "--allow-remote to listen on it".format(host))
+        return KernelServer((host, port), service, max_body)
+    return UnixKernelServer(socket_path, service, max_body)
+
+
+def main(argv=None):  # pragma: no cover
+    """Main script for pypher serve"""
+    try:
+        args = parse_args(argv)
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    log = setup_logger(args.log)
+
+    fftutils.set_backend(args.fft_backend, workers=args.threads)
+
+    kernel_cache = None
+    if args.cache_dir is not None:
+        kernel_cache = KernelCache(args.cache_dir, args.cache_size)
+
+    service = KernelService(args.jobs, args.max_queue, args.psf_cache,
+                            kernel_cache, log, args.root, args.allow_output)
+    try:
+        server = make_server(service, args.socket, args.host, args.port,
+                             args.allow_remote, args.max_body)
+    except (ValueError, OSError) as err:
+        log.error(err)
+        print("pypher serve: error: {0}".format(err), file=sys.stderr)
+        sys.exit(1)
+    if args.port is not None and not is_loopback(args.host):
+        log.warning('Listening on the non-loopback address %s: any host '
+                    'of the network can read the PSFs under %s and compute '
+                    'kernels without authentication', args.host, args.root)
+        print("pypher serve: WARNING: the service is exposed to the "
+              "network on {0} without authentication".format(args.host),
+              file=sys.stderr)
+
+    if args.port is None:
+        address = args.socket
+    else:
+        address = '{0}:{1}'.format(*server.server_address[:2])
+    log.info('pypher %s serving on %s with %d jobs', __version__, address,
+             args.jobs)
+    print("pypher serve: listening on {0}".format(address))
+
+    # Stop cleanly (removing the socket) when terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Also removes the socket this server created
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher-stream
+-------------
+Compute the kernel cube of (very) large PSF cubes out of core
+
+The PSF cube(s) are memory-mapped and processed by chunks of slices:
+each chunk is read, rotated, resampled and turned into kernels, which
+are written to an output FITS cube created beforehand on disk. The
+memory used thus only depends on the chunk size, not on the number of
+slices. One of the PSFs can be a single image, used for every slice.
+
+After every chunk, the number of kernels written is saved to a
+checkpoint file next to the output (``output.progress``), so that an
+interrupted run started again with the same arguments resumes after
+the last complete chunk. The checkpoint is deleted once the cube is
+complete, and the stale temporary checkpoints of interrupted runs when
+a run starts.
+
+Usage:
+  pypher-stream psf_source psf_target output [-s ANGLE_SOURCE]
+                [-t ANGLE_TARGET] [-r REG_FACT] [--chunk CHUNK]
+                [--precision PRECISION] [--resample RESAMPLE]
+                [--fft-backend BACKEND] [--threads THREADS]
+                [--overwrite] [--no-resume]
+  pypher-stream (-h | --help | --version)
+
+Example:
+  pypher-stream psf_cube.fits psf_target.fits kernels.fits -r 1.e-5
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+from collections import OrderedDict
+
+import numpy as np
+
+from . import fftutils
+from . import fitsutils as fits
+from .batch import KernelTask
+from .fitsutils import pyfits
+from .parser import ThrowingArgumentParser, ArgumentParserError
+from .pypher import (kernel_from_otf, kernel_header, prepare_source,
+                     prepare_source_otf, prepare_target, psf2otf,
+                     remove_stale_tmp, urdft2, PRECISIONS, RESAMPLINGS,
+                     TMP_PREFIX, TMP_SUFFIX, __version__)
+
+# Default number of slices processed at once
+CHUNK_SLICES = 16
+
+# Suffix of the checkpoint file of an output cube
+CHECKPOINT_SUFFIX = '.progress'
+
+
+def parse_args():
+    """Argument parser for the command line interface of `pypher-stream`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher-stream',
+        description="Compute the kernel cube of PSF cubes chunk by chunk")
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {0}'.format(__version__))
+
+    parser.add_argument('psf_source', type=str,
+                        help="FITS file of the source PSF cube or image")
+
+    parser.add_argument('psf_target', type=str,
+                        help="FITS file of the target PSF cube or image")
+
+    parser.add_argument('output', type=str,
+                        help="File name for the output kernel cube")
+
+    parser.add_argument('-s', '--angle_source', type=float, default=0.0,
+                        help="Rotation angle to apply to `psf_source` (deg)")
+
+    parser.add_argument('-t', '--angle_target', type=float, default=0.0,
+                        help="Rotation angle to apply to `psf_target` (deg)")
+
+    parser.add_argument('-r', '--reg_fact', type=float, default=1.e-4,
+                        help="Regularisation parameter for the Wiener filter")
+
+    parser.add_argument('--chunk', type=int, default=CHUNK_SLICES,
+                        help="Number of slices processed at once")
+
+    parser.add_argument('--precision', type=str, default='double',
+                        choices=sorted(PRECISIONS),
+                        help="Floating point precision of the computation "
+                             "and of the output kernels")
+
+    parser.add_argument('--resample', type=str, default='spline',
+                        choices=RESAMPLINGS,
+                        help="Resampling of the source PSF, see pypher")
+
+    parser.add_argument('--fft-backend', type=str, default='scipy',
+                        choices=fftutils.BACKENDS,
+                        help="Library used to compute the FFTs")
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used by the FFTs "
+                             "(-1 for all CPUs)")
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Overwrite the output file if it exists")
+
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Start from scratch even if a checkpoint of "
+                             "the output exists (requires --overwrite)")
+
+    return parser.parse_args()
+
+
+def checkpoint_name(output_file):
+    """Return the name of the checkpoint file of an output cube"""
+    return output_file + CHECKPOINT_SUFFIX
+
+
+def read_checkpoint(output_file):
+    """
+    Read the checkpoint of an output cube
+
+    Parameters
+    ----------
+    output_file: str
+        Path to the output FITS cube
+
+    Returns
+    -------
+    state: dict or `None`
+        Parameters of the run, position of the data in the output file
+        and number of kernels ``done``, `None` if there is no readable
+        checkpoint
+
+    """
+    try:
+        with open(checkpoint_name(output_file)) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_checkpoint(output_file, state):
+    """
+    Atomically write the checkpoint of an output cube
+
+    The state is written to a temporary file then renamed, so that an
+    interruption leaves either the previous or the new checkpoint.
+
+    Parameters
+    ----------
+    output_file: str
+        Path to the output FITS cube
+    state: dict
+        JSON serializable state of the run
+
+    """
+    directory = os.path.dirname(os.path.abspath(output_file))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix=TMP_PREFIX,
+                                        suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(handle, 'w') as tmp_file:
+            json.dump(state, tmp_file, indent=2)
+        os.replace(tmp_path, checkpoint_name(output_file))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _file_id(fits_file):
+    """Path, size and modification time identifying an input file"""
+    stat = os.stat(fits_file)
+    return [os.path.abspath(fits_file), stat.st_size, stat.st_mtime]
+
+
+def _read_slices(hdu, key, dtype):
+    """Read a section of an image or cube, non-finite values set to 0"""
+    return fits.replace_nonfinite(np.array(hdu.section[key], dtype=dtype))
+
+
+def _target_fourier(psf, angle):
+    """Transform of the rotated and normalized target PSF image or cube"""
+    return urdft2(prepare_target(psf, angle, copy=False))
+
+
+def _source_otf(psf, pixscale, target_pixscale, target_shape, angle,
+                resample):
+    """OTF on the target grid of the prepared source PSF image or cube"""
+    if resample == 'fourier':
+        return prepare_source_otf(psf, pixscale, target_pixscale,
+                                  target_shape, angle, copy=False)
+    psf = prepare_source(psf, pixscale, target_pixscale, target_shape, angle,
+                         copy=False)
+    return psf2otf(psf, target_shape, real=True)
+
+
+def stream_kernels(psf_source, psf_target, output_file, angle_source=0.0,
+                   angle_target=0.0, reg_fact=1e-4, chunk=CHUNK_SLICES,
+                   dtype=None, resample='spline', overwrite=False,
+                   resume=True, progress=None):
+    """
+    Compute the kernel cube of PSF cubes chunk by chunk, out of core
+
+    The input cubes are memory-mapped and the kernels of ``chunk``
+    slices at a time are computed as by `compute_kernel` and written to
+    an output cube created on disk with the header of the `pypher`
+    command. A PSF given as a single image is prepared once for all the
+    slices. The number of kernels written is checkpointed after every
+    chunk, so that a run interrupted with the same parameters resumes
+    after its last complete chunk.
+
+    Parameters
+    ----------
+    psf_source: str
+        Path to the FITS source PSF cube (N x H x W) or image
+    psf_target: str
+        Path to the FITS target PSF cube or image. If both PSFs are
+        cubes, they must have the same number of slices.
+    output_file: str
+        Path to the output FITS kernel cube
+    angle_source, angle_target: float, optional
+        Rotation angles to apply to the PSFs in degrees
+    reg_fact: float, optional
+        Regularisation parameter for the Wiener filter
+    chunk: int, optional
+        Number of slices processed at once (default `CHUNK_SLICES`)
+    dtype: `numpy.dtype`, optional
+        Real floating point type of the computation and of the output
+        (default `numpy.float64`)
+    resample: str, optional
+        Resampling of the source PSF among `RESAMPLINGS`
+    overwrite: bool, optional
+        If `True`, overwrite an existing output file that is not resumed
+    resume: bool, optional
+        If `True` (default), resume from the checkpoint of the output if
+        it matches the parameters of the run
+    progress: callable, optional
+        Called with the number of kernels done and the total after
+        every chunk
+
+    Returns
+    -------
+    nkernels: int
+        Number of kernels computed by this call
+
+    Raises
+    ------
+    ValueError
+        If neither PSF is a cube, or the cubes differ in length
+    IOError
+        If the output file exists and is neither resumed nor overwritten
+
+    """
+    if chunk < 1:
+        raise ValueError("The chunk size must be positive")
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+
+    source_shape = fits.image_shape(psf_source)
+    target_shape = fits.image_shape(psf_target)
+    lengths = set(shape[0] for shape in [source_shape, target_shape]
+                  if len(shape) == 3)
+    if not lengths:
+        raise ValueError("At least one of the PSFs must be a cube")
+    if len(lengths) > 1:
+        raise ValueError("The PSF cubes have different lengths: "
+                         "{0} and {1}".format(source_shape[0],
+                                              target_shape[0]))
+    nslices = lengths.pop()
+    shape = (nslices,) + tuple(target_shape[-2:])
+
+    pixscale_source = fits.get_pixscale(psf_source)
+    pixscale_target = fits.get_pixscale(psf_target)
+
+    # Parameters a checkpoint must match, as read back from JSON
+    params = json.loads(json.dumps(OrderedDict([
+        ('version', __version__),
+        ('psf_source', _file_id(psf_source)),
+        ('psf_target', _file_id(psf_target)),
+        ('angle_source', angle_source), ('angle_target', angle_target),
+        ('reg_fact', reg_fact), ('dtype', dtype.str),
+        ('resample', resample), ('shape', shape)])))
+
+    # Temporary checkpoints of runs interrupted while writing them
+    remove_stale_tmp(os.path.dirname(os.path.abspath(output_file)))
+
+    state = read_checkpoint(output_file) if resume else None
+    if (state is not None and state.get('params') == params and
+            os.path.exists(output_file)):
+        offset, done = state['offset'], state['done']
+    else:
+        task = KernelTask(psf_source, psf_target, output_file, angle_source,
+                          angle_target, reg_fact)
+        offset = fits.create_image(output_file, shape, dtype,
+                                   kernel_header(task, pixscale_target),
+                                   overwrite=overwrite)
+        done = 0
+        state = OrderedDict([('params', params), ('offset', offset),
+                             ('done', done)])
+        write_checkpoint(output_file, state)
+
+    start = done
+    out = fits.image_memmap(output_file, shape, dtype, offset)
+    # Default memmap option, memmap=True forbidding to read scaled images
+    with pyfits.open(psf_source) as source_list, \
+            pyfits.open(psf_target) as target_list:
+        hdus = [fits.image_hdu(source_list), fits.image_hdu(target_list)]
+
+        def prepare(index, key):
+            """Read and prepare slices of the source or target PSF"""
+            psf = _read_slices(hdus[index], key, dtype)
+            if index == 0:
+                return _source_otf(psf, pixscale_source, pixscale_target,
+                                   shape[-2:], angle_source, resample)
+            return _target_fourier(psf, angle_target)
+
+        # A single image is read and prepared once for every slice, as in
+        # `KernelBatch`
+        prepared = [prepare(index, Ellipsis)
+                    if hdu.header['NAXIS'] == 2 else None
+                    for index, hdu in enumerate(hdus)]
+
+        while done < nslices:
+            stop = min(done + chunk, nslices)
+            trans_func, target_ft = [
+                prepare(index, slice(done, stop)) if value is None else value
+                for index, value in enumerate(prepared)]
+            kernel, _ = kernel_from_otf(trans_func, target_ft, shape[-2:],
+                                        reg_fact=reg_fact)
+            out[done:stop] = kernel
+            out.flush()
+            del kernel, trans_func, target_ft
+
+            # Checkpoint once the chunk is on disk
+            done = state['done'] = stop
+            write_checkpoint(output_file, state)
+            if progress is not None:
+                progress(done, nslices)
+
+    del out
+    os.remove(checkpoint_name(output_file))
+
+    return nslices - start
+
+
+def main():  # pragma: no cover
+    """Main script for pypher-stream"""
+    try:
+        args = parse_args()
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    fftutils.set_backend(args.fft_backend, workers=args.threads)
+
+    def progress(done, total):
+        print("pypher-stream: {0}/{1} kernels".format(done, total))
+
+    nkernels = stream_kernels(args.psf_source, args.psf_target, args.output,
+                              args.angle_source, args.angle_target,
+                              args.reg_fact, chunk=args.chunk,
+                              dtype=PRECISIONS[args.precision],
+                              resample=args.resample,
+                              overwrite=args.overwrite,
+                              resume=not args.no_resume, progress=progress)
+
+    print("pypher-stream: {0} kernels computed, cube saved to "
+          "{1}".format(nkernels, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,7 @@ def create_mock_fits():
     # Single extension FITS
     img = fits.ImageHDU(data=x)
     singlehdu = fits.HDUList([prihdu, img])
-    singlehdu.writeto('image.fits', clobber=True)
+    singlehdu.writeto('image.fits', overwrite=True)
 
 
 @pytest.fixture(scope="module")
@@ -47,6 +47,41 @@ def mock_parser():
     return parser
 
 
+@pytest.fixture(scope='function', params=[15, 100])
+def psfpair(request):
+    size = request.param
+    y, x = np.indices((size, size)) - size // 2
+    source = np.exp(-(x**2 + y**2) / 2.)
+    target = np.exp(-(x**2 + 0.5 * y**2) / 8.)
+    return target / target.sum(), source / source.sum()
+
+
+@pytest.fixture(scope='function', params=[15, 40])
+def psfcube(request):
+    """Cube of elliptical PSFs with varying widths"""
+    size = request.param
+    y, x = np.indices((size, size)) - size // 2
+    cube = np.array([np.exp(-(x**2 / sigma**2 + y**2 / 4.) / 2.)
+                     for sigma in [1., 1.5, 2.5]])
+    return cube / cube.sum(axis=(1, 2), keepdims=True)
+
+
+@pytest.fixture
+def psffiles(tmpdir):
+    """Source and target PSF files with different pixel scales"""
+    files = []
+    for name, size, sigma, pixscale in [('source', 61, 2., 0.1),
+                                        ('target', 41, 3., 0.2)]:
+        y, x = np.indices((size, size)) - size // 2
+        header = fits.Header()
+        header['PIXSCALE'] = pixscale
+        filename = str(tmpdir.join(name + '.fits'))
+        fits.writeto(filename, np.exp(-(x**2 + y**2) / (2 * sigma**2)),
+                     header)
+        files.append(filename)
+    return files
+
+
 @pytest.fixture(scope='function', params=[15, 55, 255])
 def tones(request):
     size = request.param
@@ -6,18 +6,60 @@
 
 from __future__ import division, absolute_import
 
+import os
+import sys
+import json
+import argparse
+import socket
+import threading
+import time
+import subprocess
+import asyncio
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 import numpy as np
 import astropy.io.fits as fits
 
 from numpy.testing import assert_equal, assert_allclose
+from scipy.ndimage import convolve, rotate, zoom
 
-from pypher.pypher import (parse_args, format_kernel_header,
-                           imrotate, imresample, trim, zero_pad,
-                           psf2otf, homogenization_kernel)
-from pypher.fitsutils import has_pixelscale, get_pixscale, add_comments
+from pypher.pypher import (parse_args, format_kernel_header, kernel_header,
+                           load_psf, prepare_source, prepare_target,
+                           imrotate, imresample, imwarp, trim, zero_pad,
+                           psf2otf, udft2, uidft2, deconv_wiener,
+                           homogenization_kernel, hermitian_full,
+                           LAPLACIAN, RegularizationCache, reg_cache,
+                           KernelWorkspace, shift_pad, compute_kernel,
+                           psf2otf_resampled, plan_kernel, memory_size,
+                           prepare_source_otf, kernel_from_otf, urdft2,
+                           crop_kernel, KernelCache, kernel_key, reg_curve,
+                           select_reg_fact, reg_factor, uirdft2, REG_GRID,
+                           reg_selection_issue,
+                           resample_source, remove_stale_tmp, TMP_PREFIX,
+                           TMP_MAX_AGE)
+from pypher.fftutils import NUMPY_FFT_OUT
+from pypher.fftutils import fft_backend, get_backend, set_backend
+from pypher.fitsutils import (has_pixelscale, get_pixscale, add_comments,
+                              read_image, read_section, image_shape,
+                              update_header)
 from pypher.parser import ArgumentParserError
 from pypher.addpixscl import parse_args as parse_args_addpixscl
+from pypher.addpixscl import add_pixelscales
+from pypher.batch import (KernelBatch, KernelTask, kernel_name,
+                          read_manifest, run_batch)
+from pypher.batch import parse_args as parse_args_batch
+from pypher.apply import TiledConvolution, apply_kernel
+from pypher.metrics import StageMetrics
+from pypher.serve import (KernelService, ServiceError, make_server,
+                          decode_array, encode_array)
+from pypher.apply import parse_args as parse_args_apply
+from pypher.stream import stream_kernels, checkpoint_name, read_checkpoint
+from pypher import stream
+from pypher.aio import (AsyncRunner, compute_kernel_async,
+                        kernel_from_files_async, load_psf_async)
 
 ERRSHAPE = 'incorrect shape'
 ERROUT = 'incorrect output'
@@ -26,16 +68,83 @@ PIXSCALE = 1.0
 ABSTOL = 1e-6
 RELTOL = 1e-6
 
+# Environment of the commands run in a fresh interpreter, importing this
+# pypher whatever the working directory (see the fitscleandir fixture)
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+SUBPROCESS_ENV = dict(os.environ, PYTHONPATH=os.pathsep.join(
+    filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+
 
 class TestParser(object):
     def test_parse_args(self):
         with pytest.raises(ArgumentParserError):
             parse_args()
 
+    def test_reg_factor(self):
+        assert reg_factor('AUTO') == 'auto'
+        assert reg_factor('1e-3') == 1e-3
+        with pytest.raises(argparse.ArgumentTypeError):
+            reg_factor('optimal')
+
+    @pytest.mark.parametrize('command', ['pypher --version', 'pypher -h',
+                                         'pypher-batch -h',
+                                         'pypher-apply --version',
+                                         'pypher-stream -h',
+                                         'addpixscl -h'])
+    def test_lazy_imports(self, command):
+        # Run in a fresh interpreter, the test session has loaded them all
+        code = '''
+import sys
+from pypher import pypher, batch, apply, stream, addpixscl
+modules = {'pypher': pypher, 'pypher-batch': batch, 'pypher-apply': apply,
+           'pypher-stream': stream, 'addpixscl': addpixscl}
+sys.argv = sys.argv[1:]
+try:
+    modules[sys.argv[0]].parse_args()
+except SystemExit:
+    pass
+sys.stderr.write(repr(sorted(name for name in ['scipy', 'astropy']
+                             if name in sys.modules)))
+'''
+        process = subprocess.Popen([sys.executable, '-c', code] +
+                                   command.split(),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=SUBPROCESS_ENV)
+        _, loaded = process.communicate()
+        assert process.returncode == 0
+        assert loaded.decode() == '[]'
+
+    def test_addpixscl_without_scipy(self, tmpdir):
+        filename = str(tmpdir.join('image.fits'))
+        fits.writeto(filename, np.ones((5, 5)))
+        code = '''
+import sys
+from pypher.addpixscl import add_pixelscales
+add_pixelscales(sys.argv[1:], 0.1)
+sys.stderr.write(repr('scipy' in sys.modules))
+'''
+        process = subprocess.Popen([sys.executable, '-c', code, filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=SUBPROCESS_ENV)
+        _, loaded = process.communicate()
+        assert loaded.decode() == 'False'
+        assert get_pixscale(filename) == 0.1
+
     def test_parse_args_addpixscl(self):
         with pytest.raises(ArgumentParserError):
             parse_args_addpixscl()
 
+    def test_parse_args_batch(self):
+        with pytest.raises(ArgumentParserError):
+            parse_args_batch()
+
+    def test_parse_args_apply(self):
+        with pytest.raises(ArgumentParserError):
+            parse_args_apply()
+
 
 class TestFits(object):
     def test_nopixelscale(self, fitscleandir):
@@ -56,11 +165,100 @@ class TestFits(object):
         pscale = get_pixscale('image.fits')
         assert round(pscale, 1) == PIXSCALE
 
+    def test_format_header_regfacts(self, mock_parser):
+        format_kernel_header('image.fits', mock_parser._replace(
+            reg_fact=[1e-3, 1e-4]), PIXSCALE)
+        assert fits.getval('image.fits', 'NREGFACT') == 2
+        assert fits.getval('image.fits', 'REGF0001') == 1e-3
+        assert fits.getval('image.fits', 'REGF0002') == 1e-4
+
     def test_add_single_comment(self):
         add_comments('image.fits', "single comment")
         comments = str(fits.getval('image.fits', 'COMMENT')).split('\n')
         assert comments[-1] == "single comment"
 
+    def test_kernel_header(self, mock_parser, tmpdir):
+        filename = str(tmpdir.join('kernel.fits'))
+        fits.writeto(filename, data=np.zeros((5, 5)),
+                     header=kernel_header(mock_parser, PIXSCALE))
+        header = fits.getheader(filename)
+        assert round(header['CD1_1'] * 3600, 1) == PIXSCALE
+        assert header['REGFACT'] == mock_parser.reg_fact
+        assert 'File written with PyPHER' in str(header['COMMENT'])
+
+        # Same header as the one written on an existing file
+        format_kernel_header(filename, mock_parser, PIXSCALE)
+        assert fits.getheader(filename) == header
+
+    def test_update_header(self, tmpdir):
+        filename = str(tmpdir.join('image.fits'))
+        fits.writeto(filename, data=np.zeros((5, 5)))
+        add_comments(filename, ['old'])
+        update_header(filename, cards=[('KEY', 1, 'a key')],
+                      comments=['new'], clear_comments=True)
+        header = fits.getheader(filename)
+        assert header['KEY'] == 1
+        assert list(header['COMMENT']) == ['new']
+
+    def test_add_pixelscales(self, tmpdir):
+        files = [str(tmpdir.join('psf{0}.fits'.format(idx)))
+                 for idx in range(4)]
+        for fits_file in files:
+            fits.writeto(fits_file, data=np.zeros((5, 5)))
+        fits.setval(files[0], 'PIXSCALE', value=0.3)
+
+        report = add_pixelscales(files + ['nofile.fits'], 0.1, jobs=2,
+                                 dry_run=True)
+        assert [status for status, _ in report.values()] == \
+            ['found', 'missing', 'missing', 'missing', 'failed']
+        assert not has_pixelscale(files[1])
+
+        # Repeated paths are processed once
+        same = os.path.join(os.path.dirname(files[1]), '.',
+                            os.path.basename(files[1]))
+        report = add_pixelscales(files + [files[2], same], 0.1, jobs=4)
+        assert list(report) == files
+        assert [status for status, _ in report.values()] == \
+            ['found', 'written', 'written', 'written']
+        assert get_pixscale(files[0]) == 0.3
+        assert round(get_pixscale(files[3]), 6) == 0.1
+
+    def test_read_image(self, tmpdir):
+        cube = np.arange(60.).reshape(3, 4, 5)
+        cube[1, 2, 3] = np.nan
+        cube[0, 1, 1], cube[2, 0, 4] = np.inf, -np.inf
+        filename = str(tmpdir.join('cube.fits'))
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(cube)]).writeto(filename)
+
+        clean = np.where(np.isfinite(cube), cube, 0)
+        data = read_image(filename, chunk_size=1)
+        assert data.dtype == np.float64
+        assert data.dtype.isnative
+        assert_equal(data, clean)
+
+        data = read_image(filename, dtype=np.float32, nan=None)
+        assert data.dtype == np.float32
+        assert np.isnan(data[1, 2, 3])
+        assert np.isposinf(data[0, 1, 1])
+
+        # pypher-stream cleans its chunks the same way
+        with fits.open(filename) as hdulist:
+            assert_equal(stream._read_slices(hdulist[1], slice(0, 3),
+                                             np.float64), clean)
+
+        assert image_shape(filename) == cube.shape
+        assert_equal(read_section(filename, slice(2, 3)), cube[2:3])
+
+        # Integer image scaled by BSCALE/BZERO
+        hdu = fits.PrimaryHDU(np.arange(20.).reshape(4, 5) / 2 + 10)
+        hdu.scale('int16', bscale=0.5, bzero=10.)
+        hdu.writeto(filename, overwrite=True)
+        scaled = fits.getdata(filename)
+        assert_equal(read_image(filename, chunk_size=1), scaled)
+        assert_equal(read_section(filename, (slice(1, 3), 2)),
+                     scaled[1:3, 2])
+
 
 class TestImageManipulation(object):
     def test_rotate90(self, imagerot):
@@ -115,6 +313,24 @@ class TestImageManipulation(object):
             trim(arr, shape_ee)
             trim(arr, shape_eo)
 
+    def test_trim_zero_pad_cube(self, tones):
+        arr, size = tones
+        cube = np.array([arr, 2 * arr])
+        padded = zero_pad(cube, (size + 2, size + 4), position='center')
+        assert padded.shape == (2, size + 2, size + 4)
+        assert_equal(padded[1], zero_pad(2 * arr, (size + 2, size + 4),
+                                         position='center'))
+        assert_equal(trim(padded, (size, size)), cube)
+
+    def test_rotate_resample_cube(self, psfcube):
+        rotated = imrotate(psfcube, 30)
+        resampled = imresample(psfcube, 2, 1)
+        for idx, psf in enumerate(psfcube):
+            assert_allclose(rotated[idx], imrotate(psf, 30),
+                            atol=ABSTOL, rtol=RELTOL)
+            assert_allclose(resampled[idx], imresample(psf, 2, 1),
+                            atol=ABSTOL, rtol=RELTOL)
+
     def test_zero_pad(self, tones):
         arr, size = tones
         size_e = size + 1
@@ -143,6 +359,90 @@ class TestImageManipulation(object):
                 zero_pad(arr, shape_ee, 'center')
                 zero_pad(arr, shape_eo, 'center')
 
+    def test_warp_matches_two_passes(self, imagerot):
+        # Pure rotation and pure resampling are unchanged
+        assert_allclose(imwarp(imagerot, 30, 1., 1.), imrotate(imagerot, 30),
+                        atol=ABSTOL)
+        for shape in [(21, 21), (65, 65)]:
+            resampled = imresample(imagerot, 1., 0.7)
+            if resampled.shape > shape:
+                resampled = trim(resampled, shape)
+            else:
+                resampled = zero_pad(resampled, shape, position='center')
+            assert_allclose(imwarp(imagerot, 0, 1., 0.7, shape), resampled,
+                            atol=ABSTOL)
+
+        with pytest.raises(ValueError):
+            imwarp(imagerot, 30, 1., 0.7, (20, 20))
+
+    def test_warp_single_interpolation(self):
+        x = np.arange(-30, 31)
+        psf = np.exp(-(x[:, None] - 2)**2 / 30. - x[None, :]**2 / 15.)
+        cube = np.array([psf, 2 * psf])
+        ratio = 89 / 61
+
+        warped = imwarp(cube, 33, 0.1, 0.07)
+        two_passes = imresample(imrotate(psf, 33), 0.1, 0.07)
+        reference = zoom(rotate(psf, -33, axes=(1, 0), reshape=False,
+                                order=5), ratio, order=5) / ratio**2
+
+        assert warped.shape == (2, 89, 89)
+        assert_allclose(warped[1], 2 * warped[0])
+        error_warp = np.abs(warped[0] - reference).max()
+        error_two_passes = np.abs(two_passes - reference).max()
+        assert error_warp < error_two_passes
+
+    def test_prepare_source_normalized(self):
+        y, x = np.indices((64, 64)) - 31.5
+        psf = np.exp(-(x**2 + (y - 3)**2) / 20.)
+        cube = np.array([psf, 3 * psf])
+        reference = psf.copy()
+
+        # Rotated and resampled: the warp does not preserve the sum
+        source = prepare_source(cube, 0.1, 0.16, (40, 40), angle=20.)
+        assert source.shape == (2, 40, 40)
+        assert_allclose(source.sum(axis=(1, 2)), 1.)
+        assert_equal(psf, reference)
+
+        target = np.exp(-(x[12:-12, 12:-12]**2 + y[12:-12, 12:-12]**2) / 30.)
+        kernel = compute_kernel(psf, target, 0.1, 0.16, angle_source=20.)
+        assert_allclose(kernel.sum(), 1.)
+
+        # Neither rotated nor resampled
+        source = prepare_source(psf, 0.1, 0.1, (64, 64), copy=False)
+        assert source is psf
+        assert_allclose(source.sum(), 1.)
+
+    def test_crop_kernel(self):
+        y, x = np.indices((41, 41)) - 20
+        kernel = np.exp(-(x**2 + y**2) / 8.)
+        kernel[20, 20] = -0.5
+
+        cropped, flux_lost = crop_kernel(kernel, energy=0.999)
+        size = cropped.shape[0]
+        assert cropped.shape == (size, size) and size % 2 == 1
+        region = slice(20 - size // 2, 20 + size // 2 + 1)
+        assert_equal(cropped, kernel[region, region])
+        assert_allclose(flux_lost, 1 - cropped.sum() / kernel.sum())
+        # Smallest odd square
+        energy = np.abs(kernel).sum()
+        assert np.abs(cropped).sum() >= 0.999 * energy
+        assert np.abs(cropped[1:-1, 1:-1]).sum() < 0.999 * energy
+
+        cropped, _ = crop_kernel(kernel, tol=1e-4)
+        size = cropped.shape[0]
+        region = slice(20 - size // 2, 20 + size // 2 + 1)
+        outside = np.abs(kernel).copy()
+        outside[region, region] = 0
+        assert outside.max() <= 1e-4 * np.abs(kernel).max()
+
+        # Same size for all the images of a cube
+        cube, _ = crop_kernel(np.array([kernel, kernel**2]), energy=0.999)
+        assert cube.shape[1:] == crop_kernel(kernel, energy=0.999)[0].shape
+
+        # Nothing to crop
+        assert crop_kernel(kernel, tol=0.)[0] is kernel
+
 
 class TestFourier(object):
     def test_dirac_otf(self, imagedirac):
@@ -162,3 +462,1291 @@ class TestFourier(object):
 
         assert k.dtype == float
         assert kf.dtype == complex
+
+    def test_real_otf(self, imagerot):
+        shape = imagerot.shape
+        full = psf2otf(imagerot, shape)
+        half = psf2otf(imagerot, shape, real=True)
+        assert half.shape == (shape[0], shape[1] // 2 + 1)
+        assert_allclose(half, full[:, :shape[1] // 2 + 1],
+                        atol=ABSTOL, rtol=RELTOL)
+        assert_allclose(hermitian_full(half, shape), full,
+                        atol=ABSTOL, rtol=RELTOL)
+
+    @pytest.mark.parametrize('backend', ['scipy', 'numpy'])
+    def test_unitary_transforms(self, imagerot, backend):
+        image = imagerot[:, :-1]
+        with fft_backend(backend):
+            full = udft2(image)
+            half = urdft2(image)
+            assert_allclose(full, np.fft.fft2(image, norm='ortho'))
+            assert_allclose(half, np.fft.rfft2(image, norm='ortho'))
+            # Parseval and inverse transforms
+            assert_allclose(np.sum(np.abs(full)**2), np.sum(image**2))
+            assert_allclose(uidft2(full).real, image, atol=1e-12)
+            assert_allclose(uirdft2(half, image.shape), image, atol=1e-12)
+
+            single = image.astype(np.float32)
+            assert urdft2(single).dtype == np.complex64
+            assert uirdft2(urdft2(single), image.shape).dtype == np.float32
+
+    def test_homogenization_real_path(self, imagedirac):
+        center = imagedirac.shape[0] // 2
+        target = np.zeros_like(imagedirac)
+        s = slice(center - 1, center + 2)
+        target[s, s] += 1.
+        target[center, center] += 1
+        target /= target.sum()
+
+        k, kf = homogenization_kernel(target, imagedirac, reg_fact=1e-4)
+        _, kf_full = homogenization_kernel(target, imagedirac,
+                                           reg_fact=1e-4, full_fourier=True)
+
+        # Reference computed with full-plane complex transforms
+        ref_f = deconv_wiener(imagedirac, 1e-4) * udft2(target)
+        ref = np.real(uidft2(ref_f))
+
+        assert kf.shape[-1] == imagedirac.shape[1] // 2 + 1
+        assert_allclose(k, ref, atol=ABSTOL, rtol=RELTOL)
+        assert_allclose(kf_full, ref_f, atol=ABSTOL, rtol=RELTOL)
+
+    def test_fft_backends(self, imagerot):
+        shape = imagerot.shape
+        ref = psf2otf(imagerot, shape)
+        for backend in ['numpy', 'scipy']:
+            with fft_backend(backend, workers=2):
+                assert get_backend() == (backend, 2)
+                assert_allclose(psf2otf(imagerot, shape), ref,
+                                atol=ABSTOL, rtol=RELTOL)
+        assert get_backend() == ('scipy', 1)
+
+    def test_fft_unknown_backend(self):
+        with pytest.raises(ValueError):
+            set_backend('fftpack')
+
+    def test_reg_cache(self):
+        reg_cache.clear()
+        shape = (15, 15)
+        ref = np.abs(psf2otf(LAPLACIAN, shape, real=True))**2
+
+        reg_cache.warm([shape])
+        assert_allclose(reg_cache.get(shape, real=True), ref)
+        assert reg_cache.info() == {'hits': 1, 'misses': 1,
+                                    'size': 1, 'maxsize': 16}
+        with pytest.raises(ValueError):
+            reg_cache.get(shape, real=True)[0, 0] = 0
+
+        reg_cache.clear()
+        assert len(reg_cache) == 0
+
+    def test_reg_cache_eviction(self):
+        cache = RegularizationCache(maxsize=2)
+        for size in [5, 7, 5, 9]:
+            cache.get((size, size))
+        assert len(cache) == 2
+        assert cache.info()['hits'] == 1
+        cache.get((7, 7))
+        assert cache.info()['misses'] == 4
+
+    def test_homogenization_reg_sweep(self, psfpair):
+        target, source = psfpair
+        reg_facts = [1e-5, 1e-4, 1e-3]
+        k, kf = homogenization_kernel(target, source, reg_fact=reg_facts)
+
+        assert k.shape == (len(reg_facts),) + target.shape
+        assert kf.shape[0] == len(reg_facts)
+        for idx, reg_fact in enumerate(reg_facts):
+            k_ref, kf_ref = homogenization_kernel(target, source,
+                                                  reg_fact=reg_fact)
+            assert_allclose(k[idx], k_ref, atol=ABSTOL, rtol=RELTOL)
+            assert_allclose(kf[idx], kf_ref, atol=ABSTOL, rtol=RELTOL)
+
+    def test_otf_cube(self, psfcube):
+        shape = psfcube.shape[1:]
+        otf = psf2otf(psfcube, shape, real=True)
+        for idx, psf in enumerate(psfcube):
+            assert_allclose(otf[idx], psf2otf(psf, shape, real=True),
+                            atol=ABSTOL, rtol=RELTOL)
+
+    def test_homogenization_cube(self, psfcube):
+        target = psfcube[-1]
+        sources = psfcube[:-1]
+        k, kf = homogenization_kernel(target, sources, reg_fact=1e-4)
+        assert k.shape == sources.shape
+        for idx, source in enumerate(sources):
+            k_ref, kf_ref = homogenization_kernel(target, source,
+                                                  reg_fact=1e-4)
+            assert_allclose(k[idx], k_ref, atol=ABSTOL, rtol=RELTOL)
+            assert_allclose(kf[idx], kf_ref, atol=ABSTOL, rtol=RELTOL)
+
+        # Cube of targets and several regularisation parameters
+        k, _ = homogenization_kernel(psfcube, psfcube[0],
+                                     reg_fact=[1e-5, 1e-3])
+        assert k.shape == (2,) + psfcube.shape
+        k_ref, _ = homogenization_kernel(psfcube[2], psfcube[0],
+                                         reg_fact=1e-3)
+        assert_allclose(k[1, 2], k_ref, atol=ABSTOL, rtol=RELTOL)
+
+    def test_shift_pad(self, imagerot):
+        shape = (imagerot.shape[0] + 3, imagerot.shape[1] + 2)
+        ref = np.roll(zero_pad(imagerot, shape),
+                      (-(imagerot.shape[0] // 2), -(imagerot.shape[1] // 2)),
+                      axis=(0, 1))
+        assert_equal(shift_pad(imagerot, np.ones(shape)), ref)
+
+    def test_workspace(self, psfpair):
+        target, source = psfpair
+        workspace = KernelWorkspace(target.shape)
+        k_ref, kf_ref = homogenization_kernel(target, source)
+        for _ in range(2):
+            k, kf = homogenization_kernel(target, source,
+                                          workspace=workspace)
+            assert_allclose(k, k_ref, atol=ABSTOL, rtol=RELTOL)
+            assert_allclose(kf, kf_ref, atol=ABSTOL, rtol=RELTOL)
+        assert kf is workspace.otf
+
+        with pytest.raises(ValueError):
+            homogenization_kernel(target, source, reg_fact=[1e-4, 1e-3],
+                                  workspace=workspace)
+        with pytest.raises(ValueError):
+            homogenization_kernel(target[1:-1, 1:-1], source[1:-1, 1:-1],
+                                  workspace=workspace)
+
+    @pytest.mark.skipif(not NUMPY_FFT_OUT, reason="numpy < 2.0")
+    def test_workspace_allocations(self, psfpair):
+        target, source = psfpair
+        workspace = KernelWorkspace(target.shape)
+        with fft_backend('numpy'):
+            homogenization_kernel(target, source, workspace=workspace)
+            tracemalloc.start()
+            homogenization_kernel(target, source, workspace=workspace)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        # Only the output kernel is allocated
+        assert peak < 1.1 * target.nbytes + 10000
+
+    @pytest.mark.parametrize('backend', ['numpy', 'scipy'])
+    def test_workspace_fallback(self, psfpair, backend, monkeypatch):
+        # Transforms without ``out`` support (numpy < 2.0, scipy) allocate
+        # their result before copying it into the workspace buffers
+        monkeypatch.setattr('pypher.fftutils.NUMPY_FFT_OUT', False)
+        target, source = psfpair
+        workspace = KernelWorkspace(target.shape)
+        k_ref, kf_ref = homogenization_kernel(target, source)
+        with fft_backend(backend):
+            homogenization_kernel(target, source, workspace=workspace)
+            tracemalloc.start()
+            k, kf = homogenization_kernel(target, source,
+                                          workspace=workspace)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        assert_allclose(k, k_ref, atol=ABSTOL, rtol=RELTOL)
+        assert_allclose(kf, kf_ref, atol=ABSTOL, rtol=RELTOL)
+        assert kf is workspace.otf
+        # The output kernel and at most two temporary transforms
+        assert peak < 1.1 * target.nbytes + 2.1 * kf.nbytes + 10000
+
+    @pytest.mark.parametrize('backend', ['numpy', 'scipy'])
+    def test_homogenization_single(self, psfpair, backend):
+        target, source = psfpair
+        k_ref, _ = homogenization_kernel(target, source,
+                                         reg_fact=[1e-4, 1e-3])
+        with fft_backend(backend):
+            k, kf = homogenization_kernel(target, source,
+                                          reg_fact=[1e-4, 1e-3],
+                                          dtype=np.float32)
+        assert k.dtype == np.float32
+        assert kf.dtype == np.complex64
+        assert_allclose(k, k_ref, atol=1e-6 * np.abs(k_ref).max())
+
+    def test_compute_kernel_single(self, psffiles):
+        psf_source, pixscale_source = load_psf(psffiles[0])
+        psf_target, pixscale_target = load_psf(psffiles[1], np.float32)
+        assert psf_target.dtype == np.float32
+
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target, angle_source=15.)
+        k = compute_kernel(psf_source, psf_target, pixscale_source,
+                           pixscale_target, angle_source=15.,
+                           dtype=np.float32)
+        assert k.dtype == np.float32
+        assert_allclose(k, k_ref, atol=1e-6 * np.abs(k_ref).max())
+
+    def test_psf2otf_resampled(self):
+        def gaussian(size, pixscale):
+            x = (np.arange(size) - (size - 1) / 2) * pixscale
+            psf = np.exp(-(x[:, None]**2 + (x[None, :] - 0.3)**2) / 0.5)
+            return psf / psf.sum()
+
+        psf = gaussian(121, 0.1)
+        assert_allclose(psf2otf_resampled(psf, 0.1, 0.1, (141, 141)),
+                        psf2otf(zero_pad(psf, (141, 141), 'center'),
+                                (141, 141), real=True), atol=ABSTOL)
+
+        for pixscale, size in [(0.2, 65), (0.07, 150)]:
+            shape = (size, size)
+            otf = psf2otf_resampled(np.array([psf, psf]), 0.1, pixscale,
+                                    shape)
+            assert otf.shape == (2, size, size // 2 + 1)
+            assert_allclose(otf[1], psf2otf(gaussian(size, pixscale), shape,
+                                            real=True), atol=ABSTOL)
+
+        # 64 pixels of 0.13 arcsec span 83.2 PSF pixels, rounded to 83
+        otf = psf2otf_resampled(psf, 0.1, 0.13, (64, 64))
+        assert_allclose(otf, psf2otf(gaussian(64, 0.1 * 83 / 64), (64, 64),
+                                     real=True), atol=ABSTOL)
+
+    def test_compute_kernel_fourier(self, psffiles):
+        psf_source, pixscale_source = load_psf(psffiles[0])
+        psf_target, pixscale_target = load_psf(psffiles[1])
+
+        # Gaussian PSFs of 0.2 and 0.6 arcsec: Gaussian kernel
+        y, x = np.indices(psf_target.shape) - psf_target.shape[0] // 2
+        sigma = np.sqrt(0.6**2 - 0.2**2) / pixscale_target
+        k_ref = np.exp(-(x**2 + y**2) / (2 * sigma**2))
+        k_ref /= k_ref.sum()
+
+        k = compute_kernel(psf_source, psf_target, pixscale_source,
+                           pixscale_target, reg_fact=1e-8,
+                           resample='fourier')
+        assert_allclose(k, k_ref, atol=ABSTOL * k_ref.max())
+
+        # No limit on the size of the resampled source
+        with pytest.raises(MemoryError):
+            prepare_source(psf_source, 1., 0.005, (41, 41))
+        k = compute_kernel(psf_source, psf_target, 1., 0.005,
+                           resample='fourier')
+        assert k.shape == psf_target.shape
+
+    def test_reg_curve(self, psfpair):
+        psf_target, psf_source = psfpair
+        rng = np.random.RandomState(3)
+        psf_target = psf_target + 1e-5 * rng.randn(*psf_target.shape)
+        trans_func = psf2otf(psf_source, psf_source.shape, real=True)
+        target_fourier = urdft2(psf_target)
+        laplacian_otf = psf2otf(LAPLACIAN, psf_target.shape, real=True)
+
+        reg_facts = [1e-6, 1e-4, 1e-2]
+        curve = reg_curve(trans_func, target_fourier, psf_target.shape,
+                          reg_facts, chunk_size=1)
+        for idx, reg in enumerate(reg_facts):
+            kernel, _ = kernel_from_otf(trans_func, target_fourier,
+                                        psf_target.shape, reg, clip=False)
+            kernel_fourier = urdft2(kernel)
+            residual = uirdft2(target_fourier - trans_func * kernel_fourier,
+                               psf_target.shape)
+            seminorm = uirdft2(laplacian_otf * kernel_fourier,
+                               psf_target.shape)
+            assert_allclose(curve['residual'][idx], np.sum(residual**2),
+                            rtol=RELTOL)
+            assert_allclose(curve['seminorm'][idx], np.sum(seminorm**2),
+                            rtol=RELTOL)
+
+        # A cube of identical PSFs gives the same GCV function
+        cube = reg_curve(trans_func, urdft2(np.array([psf_target] * 2)),
+                         psf_target.shape, reg_facts)
+        assert_allclose(cube['residual'], 2 * curve['residual'])
+        assert_allclose(cube['gcv'], curve['gcv'])
+
+    @pytest.mark.parametrize('method', ['gcv', 'lcurve'])
+    def test_select_reg_fact(self, method):
+        size = 64
+        y, x = np.indices((size, size)) - size // 2
+        psf_source = np.exp(-(x**2 + y**2) / 4.5)
+        psf_target = np.exp(-(x**2 + y**2) / 32.)
+        trans_func = psf2otf(psf_source / psf_source.sum(), (size, size),
+                             real=True)
+        rng = np.random.RandomState(4)
+
+        selected = []
+        for noise in [1e-6, 1e-4]:
+            target = psf_target / psf_target.sum()
+            target = target + noise * target.max() * rng.randn(size, size)
+            reg_fact, curve = select_reg_fact(trans_func, urdft2(target),
+                                              target.shape, method=method)
+            assert reg_fact in REG_GRID
+            assert len(curve['curvature']) == len(REG_GRID)
+            selected.append(reg_fact)
+        assert selected[0] < selected[1]
+
+        with pytest.raises(ValueError):
+            select_reg_fact(trans_func, urdft2(target), target.shape,
+                            method='unknown')
+
+    @pytest.mark.parametrize('method', ['gcv', 'lcurve'])
+    def test_select_reg_fact_noise_free(self, method):
+        # Without noise both criteria favour the smallest parameter, and
+        # the L-curve has no corner
+        size = 64
+        y, x = np.indices((size, size)) - size // 2
+        psf_source = np.exp(-(x**2 + y**2) / 4.5)
+        psf_target = np.exp(-(x**2 + y**2) / 32.)
+        trans_func = psf2otf(psf_source / psf_source.sum(), (size, size),
+                             real=True)
+        target_fourier = urdft2(psf_target / psf_target.sum())
+        with pytest.warns(UserWarning, match='end of the grid|no corner'):
+            reg_fact, curve = select_reg_fact(trans_func, target_fourier,
+                                              (size, size), method=method)
+        assert reg_fact == REG_GRID[0]
+        assert reg_selection_issue(curve, reg_fact, method) is not None
+        assert reg_selection_issue(curve, REG_GRID[20], 'gcv') is None
+
+
+class TestBatch(object):
+    def test_read_manifest_csv(self, tmpdir):
+        manifest = tmpdir.join('kernels.csv')
+        manifest.write("psf_source,psf_target,output,reg_fact\n"
+                       "a.fits,b.fits,,\n"
+                       "a.fits,c.fits,ac.fits,1e-5 1e-3\n")
+        tasks = read_manifest(str(manifest), 'out', 1e-4)
+
+        assert len(tasks) == 2
+        assert tasks[0].output == kernel_name('a.fits', 'b.fits', 'out')
+        assert tasks[0].reg_fact == 1e-4
+        assert tasks[1].output == 'ac.fits'
+        assert tasks[1].reg_fact == [1e-5, 1e-3]
+
+    def test_read_manifest_names(self, tmpdir):
+        manifest = tmpdir.join('kernels.csv')
+        manifest.write("psf_source,psf_target,angle_source\n"
+                       "a.fits,b.fits,0\n"
+                       "a.fits,b.fits,90\n")
+        tasks = read_manifest(str(manifest))
+        assert [task.output for task in tasks] == ['./a_to_b.fits',
+                                                   './a_to_b_1.fits']
+
+        manifest.write("psf_source,psf_target,output\n"
+                       "a.fits,b.fits,k.fits\n"
+                       "a.fits,c.fits,k.fits\n")
+        with pytest.raises(ValueError):
+            read_manifest(str(manifest))
+
+    def test_read_manifest_json(self, tmpdir):
+        manifest = tmpdir.join('kernels.json')
+        manifest.write(json.dumps({'sources': ['a.fits',
+                                               {'psf': 'b.fits',
+                                                'angle': 30}],
+                                   'targets': ['c.fits', 'd.fits']}))
+        tasks = read_manifest(str(manifest))
+
+        assert len(tasks) == 4
+        assert tasks[3].psf_source == 'b.fits'
+        assert tasks[3].psf_target == 'd.fits'
+        assert tasks[3].angle_source == 30
+        assert tasks[3].output == kernel_name('b.fits', 'd.fits')
+
+    def test_batch_kernel(self, psffiles, tmpdir):
+        psf_source, psf_target = psffiles
+        source, pixscale_source = load_psf(psf_source)
+        target, pixscale_target = load_psf(psf_target)
+        target = prepare_target(target)
+        source = prepare_source(source, pixscale_source, pixscale_target,
+                                target.shape)
+        ref, _ = homogenization_kernel(target, source, reg_fact=1e-4)
+
+        batch = KernelBatch()
+        for reg_fact in [1e-4, 1e-3]:
+            task = KernelTask(psf_source, psf_target,
+                              str(tmpdir.join('kernel.fits')),
+                              0.0, 0.0, reg_fact)
+            kernel, pixel_scale = batch.compute(task)
+
+        assert len(batch._psfs) == 2
+        assert len(batch._sources) == 1
+        assert pixel_scale == pixscale_target
+
+        output = batch.run(task._replace(reg_fact=1e-4))
+        assert_allclose(fits.getdata(output), ref, atol=ABSTOL, rtol=RELTOL)
+        assert fits.getval(output, 'REGFACT') == 1e-4
+
+        kernel, _ = KernelBatch(resample='fourier').compute(task)
+        assert_allclose(kernel, compute_kernel(load_psf(psf_source)[0],
+                                               load_psf(psf_target)[0],
+                                               pixscale_source,
+                                               pixscale_target,
+                                               reg_fact=task.reg_fact,
+                                               resample='fourier'))
+
+    def test_batch_eviction(self, psffiles, tmpdir):
+        psf_source, psf_target = psffiles
+        output = str(tmpdir.join('kernel.fits'))
+        tasks = [KernelTask(psf_source, psf_target, output, 0.0, angle, 1e-4)
+                 for angle in [0.0, 30.0, 0.0]]
+        reference = [KernelBatch().compute(task)[0] for task in tasks]
+
+        batch = KernelBatch(maxsize=1)
+        for task, ref in zip(tasks, reference):
+            assert_equal(batch.compute(task)[0], ref)
+            assert len(batch._psfs) == len(batch._targets) == 1
+            assert len(batch._sources) == 1
+        assert list(batch._targets) == [(psf_target, 0.0)]
+
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_run_batch(self, psffiles, tmpdir, jobs):
+        psf_source, psf_target = psffiles
+        tasks = [KernelTask(psf_source, psf_target,
+                            str(tmpdir.join('k{0}.fits'.format(idx))),
+                            0.0, 0.0, reg_fact)
+                 for idx, reg_fact in enumerate([1e-4, 1e-3])]
+        # A missing PSF must not abort the batch
+        tasks.append(KernelTask('missing.fits', psf_target,
+                                str(tmpdir.join('k2.fits')),
+                                0.0, 0.0, 1e-4))
+
+        failures = run_batch(tasks, jobs=jobs)
+
+        assert [task.output for task, _ in failures] == [tasks[2].output]
+        assert fits.getval(tasks[1].output, 'REGFACT') == 1e-3
+
+
+class TestPlan(object):
+    def test_memory_size(self):
+        assert memory_size('1024') == 1024
+        assert memory_size('512M') == 512 * 2**20
+        assert memory_size('1.5gb') == 3 * 2**29
+
+    @pytest.mark.parametrize('resample', ['spline', 'fourier'])
+    def test_plan_kernel(self, tmpdir, resample):
+        # Large enough for the arrays to dominate the memory overheads
+        files = []
+        for name, size, pixscale in [('source', 601, 0.05),
+                                     ('target', 301, 0.1)]:
+            y, x = np.indices((size, size)) - size // 2
+            header = fits.Header()
+            header['PIXSCALE'] = pixscale
+            files.append(str(tmpdir.join(name + '.fits')))
+            fits.writeto(files[-1], np.exp(-(x**2 + y**2) / 50.), header)
+        psf_source, psf_target = files
+
+        plan = plan_kernel(psf_source, psf_target, angle_source=15.,
+                           reg_fact=[1e-4, 1e-3], resample=resample)
+        json.dumps(plan)
+
+        assert plan['source_shape'] == [601, 601]
+        assert plan['resampled_size'] == 301
+        assert plan['kernel_shape'] == [2, 301, 301]
+        assert list(plan['stages']) == ['load', 'rotation', 'resampling',
+                                        'padding', 'otf', 'wiener']
+        assert plan['recommended']['precision'] == 'double'
+
+        # Same steps as the pypher command
+        tracemalloc.start()
+        source, pixscale_source = load_psf(psf_source)
+        target, pixscale_target = load_psf(psf_target)
+        target = prepare_target(target, copy=False)
+        if resample == 'fourier':
+            trans_func = prepare_source_otf(source, pixscale_source,
+                                            pixscale_target, target.shape,
+                                            15., copy=False)
+            kernel_from_otf(trans_func, urdft2(target), target.shape,
+                            reg_fact=[1e-4, 1e-3])
+        else:
+            source = prepare_source(source, pixscale_source,
+                                    pixscale_target, target.shape, 15.,
+                                    copy=False)
+            homogenization_kernel(target, source, reg_fact=[1e-4, 1e-3])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # The arrays, without the small interpreter overheads (headers)
+        assert 0.99 * peak < plan['peak_memory'] < 2 * peak
+
+    @pytest.mark.parametrize('angle,pixscale', [(15., 0.05), (0., 0.1)])
+    def test_plan_resampling(self, tmpdir, angle, pixscale):
+        files = []
+        for name, size, scale in [('source', 601, pixscale),
+                                  ('target', 301, 0.1)]:
+            y, x = np.indices((size, size)) - size // 2
+            header = fits.Header()
+            header['PIXSCALE'] = scale
+            files.append(str(tmpdir.join(name + '.fits')))
+            fits.writeto(files[-1], np.exp(-(x**2 + y**2) / 50.), header)
+
+        plan = plan_kernel(*files, angle_source=angle)
+        assert plan['stages']['padding']['memory'] == 0
+
+        # Spline resampling onto the target grid, as the pypher command
+        source, pixscale_source = load_psf(files[0])
+        target, pixscale_target = load_psf(files[1])
+        tracemalloc.start()
+        resample_source(source, pixscale_source, pixscale_target,
+                        target.shape, angle)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak += source.nbytes + target.nbytes
+        # The arrays, without the small interpreter overheads
+        assert_allclose(plan['stages']['resampling']['memory'], peak,
+                        rtol=1e-2)
+
+    def test_plan_fourier_resampling(self, tmpdir):
+        files = []
+        for name, size, scale in [('source', 601, 0.05),
+                                  ('target', 301, 0.13)]:
+            header = fits.Header()
+            header['PIXSCALE'] = scale
+            files.append(str(tmpdir.join(name + '.fits')))
+            fits.writeto(files[-1], np.ones((size, size)), header)
+
+        plan = plan_kernel(*files, resample='fourier')
+        source, pixscale_source = load_psf(files[0])
+        target, pixscale_target = load_psf(files[1])
+        # Import the FFT backend beforehand
+        psf2otf_resampled(source[:9, :9], pixscale_source, pixscale_target,
+                          (5, 5))
+        tracemalloc.start()
+        psf2otf_resampled(source, pixscale_source, pixscale_target,
+                          target.shape)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak += source.nbytes + target.nbytes
+        assert_allclose(plan['stages']['resampling']['memory'], peak,
+                        rtol=1e-2)
+
+    def test_plan_rotation(self, tmpdir):
+        # Source smaller than the target, rotated in Fourier resampling
+        files = []
+        for name, size in [('source', 21), ('target', 41)]:
+            header = fits.Header()
+            header['PIXSCALE'] = 0.1
+            files.append(str(tmpdir.join(name + '.fits')))
+            fits.writeto(files[-1], np.ones((size, size)), header)
+
+        plan = plan_kernel(*files, angle_source=10., resample='fourier')
+        rotation = plan['stages']['rotation']
+        assert rotation['flops'] == 10. * 21 * 21
+        assert rotation['memory'] == 2 * 21 * 21 * 8 + 41 * 41 * 8
+
+        plan = plan_kernel(*files, angle_source=10.)
+        assert plan['stages']['rotation']['flops'] == 0.
+
+    def test_plan_budget(self, psffiles):
+        plan = plan_kernel(*psffiles, max_memory=10**9)
+        assert plan['recommended']['precision'] == 'double'
+
+        single = plan_kernel(*psffiles, precision='single')
+        plan = plan_kernel(*psffiles, max_memory=single['peak_memory'])
+        assert plan['recommended']['precision'] == 'single'
+        assert plan['recommended']['peak_memory'] <= plan['max_memory']
+
+        plan = plan_kernel(*psffiles, max_memory=1000)
+        assert plan['recommended'] is None
+
+
+class TestKernelCache(object):
+    def test_kernel_key(self, psfpair):
+        target, source = psfpair
+        key = kernel_key(source, target, 0.1, 0.2)
+        assert key == kernel_key(source.copy(), target, 0.1, 0.2)
+        assert key == kernel_key(source.astype('>f8'), target, 0.1, 0.2)
+
+        changed = source.copy()
+        changed[0, 0] += 1e-12
+        assert key != kernel_key(changed, target, 0.1, 0.2)
+        assert key != kernel_key(source.astype(np.float32), target, 0.1, 0.2)
+        assert key != kernel_key(source, target, 0.1, 0.25)
+        assert key != kernel_key(source, target, 0.1, 0.2, angle_source=1.)
+        assert key != kernel_key(source, target, 0.1, 0.2, reg_fact=1e-3)
+        assert key != kernel_key(source, target, 0.1, 0.2, reg_fact=[1e-4])
+        assert key != kernel_key(source, target, 0.1, 0.2,
+                                 resample='fourier')
+
+    def test_compute_kernel_cache(self, psffiles, tmpdir):
+        psf_source, pixscale_source = load_psf(psffiles[0])
+        psf_target, pixscale_target = load_psf(psffiles[1])
+        cache = KernelCache(str(tmpdir.join('cache')))
+        args = (psf_source, psf_target, pixscale_source, pixscale_target)
+
+        k_ref = compute_kernel(*args, angle_source=10.)
+        k = compute_kernel(*args, angle_source=10., cache=cache)
+        k_hit = compute_kernel(*args, angle_source=10., cache=cache)
+        assert_equal(k, k_ref)
+        assert_equal(k_hit, k_ref)
+
+        k_single = compute_kernel(*args, angle_source=10., dtype=np.float32,
+                                  cache=cache)
+        assert k_single.dtype == np.float32
+
+        info = cache.info()
+        assert (info['hits'], info['misses'], info['size']) == (1, 2, 2)
+        assert len(tmpdir.join('cache').listdir()) == 2
+
+    def test_cache_eviction(self, tmpdir):
+        kernel = np.ones((10, 10))
+        cache = KernelCache(str(tmpdir))
+        cache.put('a', kernel)
+        nbytes = cache.info()['nbytes']
+
+        cache.max_size = nbytes - 1
+        cache.evict()
+        assert cache.info()['size'] == 0
+
+        cache.max_size = 2 * nbytes
+        for key, mtime in [('a', 1), ('b', 2)]:
+            cache.put(key, kernel * mtime)
+            os.utime(cache.path(key), (mtime, mtime))
+        assert_equal(cache.get('a'), kernel)
+
+        cache.put('c', kernel)
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.info()['size'] == 2
+
+        cache.clear()
+        assert cache.info() == {'hits': 0, 'misses': 0, 'size': 0,
+                                'nbytes': 0, 'max_size': 2 * nbytes}
+
+    def test_stale_tmp(self, tmpdir):
+        old = time.time() - TMP_MAX_AGE - 1
+        for name in ['stale', 'recent']:
+            tmpdir.join(TMP_PREFIX + name + '.tmp').write('')
+        tmpdir.join('other.tmp').write('')
+        os.utime(str(tmpdir.join(TMP_PREFIX + 'stale.tmp')), (old, old))
+        os.utime(str(tmpdir.join('other.tmp')), (old, old))
+
+        cache = KernelCache(str(tmpdir))
+        assert sorted(os.listdir(str(tmpdir))) == sorted([
+            TMP_PREFIX + 'recent.tmp', 'other.tmp'])
+
+        cache.put('a', np.ones((10, 10)))
+        assert sorted(os.listdir(str(tmpdir))) == sorted([
+            TMP_PREFIX + 'recent.tmp', 'other.tmp', 'a.npy'])
+        assert remove_stale_tmp(str(tmpdir), max_age=0) == 1
+
+
+class TestMetrics(object):
+    def test_stage_metrics(self, tmpdir):
+        metrics = StageMetrics()
+        metrics.info['size'] = 100
+        for _ in range(2):
+            with metrics.stage('fft'):
+                image = np.ones((100, 100))
+                metrics.describe(image=image)
+        with metrics.stage('sum'):
+            image.sum()
+
+        assert list(metrics.stages) == ['fft', 'sum']
+        assert metrics.stages['fft']['calls'] == 2
+        assert metrics.stages['fft']['arrays']['image'] == {
+            'shape': [100, 100], 'dtype': 'float64', 'nbytes': 80000}
+        assert 'peak_memory' not in metrics.stages['fft']
+
+        filename = str(tmpdir.join('metrics.json'))
+        metrics.write(filename)
+        with open(filename) as json_file:
+            content = json.load(json_file)
+        assert content['info'] == {'size': 100}
+        assert list(content['stages']) == ['fft', 'sum']
+        stages = metrics.stages.values()
+        assert_allclose(content['total_time'],
+                        sum(stage['time'] for stage in stages))
+        assert content['peak_memory'] is None
+
+        with pytest.raises(RuntimeError):
+            metrics.describe(image=image)
+
+    def test_stage_metrics_memory(self):
+        metrics = StageMetrics(trace_memory=True)
+        with metrics.stage('small'):
+            np.ones(10)
+        with metrics.stage('large'):
+            np.ones(10**6)
+        metrics.close()
+
+        assert metrics.stages['large']['peak_memory'] >= 8 * 10**6
+        assert metrics.stages['small']['peak_memory'] < 8 * 10**6
+        assert metrics.as_dict()['peak_memory'] >= 8 * 10**6
+
+    @pytest.mark.parametrize('resample', ['spline', 'fourier'])
+    def test_run_metrics(self, psffiles, tmpdir, resample):
+        output = str(tmpdir.join('kernel.fits'))
+        filename = str(tmpdir.join('metrics.json'))
+        code = 'from pypher.pypher import main; main()'
+        process = subprocess.Popen([sys.executable, '-c', code] + psffiles +
+                                   [output, '--resample', resample,
+                                    '--metrics', filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=SUBPROCESS_ENV)
+        process.communicate()
+        assert process.returncode == 0
+
+        with open(filename) as json_file:
+            stages = json.load(json_file)['stages']
+        assert [name for name in stages if name.startswith('otf')] == \
+            ['otf', 'otf_target']
+        assert stages['otf']['calls'] == stages['otf_target']['calls'] == 1
+        assert list(stages['otf']['arrays']) == ['trans_func']
+        assert list(stages['otf_target']['arrays']) == ['target_fourier']
+
+    def test_run_metrics_auto_reg_fact(self, psffiles, tmpdir):
+        output = str(tmpdir.join('kernel.fits'))
+        filename = str(tmpdir.join('metrics.json'))
+        code = 'from pypher.pypher import main; main()'
+        process = subprocess.Popen([sys.executable, '-c', code] + psffiles +
+                                   [output, '-r', 'auto',
+                                    '--metrics', filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=SUBPROCESS_ENV)
+        process.communicate()
+        assert process.returncode == 0
+
+        with open(filename) as json_file:
+            info = json.load(json_file)['info']
+        assert len(info['reg_fact']) == 1
+        assert info['reg_fact'][0] == fits.getheader(output)['REGFACT']
+        assert info['reg_method'] == 'gcv'
+        assert info['reg_curve_size'] > 1
+        # Noise-free PSFs, for which the selection fails
+        assert 'end of the grid' in info['reg_issue']
+
+
+def http_request(address, method, path, body=None, host='localhost',
+                 content_type='application/json'):
+    """Send an HTTP request over TCP or a Unix socket, return the JSON"""
+    if isinstance(address, tuple):
+        client = socket.create_connection(address)
+    else:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(address)
+    body = json.dumps(body).encode() if body is not None else b''
+    client.sendall('{0} {1} HTTP/1.0\r\nHost: {2}\r\nContent-Type: {3}\r\n'
+                   'Content-Length: {4}\r\n\r\n'
+                   .format(method, path, host, content_type,
+                           len(body)).encode() + body)
+    response = b''
+    while True:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        response += chunk
+    client.close()
+    head, content = response.split(b'\r\n\r\n', 1)
+    return int(head.split()[1]), json.loads(content.decode())
+
+
+class TestServe(object):
+    def test_kernel_service(self, psffiles, tmpdir):
+        service = KernelService(jobs=2, root=str(tmpdir), allow_output=True)
+        psf_source, pixscale_source = load_psf(psffiles[0])
+        psf_target, pixscale_target = load_psf(psffiles[1])
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target, angle_source=10.,
+                               reg_fact=1e-5)
+
+        output = str(tmpdir.join('kernel.fits'))
+        response = service.compute({'psf_source': psffiles[0],
+                                    'psf_target': psffiles[1],
+                                    'angle_source': 10., 'reg_fact': 1e-5,
+                                    'output': output})
+        kernel, header = fits.getdata(output, header=True)
+        assert response['shape'] == list(k_ref.shape)
+        assert_allclose(kernel, k_ref)
+        assert header['REGFACT'] == 1e-5
+
+        # PSFs as arrays, base64 or nested lists
+        response = service.compute({
+            'psf_source': dict(encode_array(psf_source),
+                               pixscale=pixscale_source),
+            'psf_target': {'data': psf_target.tolist(),
+                           'pixscale': pixscale_target},
+            'angle_source': 10., 'reg_fact': 1e-5})
+        assert_equal(decode_array(response['kernel']), k_ref)
+        assert response['pixscale'] == pixscale_target
+
+        # The name of an array, written to the kernel header
+        request = {'psf_source': dict(encode_array(psf_source),
+                                      pixscale=pixscale_source, name=3),
+                   'psf_target': psffiles[1], 'output': 'named.fits'}
+        with pytest.raises(ServiceError) as error:
+            service.compute(request)
+        assert error.value.status == 400
+        assert 'psf_source name' in str(error.value)
+        request['psf_source']['name'] = 'source_array'
+        service.compute(request)
+        header = fits.getheader(str(tmpdir.join('named.fits')))
+        assert '=> source_array' in header['COMMENT']
+
+        response = service.compute({'psf_source': psffiles[0],
+                                    'psf_target': psffiles[1],
+                                    'precision': 'single'})
+        assert response['dtype'] == 'float32'
+
+        for request in [{'psf_source': psffiles[0]},
+                        {'psf_source': 'missing.fits',
+                         'psf_target': psffiles[1]},
+                        {'psf_source': {'data': [[1.]]},
+                         'psf_target': psffiles[1]},
+                        {'psf_source': psffiles[0], 'psf_target': psffiles[1],
+                         'resample': 'cubic'}]:
+            with pytest.raises(ServiceError):
+                service.compute(request)
+
+        for key, value in [('reg_fact', 'auto'), ('reg_fact', -1e-4),
+                           ('reg_fact', []), ('reg_fact', [1e-4, True]),
+                           ('angle_source', '10'), ('angle_target', None),
+                           ('precision', ['single']), ('resample', 1)]:
+            request = {'psf_source': psffiles[0], 'psf_target': psffiles[1],
+                       key: value}
+            with pytest.raises(ServiceError) as error:
+                service.compute(request)
+            assert error.value.status == 400
+            assert key in str(error.value) or 'unknown' in str(error.value)
+
+        metrics = service.metrics()
+        assert metrics['kernels'] == 4
+        assert metrics['active'] == metrics['waiting'] == 0
+        assert metrics['psf_cache']['hits'] >= 3
+
+    def test_service_paths(self, psffiles, tmpdir):
+        root = tmpdir.mkdir('root')
+        tmpdir.join('source.fits').copy(root.join('source.fits'))
+        root.join('link.fits').mksymlinkto(tmpdir.join('target.fits'))
+        service = KernelService(root=str(root))
+
+        # Relative names are resolved from the root
+        response = service.compute({
+            'psf_source': 'source.fits',
+            'psf_target': str(root.join('source.fits'))})
+        assert 'kernel' in response
+
+        # Paths escaping the root, also through a symbolic link
+        for name in [psffiles[1], '../target.fits', 'link.fits',
+                     str(root.join('..', 'target.fits'))]:
+            with pytest.raises(ServiceError) as error:
+                service.compute({'psf_source': 'source.fits',
+                                 'psf_target': name})
+            assert error.value.status == 403
+
+        # Output files are disabled by default, and never outside the root
+        request = {'psf_source': 'source.fits', 'psf_target': 'source.fits',
+                   'output': 'kernel.fits'}
+        with pytest.raises(ServiceError) as error:
+            service.compute(request)
+        assert error.value.status == 403
+        assert not root.join('kernel.fits').check()
+
+        service.allow_output = True
+        for output in ['../kernel.fits', str(tmpdir.join('kernel.fits')),
+                       'link.fits']:
+            with pytest.raises(ServiceError) as error:
+                service.compute(dict(request, output=output))
+            assert error.value.status == 403
+        assert not tmpdir.join('kernel.fits').check()
+
+        # Existing files are only replaced on demand
+        assert service.compute(request)['output'] == 'kernel.fits'
+        with pytest.raises(ServiceError) as error:
+            service.compute(request)
+        assert error.value.status == 409
+        service.compute(dict(request, overwrite=True))
+        assert root.join('kernel.fits').check()
+
+    def test_service_queue(self, psffiles, tmpdir):
+        service = KernelService(max_queue=0, root=str(tmpdir))
+        with pytest.raises(ServiceError) as error:
+            service.compute({'psf_source': psffiles[0],
+                             'psf_target': psffiles[1]})
+        assert error.value.status == 503
+        assert service.metrics()['rejected'] == 1
+
+    @pytest.mark.parametrize('unix', [False, True])
+    def test_kernel_server(self, psffiles, tmpdir, unix):
+        service = KernelService(root=str(tmpdir))
+        if unix:
+            address = str(tmpdir.join('pypher.sock'))
+            server = make_server(service, socket_path=address)
+            assert os.stat(address).st_mode & 0o777 == 0o600
+        else:
+            server = make_server(service, port=0)
+            address = server.server_address[:2]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            status, health = http_request(address, 'GET', '/health')
+            assert status == 200 and health['status'] == 'ok'
+
+            status, response = http_request(
+                address, 'POST', '/kernel',
+                {'psf_source': psffiles[0], 'psf_target': psffiles[1]})
+            assert status == 200
+            assert decode_array(response['kernel']).shape == (41, 41)
+
+            status, response = http_request(address, 'POST', '/kernel',
+                                            {'psf_source': psffiles[0]})
+            assert status == 400 and 'psf_target' in response['error']
+
+            status, response = http_request(
+                address, 'POST', '/kernel',
+                {'psf_source': psffiles[0], 'psf_target': psffiles[1],
+                 'reg_fact': 'auto'})
+            assert status == 400
+            assert response['error'].startswith('reg_fact must be a number')
+
+            # Requests a web page could send
+            status, response = http_request(
+                address, 'POST', '/kernel',
+                {'psf_source': psffiles[0], 'psf_target': psffiles[1]},
+                content_type='text/plain')
+            assert status == 415
+            status, response = http_request(address, 'GET', '/health',
+                                            host='attacker.example:8457')
+            assert status == (200 if unix else 403)
+            for host in ['127.0.0.1:8457', '[::1]:8457', 'LOCALHOST']:
+                assert http_request(address, 'GET', '/health',
+                                    host=host)[0] == 200
+
+            status, metrics = http_request(address, 'GET', '/metrics')
+            assert metrics['kernels'] == 1
+            assert metrics['errors'] == (3 if unix else 4)
+            assert http_request(address, 'GET', '/kernel')[0] == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        if unix:
+            assert not os.path.exists(address)
+
+    def test_server_socket(self, tmpdir):
+        service = KernelService(root=str(tmpdir))
+        data = tmpdir.join('data.fits')
+        data.write('data')
+        with pytest.raises(OSError):
+            make_server(service, socket_path=str(data))
+        assert data.read() == 'data'
+
+        # A socket a server listens on is kept, a stale one replaced
+        address = str(tmpdir.join('pypher.sock'))
+        server = make_server(service, socket_path=address)
+        with pytest.raises(OSError):
+            make_server(service, socket_path=address)
+        server.socket.close()
+        assert os.path.exists(address)
+        make_server(service, socket_path=address).server_close()
+        assert not os.path.exists(address)
+
+        # Closing does not remove a file that replaced the socket
+        server = make_server(service, socket_path=address)
+        os.remove(address)
+        data.copy(tmpdir.join('pypher.sock'))
+        server.server_close()
+        assert tmpdir.join('pypher.sock').read() == 'data'
+
+    def test_server_host(self):
+        service = KernelService()
+        for host in ['0.0.0.0', '192.168.1.10', 'example.org']:
+            with pytest.raises(ValueError):
+                make_server(service, host=host, port=0)
+        server = make_server(service, host='0.0.0.0', port=0,
+                             allow_remote=True)
+        server.server_close()
+        server = make_server(service, host='localhost', port=0)
+        server.server_close()
+
+    def test_server_body(self, psffiles, tmpdir):
+        service = KernelService(root=str(tmpdir))
+        server = make_server(service, port=0, max_body=100)
+        address = server.server_address[:2]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            status, response = http_request(
+                address, 'POST', '/kernel',
+                {'psf_source': psffiles[0], 'psf_target': psffiles[1],
+                 'reg_fact': [1e-4] * 20})
+            assert status == 413
+
+            for length in ['-1', 'ten']:
+                client = socket.create_connection(address)
+                client.sendall('POST /kernel HTTP/1.0\r\nHost: localhost\r\n'
+                               'Content-Type: application/json\r\n'
+                               'Content-Length: {0}\r\n\r\n{{}}'
+                               .format(length).encode())
+                response = client.recv(65536)
+                client.close()
+                assert response.split()[1] == b'400'
+            assert service.metrics()['errors'] == 3
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class TestAsync(object):
+    def test_compute_kernel_async(self, psffiles, tmpdir):
+        psf_source, pixscale_source = load_psf(psffiles[0])
+        psf_target, pixscale_target = load_psf(psffiles[1])
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target, angle_source=10.,
+                               reg_fact=1e-5)
+        output = str(tmpdir.join('kernel.fits'))
+
+        async def compute():
+            (source, pixscale), _ = await asyncio.gather(
+                load_psf_async(psffiles[0]), load_psf_async(psffiles[1]))
+            kernel = await compute_kernel_async(
+                source, psf_target, pixscale, pixscale_target,
+                angle_source=10., reg_fact=1e-5)
+            from_files = await kernel_from_files_async(
+                psffiles[0], psffiles[1], output, angle_source=10.,
+                reg_fact=1e-5)
+            return kernel, from_files
+
+        kernel, (k_files, pixscale) = asyncio.run(compute())
+        data, header = fits.getdata(output, header=True)
+        assert_equal(kernel, k_ref)
+        assert_equal(k_files, k_ref)
+        assert pixscale == pixscale_target
+        assert_allclose(data, k_ref)
+        assert header['REGFACT'] == 1e-5
+
+    def test_max_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def work(value):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            threading.Event().wait(0.02)
+            with lock:
+                state['running'] -= 1
+            return value
+
+        runner = AsyncRunner(max_concurrency=2)
+
+        async def compute():
+            return await asyncio.gather(*[runner.compute(work, value)
+                                          for value in range(8)])
+
+        # The runner works across event loops
+        for _ in range(2):
+            assert asyncio.run(compute()) == list(range(8))
+        assert state['max'] == 2
+
+    def test_runner_close(self, psffiles):
+        runner = AsyncRunner()
+        assert runner.io_executor is None
+
+        async def read():
+            async with runner:
+                pixscale = await runner.get_pixscale(psffiles[0])
+                return pixscale, runner.io_executor
+
+        pixscale, io_executor = asyncio.run(read())
+        assert pixscale == get_pixscale(psffiles[0])
+        assert runner.io_executor is None
+        with pytest.raises(RuntimeError):
+            io_executor.submit(int)
+
+        # A new pool is created after closing, given executors are kept
+        given = ThreadPoolExecutor(1)
+        for runner in [runner, AsyncRunner(io_executor=given)]:
+            assert asyncio.run(read())[0] == pixscale
+        assert given.submit(int).result() == 0
+        given.shutdown()
+
+
+class TestApply(object):
+    @pytest.mark.parametrize('kernel_shape', [(7, 7), (8, 6), (21, 21)])
+    def test_tiled_convolution(self, kernel_shape):
+        rng = np.random.RandomState(1)
+        image = rng.rand(157, 203)
+        kernel = rng.rand(*kernel_shape)
+        reference = convolve(image, kernel, mode='constant')
+
+        for tile, jobs in [(16, 1), (50, 3), (500, 1)]:
+            conv = TiledConvolution(kernel, tile)
+            assert_allclose(conv.convolve(image, jobs=jobs), reference,
+                            atol=1e-12)
+
+    @pytest.mark.parametrize('processes', [False, True])
+    def test_apply_kernel(self, tmpdir, processes):
+        rng = np.random.RandomState(2)
+        image = rng.rand(120, 90).astype(np.float32)
+        image[5, 7] = np.nan
+        header = fits.Header()
+        header['CRVAL1'] = 10.
+        image_file = str(tmpdir.join('image.fits'))
+        fits.writeto(image_file, image, header)
+        kernel = rng.rand(9, 9).astype(np.float32)
+        output = str(tmpdir.join('output.fits'))
+
+        ntiles = apply_kernel(image_file, kernel, output, tile=32, jobs=2,
+                              processes=processes)
+
+        data, header = fits.getdata(output, header=True)
+        assert ntiles == 12
+        assert data.dtype.newbyteorder('=') == np.float32
+        assert header['CRVAL1'] == 10.
+        assert_allclose(data, convolve(np.nan_to_num(image).astype(float),
+                                       kernel, mode='constant'), rtol=1e-5)
+
+        with pytest.raises(IOError):
+            apply_kernel(image_file, kernel, output)
+
+    @pytest.mark.parametrize('processes', [False, True])
+    def test_apply_kernel_scaled(self, tmpdir, processes):
+        rng = np.random.RandomState(3)
+        hdu = fits.PrimaryHDU(rng.randint(-1000, 1000, (512, 512)) / 2.)
+        hdu.scale('int16', bscale=0.5, bzero=10.)
+        image_file = str(tmpdir.join('scaled.fits'))
+        hdu.writeto(image_file)
+        image = fits.getdata(image_file)
+        kernel = rng.rand(9, 9)
+        output = str(tmpdir.join('output.fits'))
+
+        apply_kernel(image_file, kernel, output, tile=64, jobs=2,
+                     processes=processes)
+        assert_allclose(fits.getdata(output),
+                        convolve(image.astype(float), kernel,
+                                 mode='constant'), atol=1e-9)
+
+        if not processes:
+            # The scaled image is read tile by tile, never whole
+            tracemalloc.start()
+            apply_kernel(image_file, kernel, output, tile=64, jobs=2,
+                         overwrite=True)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert peak < image.nbytes / 2
+
+
+class TestStream(object):
+    @pytest.fixture
+    def cubefiles(self, tmpdir):
+        """Source PSF cube and target PSF image files"""
+        y, x = np.indices((41, 41)) - 20
+        cube = np.array([np.exp(-(x**2 + y**2) / (2 * sigma**2))
+                         for sigma in np.linspace(1., 2.5, 7)])
+        cube[3, 0, 0] = np.nan
+        files = []
+        for name, data, pixscale in [
+                ('source', cube, 0.1),
+                ('target', np.exp(-(x**2 + y**2) / 18.), 0.2)]:
+            header = fits.Header()
+            header['PIXSCALE'] = pixscale
+            files.append(str(tmpdir.join(name + '.fits')))
+            fits.writeto(files[-1], data, header)
+        return files
+
+    def test_stream_kernels(self, cubefiles, tmpdir):
+        psf_source, pixscale_source = load_psf(cubefiles[0])
+        psf_target, pixscale_target = load_psf(cubefiles[1])
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target, angle_source=10.,
+                               reg_fact=1e-5)
+        output = str(tmpdir.join('kernels.fits'))
+
+        done = []
+        nkernels = stream_kernels(cubefiles[0], cubefiles[1], output,
+                                  angle_source=10., reg_fact=1e-5, chunk=3,
+                                  progress=lambda *args: done.append(args))
+        kernel, header = fits.getdata(output, header=True)
+        assert nkernels == 7
+        assert done == [(3, 7), (6, 7), (7, 7)]
+        assert_allclose(kernel, k_ref)
+        assert header['REGFACT'] == 1e-5
+        assert not os.path.exists(checkpoint_name(output))
+
+        # Target cube, single precision
+        fits.writeto(cubefiles[1], np.stack([psf_target] * 7),
+                     fits.getheader(cubefiles[1]), overwrite=True)
+        stream_kernels(cubefiles[0], cubefiles[1], output, chunk=4,
+                       dtype=np.float32, overwrite=True)
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target, dtype=np.float32)
+        kernel = fits.getdata(output)
+        assert kernel.dtype.newbyteorder('=') == np.float32
+        assert_allclose(kernel, k_ref, rtol=1e-5, atol=1e-7)
+
+        with pytest.raises(IOError):
+            stream_kernels(cubefiles[0], cubefiles[1], output)
+        with pytest.raises(ValueError):
+            stream_kernels(cubefiles[1], cubefiles[0], output, chunk=0)
+
+    def test_stream_scaled(self, cubefiles, tmpdir):
+        # Target PSF stored as integers scaled by BSCALE/BZERO
+        hdu = fits.open(cubefiles[1])[0]
+        hdu.scale('int16', bscale=1e-4, bzero=1.)
+        hdu.writeto(cubefiles[1], overwrite=True)
+        psf_source, pixscale_source = load_psf(cubefiles[0])
+        psf_target, pixscale_target = load_psf(cubefiles[1])
+        k_ref = compute_kernel(psf_source, psf_target, pixscale_source,
+                               pixscale_target)
+        output = str(tmpdir.join('kernels.fits'))
+
+        stream_kernels(cubefiles[0], cubefiles[1], output, chunk=3)
+        # Single precision, the type of the scaled target
+        assert_allclose(fits.getdata(output), k_ref, atol=1e-6)
+
+    @pytest.mark.parametrize('resample', ['spline', 'fourier'])
+    def test_stream_prepared_once(self, cubefiles, tmpdir, monkeypatch,
+                                  resample):
+        prepared = []
+
+        def counted(function):
+            def prepare(psf, *args, **kwargs):
+                prepared.append((function.__name__, psf.ndim))
+                return function(psf, *args, **kwargs)
+            return prepare
+
+        for function in [prepare_target, prepare_source, prepare_source_otf]:
+            monkeypatch.setattr(stream, function.__name__, counted(function))
+
+        source = ('prepare_source_otf' if resample == 'fourier'
+                  else 'prepare_source')
+        output = str(tmpdir.join('kernels.fits'))
+        stream_kernels(cubefiles[0], cubefiles[1], output, chunk=3,
+                       resample=resample)
+        # The target image is prepared once, the source cube by chunks
+        assert prepared == [('prepare_target', 2)] + [(source, 3)] * 3
+
+        # Source image, target cube
+        psf_source, _ = load_psf(cubefiles[0])
+        fits.writeto(cubefiles[0], psf_source[0],
+                     fits.getheader(cubefiles[0]), overwrite=True)
+        fits.writeto(cubefiles[1], np.stack([load_psf(cubefiles[1])[0]] * 7),
+                     fits.getheader(cubefiles[1]), overwrite=True)
+        del prepared[:]
+        stream_kernels(cubefiles[0], cubefiles[1], output, chunk=3,
+                       resample=resample, overwrite=True)
+        assert prepared == [(source, 2)] + [('prepare_target', 3)] * 3
+
+    def test_resume(self, cubefiles, tmpdir, monkeypatch):
+        output = str(tmpdir.join('kernels.fits'))
+        reference = str(tmpdir.join('reference.fits'))
+        stream_kernels(cubefiles[0], cubefiles[1], reference, chunk=7)
+
+        calls = []
+
+        def interrupted(*args, **kwargs):
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            calls.append(args)
+            return kernel_from_otf(*args, **kwargs)
+
+        monkeypatch.setattr(stream, 'kernel_from_otf', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            stream_kernels(cubefiles[0], cubefiles[1], output, chunk=2)
+        assert read_checkpoint(output)['done'] == 4
+        monkeypatch.undo()
+
+        # Different parameters do not resume the run
+        with pytest.raises(IOError):
+            stream_kernels(cubefiles[0], cubefiles[1], output, chunk=2,
+                           reg_fact=1e-3)
+
+        # Temporary checkpoint of a run interrupted while writing it
+        stale = tmpdir.join(TMP_PREFIX + 'progress.tmp')
+        stale.write('{')
+        old = time.time() - TMP_MAX_AGE - 1
+        os.utime(str(stale), (old, old))
+
+        assert stream_kernels(cubefiles[0], cubefiles[1], output,
+                              chunk=2) == 3
+        assert_equal(fits.getdata(output), fits.getdata(reference))
+        assert not os.path.exists(checkpoint_name(output))
+        assert not stale.check()
+
+        with pytest.raises(ValueError):
+            stream_kernels(cubefiles[1], cubefiles[1], output)
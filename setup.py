@@ -53,14 +53,18 @@ setup(
     entry_points={
         'console_scripts': [
             'pypher = pypher.pypher:main',
+            'pypher-batch = pypher.batch:main',
+            'pypher-apply = pypher.apply:main',
+            'pypher-stream = pypher.stream:main',
             'addpixscl = pypher.addpixscl:main',
         ],
     },
     install_requires=[
-        'numpy>=1.7.2',
-        'scipy>=0.9',
-        'astropy>=0.4'
+        'numpy>=1.15',
+        'scipy>=1.4',
+        'astropy>=3.0',
     ],
+    python_requires='>=3.7',
     classifiers=[
         'Programming Language :: Python',
         'Development Status :: 4 - Beta',
@@ -68,8 +72,9 @@ setup(
         'Intended Audience :: Science/Research',
         'Topic :: Scientific/Engineering :: Astronomy',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
     ],
 )